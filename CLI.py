@@ -37,7 +37,7 @@ class MainInterpreter(cmd.Cmd):
     prompt = bcolors.OKBLUE + "(Expelliarmus) " + bcolors.ENDC
     _availableArgsList = ("vmis", "packages", "baseimages")
     _availableArgsReassembly = []
-    _availableArgsEvaluateFunctions = ["decomposition1", "decomposition2", "reassembly", "similarity"]
+    _availableArgsEvaluateFunctions = ["decomposition1", "decomposition2", "reassembly", "similarity", "graphs", "graphfiles"]
     _availableArgsEvaluateOptions = ["--repetitions=", "--path="]
 
     def __init__(self):
@@ -50,9 +50,7 @@ class MainInterpreter(cmd.Cmd):
         self.exp = Expelliarmus()
 
         with RepositoryDatabase() as repo:
-            numVMIs = repo.getNumberOfVMIs()
-            numBases = repo.getNumberOfBaseImages()
-            numPkgs = repo.getNumberOfPackages()
+            (numVMIs, numBases, numPkgs) = [str(number) for number in repo.getRepositorySummary()]
             self._availableArgsReassembly = repo.getAllVmiNames()
             self._availableArgsReassembly.append("all")
 
@@ -85,13 +83,24 @@ class MainInterpreter(cmd.Cmd):
             print "\texit       - exit program"
             print ""
 
-    def do_list(self, items):
+    def do_list(self, line):
+        args = line.split()
+        items = args[0] if len(args) > 0 else ""
+        page = None
+        if len(args) == 2:
+            if not args[1].isdigit() or int(args[1]) < 1:
+                print "Error: \"%s\" is not a valid page number." % args[1]
+                return
+            page = int(args[1])
+        elif len(args) > 2:
+            print "Error: to many arguments. Please consult \"help list\"."
+            return
         if items == "vmis":
-            self.exp.printVMIs()
+            self.exp.printVMIs(page)
         elif items == "packages":
-            self.exp.printPackages()
+            self.exp.printPackages(page)
         elif items == "baseimages":
-            self.exp.printBaseImages()
+            self.exp.printBaseImages(page)
         else:
             print "\"%s\" not recognized. Type \"help list\" for possible components to list" % items
 
@@ -99,9 +108,10 @@ class MainInterpreter(cmd.Cmd):
         return [i for i in self._availableArgsList if i.startswith(text)]
 
     def help_list(self):
-        print "\nUsage: list { vmis | packages | baseimages }"
+        print "\nUsage: list { vmis | packages | baseimages } [page]"
         print ""
-        print "\tShows a complete list of VMIs/Packages/Base images that are currently stored in the repository.\n"
+        print "\tShows a complete list of VMIs/Packages/Base images that are currently stored in the repository."
+        print "\tIf \"page\" is given, only this page of the list is shown (%i entries per page).\n" % StaticInfo.cliListPageSize
 
     def do_inspect(self, line):
         if line.startswith("/"):
@@ -302,11 +312,17 @@ class MainInterpreter(cmd.Cmd):
             if self.clearVmiFolder():
                 print "\n"
                 self.exp.evaluateReassembly(repetitions)
+        elif func == "graphs":
+            print "\n"
+            self.exp.evaluateGraphRepresentation(repetitions)
+        elif func == "graphfiles":
+            print "\n"
+            self.exp.evaluateGraphFiles(repetitions)
         else:
             print "Error: Functionality \"%s\" not recognized" % func
 
     def help_evaluate(self):
-        print "\nUsage: evaluate [options] { decomposition1 | decomposition2 | reassembly | similarity }"
+        print "\nUsage: evaluate [options] { decomposition1 | decomposition2 | reassembly | similarity | graphs | graphfiles }"
         print "\n\tEvaluates the given functionality and saves results in folder \"Evaluations\"."
         print "\nFunctionalities:"
         print "\tdecomposition1"
@@ -321,6 +337,14 @@ class MainInterpreter(cmd.Cmd):
         print "\n\tsimilarity"
         print "\t\tEvaluates the similarity between each VMI in source folder."
         print "\t\tOption \"--path\" has to be set to specify a source folder for VMIs (These will not be manipulated)."
+        print "\n\tgraphs"
+        print "\t\tCompares memory usage, file size, load time and closure time of the compact package graphs"
+        print "\t\tin the local repository with networkx graphs."
+        print "\t\tOption \"--path\" is ignored."
+        print "\n\tgraphfiles"
+        print "\t\tCompares file size, save time and load time of the graph files in the local repository with pickles"
+        print "\t\tand measures queries on memory-mapped graph files."
+        print "\t\tOption \"--path\" is ignored."
         print "\nOptions:"
         print "\t--repetitions=x"
         print "\t\tSpecify number of repetitions for evaluation (default is 5), not applicable for similarity."
@@ -1,17 +1,111 @@
+import errno
+import fcntl
+import hashlib
+import multiprocessing
 import sys
 import time
 import shutil
 import os
 from collections import defaultdict
+from contextlib import contextmanager
 
+from Evaluation import DecompositionEvaluation
+from GraphFile import GraphFileLog
 from GuestFSHelper import GuestFSHelper
+from PackageStore import PackageStore
 from RepositoryDatabase import RepositoryDatabase
 from StaticInfo import StaticInfo
-from VMIDescription import BaseImageDescriptor, VMIDescriptor
+from VMIDescription import BaseImageDescriptor, VMIDescriptor, VMIMasterDescriptor
 from VMIManipulation import VMIManipulator
 from VMISimilarity import SimilarityCalculator
 
 
+class BaseImageCompatibilityIndex:
+    """
+        Inverted index over the packages of several base images, used to check a package set against all base images
+        in one pass. Base images are numbered, sets of base images are represented as bit masks.
+    """
+    def __init__(self, baseImages):
+        """
+        :param list() baseImages: list of BaseImageDescriptor
+        """
+        self.baseImages = list(baseImages)
+        self.allMask = (1 << len(self.baseImages)) - 1
+        # in the form of {pkgName:{(version, architecture):mask of base images containing this package version}}
+        self.packageIndex = defaultdict(lambda: defaultdict(int))
+        for (index, baseImage) in enumerate(self.baseImages):
+            bit = 1 << index
+            for (pkgName, version, architecture) in baseImage.graph.iterPackageVersions():
+                self.packageIndex[pkgName][(version, architecture)] |= bit
+
+    @staticmethod
+    def isCompatible(version1, architecture1, version2, architecture2):
+        # Version has to be the same, architecture has to be the same or at least one has to say all
+        return version1 == version2 and (architecture1 == architecture2 or architecture1 == "all" or architecture2 == "all")
+
+    def getCompatibleMask(self, packageDict):
+        """
+            Same as checkCompatibilityForPackages for every base image at once.
+        :param dict() packageDict: in the form of dict{pkgName, pkgInfo} with pkgInfo = dict{version:?, Arch:?,...}
+        :return: mask of base images that contain no package of packageDict in an incompatible version or architecture
+        """
+        if packageDict is None:
+            return self.allMask
+        conflictMask = 0
+        for (pkgName, pkgInfo) in packageDict.iteritems():
+            versions = self.packageIndex.get(pkgName)
+            if versions is None:
+                continue
+            for ((version, architecture), mask) in versions.iteritems():
+                if not BaseImageCompatibilityIndex.isCompatible(version, architecture,
+                                                                pkgInfo[StaticInfo.dictKeyVersion],
+                                                                pkgInfo[StaticInfo.dictKeyArchitecture]):
+                    conflictMask |= mask
+        return self.allMask & ~conflictMask
+
+    def getBaseImagesInMask(self, mask):
+        return [baseImage for (index, baseImage) in enumerate(self.baseImages) if mask >> index & 1]
+
+
+class GuestDecomposition:
+    """
+        Result of the guest phase of a decomposition, contains everything the commit phase requires.
+        Transferred from worker processes to the committing process as pickle.
+    """
+    def __init__(self, vmiName):
+        self.vmiName = vmiName
+        self.vmi = None                 # type: VMIDescriptor
+        self.newBaseImage = None        # type: BaseImageDescriptor
+        self.MSDepList = None
+        self.MSSubGraph = None
+        self.MSPkgDict = None
+        self.localPathToUserDir = None
+        self.handlerCreationTime = None
+        self.timeGuest = None
+        self.timeCommit = None
+        # evaluation of the guest phase of a batch decomposition
+        self.evalDecomp = None
+        # error message if the guest phase failed
+        self.error = None
+
+
+def decomposeGuestTask(task):
+    """
+        Runs the guest phase of one VMI of a batch, module level function so that worker processes can run it.
+    :param task: tuple (pathToVMI, vmiName, mainServices, evaluate)
+    :return: GuestDecomposition
+    """
+    (pathToVMI, vmiName, mainServices, evaluate) = task
+    evalDecomp = DecompositionEvaluation(None) if evaluate else None
+    try:
+        guestDecomposition = Decomposer.decomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=evalDecomp)
+    except (SystemExit, Exception) as e:
+        guestDecomposition = GuestDecomposition(vmiName)
+        guestDecomposition.error = str(e)
+    guestDecomposition.evalDecomp = evalDecomp
+    return guestDecomposition
+
+
 class Decomposer:
 
     @staticmethod
@@ -27,7 +121,71 @@ class Decomposer:
 
     @staticmethod
     def decompose(pathToVMI, vmiName, mainServices, evalDecomp=None):
+        guestDecomposition = Decomposer.decomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=evalDecomp)
+        Decomposer.commitDecomposition(guestDecomposition, evalDecomp=evalDecomp)
+
+    @staticmethod
+    def decomposeBatch(vmiDataList, numWorkers=None, evalDecomp=None):
+        """
+            Decomposes several VMIs with the same result as decomposing them one after another in the given order.
+            The guest phase (graph creation, package export and removal, user folder export) runs in up to numWorkers
+            worker processes in parallel, the commit phase that changes the repository runs in this process in order.
+            VMIs whose guest phase fails are reported and skipped.
+        :param vmiDataList: list of tuples (pathToVMI, vmiName, mainServices)
+        :param numWorkers: number of worker processes, default is StaticInfo.decompositionWorkers
+        :param DecompositionEvaluation evalDecomp: holds the results of a VMI when its GuestDecomposition is yielded
+        :return: generator of GuestDecompositions in the order of vmiDataList, yielded after their commit phase
+        """
+        if numWorkers is None:
+            numWorkers = StaticInfo.decompositionWorkers
+        tasks = [(pathToVMI, vmiName, mainServices, evalDecomp is not None)
+                 for (pathToVMI, vmiName, mainServices) in vmiDataList]
+        for guestDecomposition in Decomposer.iterateGuestDecompositions(tasks, numWorkers):
+            if guestDecomposition.error is not None:
+                print "\nDecomposition of VMI \"%s\" failed and is skipped:\n\t%s" % (guestDecomposition.vmiName,
+                                                                                    guestDecomposition.error)
+                yield guestDecomposition
+                continue
+            startTime = time.time()
+            if evalDecomp is not None:
+                evalDecomp.setGuestInfo(guestDecomposition.evalDecomp)
+            Decomposer.commitDecomposition(guestDecomposition, evalDecomp=evalDecomp)
+            guestDecomposition.timeCommit = time.time() - startTime
+            yield guestDecomposition
+
+    @staticmethod
+    def iterateGuestDecompositions(tasks, numWorkers):
+        """
+        :param tasks: list of tuples (pathToVMI, vmiName, mainServices, evaluate)
+        :param numWorkers: tasks are run one after another in this process if numWorkers is 1
+        :return: generator of GuestDecompositions in the order of tasks
+        """
+        if numWorkers <= 1 or len(tasks) <= 1:
+            GuestFSHelper.warmUpPool()
+            for task in tasks:
+                yield decomposeGuestTask(task)
+            return
+        workerPool = multiprocessing.Pool(min(numWorkers, len(tasks)), initializer=GuestFSHelper.resetAfterFork)
+        try:
+            # results are returned in order, the guest phases of later VMIs continue while a VMI is committed
+            for guestDecomposition in workerPool.imap(decomposeGuestTask, tasks):
+                yield guestDecomposition
+            workerPool.close()
+        except BaseException:
+            workerPool.terminate()
+            raise
+        finally:
+            workerPool.join()
+
+    @staticmethod
+    def decomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=None):
+        """
+            Guest phase of the decomposition, the repository is only changed by adding exported packages and the
+            user folder.
+        :return: GuestDecomposition
+        """
         print "\n=== Decompose VMI \"%s\"\nPath: \"%s\"" % (vmiName, pathToVMI)
+        guestStartTime = time.time()
 
         if not os.path.isfile(pathToVMI):
             sys.exit("ERROR: Cannot decompose VMI \"%s\". File \"%s\" does not exist!" % (vmiName, pathToVMI))
@@ -40,135 +198,194 @@ class Decomposer:
         startTime = time.time()
         (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
         handlerCreationTime = time.time() - startTime
-        print ('Creating VMI Graph...')
-        vmi = VMIDescriptor(pathToVMI, vmiName, mainServices, guest, root, verbose=True)
+        try:
+            print ('Creating VMI Graph...')
+            vmi = VMIDescriptor(pathToVMI, vmiName, mainServices, guest, root, verbose=True)
+
+            print "VMI Information:\n" \
+                  "\tDistribution:\t%s\n" \
+                  "\tVersion:\t\t%s\n" \
+                  "\tArchitecture:\t%s\n" \
+                  "\tPackageManager:\t%s"\
+                  % (vmi.distribution, vmi.distributionVersion, vmi.architecture, vmi.pkgManager)
+
+            Decomposer.checkMainServicesExistence(vmi)
+
+            guestDecomposition = GuestDecomposition(vmiName)
+            guestDecomposition.vmi = vmi
+            guestDecomposition.handlerCreationTime = handlerCreationTime
+
+            # Construct Dependency lists
+            guestDecomposition.MSDepList = vmi.getMainServicesDepList()
+
+            # Construct subgraph for main services
+            guestDecomposition.MSSubGraph = vmi.getSubGraphForMainServices()
+
+            # Construct Dict that holds all required packages
+            guestDecomposition.MSPkgDict = vmi.getNodeDataFromMainServicesSubtrees()
+            # in the form of [(root,dict{nodeName:dict{nodeAttributes}})]
+            # Note: root is mainservice and part of the dict
+
+            # Export and remove Packages from VMI
+            # after this, the packages of the main services only exist in the graph of vmiDescriptor "vmi"!
+            # summed sizes of required and exported packages are saved for evaluation
+            manipulator = VMIManipulator.getVMIManipulator(vmi.pathToVMI, vmi.vmiName, guest, root)
+            Decomposer.exportPackages(vmi, manipulator, evalDecomp=evalDecomp)
+            guestDecomposition.newBaseImage = Decomposer.removePackages(vmi, manipulator, guest, root)
+
+            # Export and remove User Directory
+            print "User Folder Export:"
+            guestDecomposition.localPathToUserDir = manipulator.exportHomeDir()
+            print "\tUserfolder exported to %s" % guestDecomposition.localPathToUserDir
+            print "User Folder Removal:"
+            manipulator.removeHomeDir()
+            print "\tUserfolder removed."
+        finally:
+            # also on sys.exit, long-lived workers would otherwise leak the handle or pooled appliance
+            GuestFSHelper.shutdownHandle(guest)
+        guestDecomposition.timeGuest = time.time() - guestStartTime
+        return guestDecomposition
 
-        print "VMI Information:\n" \
-              "\tDistribution:\t%s\n" \
-              "\tVersion:\t\t%s\n" \
-              "\tArchitecture:\t%s\n" \
-              "\tPackageManager:\t%s"\
-              % (vmi.distribution, vmi.distributionVersion, vmi.architecture, vmi.pkgManager)
-
-        Decomposer.checkMainServicesExistence(vmi)
+    @staticmethod
+    def commitDecomposition(guestDecomposition, evalDecomp=None):
+        """
+            Commit phase of the decomposition, stores base image, VMI and master graph in the repository.
+        :param GuestDecomposition guestDecomposition:
+        """
+        vmi = guestDecomposition.vmi
+        newBaseImage = guestDecomposition.newBaseImage
+        MSDepList = guestDecomposition.MSDepList
+        MSSubGraph = guestDecomposition.MSSubGraph
+        MSPkgDict = guestDecomposition.MSPkgDict
+        newMainServices = vmi.mainServices
+        localPathToUserDir = guestDecomposition.localPathToUserDir
+        handlerCreationTime = guestDecomposition.handlerCreationTime
 
         # Check Similarity with all mastergraphs in repository (only for evaluation)
         Decomposer.compareWithMasterGraphs(vmi, evalDecomp=evalDecomp)
 
-        # Construct Dependency lists
-        MSDepList = vmi.getMainServicesDepList()
-
-        # Construct subgraph for main services
-        MSSubGraph = vmi.getSubGraphForMainServices()
-
-        # Construct Dict that holds all required packages
-        MSPkgDict = vmi.getNodeDataFromMainServicesSubtrees()
-        # in the form of [(root,dict{nodeName:dict{nodeAttributes}})]
-        # Note: root is mainservice and part of the dict
-
-        newMainServices = vmi.mainServices
-
-
-        # Export and remove Packages from VMI and its graph
-        # after this, vmiDescriptor "vmi" becomes invalid!
-        # summed sizes of required and exported packages are saved for evaluation
-        manipulator = VMIManipulator.getVMIManipulator(vmi.pathToVMI, vmi.vmiName, guest, root)
-        Decomposer.exportPackages(vmi, manipulator, evalDecomp=evalDecomp)
-        newBaseImage = Decomposer.removePackages(vmi, manipulator, guest, root)
-
-        # Export and remove User Directory
-        print "User Folder Export:"
-        localPathToUserDir = manipulator.exportHomeDir()
-        print "\tUserfolder exported to %s" % localPathToUserDir
-        print "User Folder Removal:"
-        manipulator.removeHomeDir()
-        print "\tUserfolder removed."
-
-        GuestFSHelper.shutdownHandle(guest)
-
-        with RepositoryDatabase() as repoManager:
-            # Decide which baseImage to keep
-            print "Base Image Storage:"
-            numPackagesInNew = len(newBaseImage.graph.nodes())
-            existingBaseImagesWithCompatiblePackages = repoManager.getBaseImagesWithCompatiblePackages(newBaseImage.distribution,
-                                                                                                       newBaseImage.distributionVersion,
-                                                                                                       newBaseImage.architecture,
-                                                                                                       newBaseImage.pkgManager)
-            (chosenBaseImage,replacingList) = Decomposer.chooseBaseImage(newBaseImage,MSPkgDict,
-                                                                         existingBaseImagesWithCompatiblePackages)
-
-            chosenBaseImageOrigFileName = chosenBaseImage.pathToVMI.split("/")[-1]
-
-            # new base image will remain and possibly replace existing base images
-            if chosenBaseImage == newBaseImage:
-                print "\tThe base image of the new VMI will remain."
-                if len(replacingList) > 0:
-                    print"\tThe existing VMIs that used the following base images are also compatible with the new base image and will use it instead."
-                    for oldBaseImage in replacingList:
-                        print "\t\t" + oldBaseImage.pathToVMI
+        # the VMI is registered in the database in a single unit of work. Files cannot be rolled back with it:
+        # files written for the VMI are restored or removed if the registration fails, files that become unused are
+        # only removed after the changes were committed
+        originalPathToBaseImage = None
+        createdGraphFileNames = list()
+        masterGraphLogSize = None
+        try:
+            with RepositoryDatabase() as repoManager, repoManager.transaction():
+                # Decide which baseImage to keep
+                print "Base Image Storage:"
+                numPackagesInNew = len(newBaseImage.graph.nodes())
+                existingBaseImagesWithCompatiblePackages = repoManager.getBaseImagesWithCompatiblePackages(newBaseImage.distribution,
+                                                                                                           newBaseImage.distributionVersion,
+                                                                                                           newBaseImage.architecture,
+                                                                                                           newBaseImage.pkgManager)
+                (chosenBaseImage,replacingList) = Decomposer.chooseBaseImage(newBaseImage,MSPkgDict,
+                                                                             existingBaseImagesWithCompatiblePackages)
+
+                chosenBaseImageOrigFileName = chosenBaseImage.pathToVMI.split("/")[-1]
+
+                # new base image will remain and possibly replace existing base images
+                if chosenBaseImage == newBaseImage:
+                    print "\tThe base image of the new VMI will remain."
+                    if len(replacingList) > 0:
+                        print"\tThe existing VMIs that used the following base images are also compatible with the new base image and will use it instead."
+                        for oldBaseImage in replacingList:
+                            print "\t\t" + oldBaseImage.pathToVMI
+
+                    else:
+                        print "\tNo compatible base images found in repository."
+
+                    # Move new base image to local repository
+                    originalPathToBaseImage = Decomposer.moveBaseImageToRepository(chosenBaseImage)
+
+                    # Save base image graph
+                    chosenBaseImage.saveGraph()
+                    createdGraphFileNames.append(chosenBaseImage.graphFileName)
+
+                    # Create and save new master graph
+                    masterDescriptor = chosenBaseImage.getVMIMasterDescriptor()
+                    masterDescriptor.saveGraph(compact=False)
+                    createdGraphFileNames.append(masterDescriptor.graphFileName)
+
+                    # add BaseImage to repository
+                    chosenBaseImageID = repoManager.addBaseImage(chosenBaseImage, masterDescriptor.graphFileName)
 
                 else:
-                    print "\tNo compatible base images found in repository."
-
-                # Move new base image to local repository
-                Decomposer.moveBaseImageToRepository(chosenBaseImage)
-
-                # Save base image graph
-                chosenBaseImage.saveGraph()
-
-                # Create and save new master graph
-                masterDescriptor = chosenBaseImage.getVMIMasterDescriptor()
-                masterDescriptor.saveGraph()
-
-                # add BaseImage to repository
-                chosenBaseImageID = repoManager.addBaseImage(chosenBaseImage, masterDescriptor.graphFileName)
-
-            else:
-                print "\tThe new VMI is compatible with the following existing base image which will be used instead of the original."
-                print "\t\t" + chosenBaseImage.pathToVMI
-                if len(replacingList) > 0:
-                    print"\tThe following base images will be replaced."
-                    for oldBaseImage in replacingList:
-                        print "\t\t" + oldBaseImage.pathToVMI
-                chosenBaseImageID = repoManager.getBaseImageId(chosenBaseImage.pathToVMI)
-                masterDescriptor = repoManager.getVMIMasterDescriptorFromBaseID(chosenBaseImageID)
-
-            # Add VMI info to repository
-            vmiID = repoManager.addVMI(vmi.vmiName,
-                                       localPathToUserDir,
-                                       chosenBaseImageID)
-
-            # add VMI's main services and its dependencies to repository
-            repoManager.addMainServicesDepListForVMI(vmiID, chosenBaseImage.distribution, MSDepList)
-
-            # add new main services and dependencies to mastergraph
-            masterDescriptor.addSubGraph(newMainServices, MSSubGraph)
-
-            # add main services and dependencies mastergraphs that will be replaced
-            for oldBaseImage in replacingList:
-                if oldBaseImage != newBaseImage:
-                    oldBaseImageID = repoManager.getBaseImageId(oldBaseImage.pathToVMI)
-                    masterDescriptor.addSubGraph(repoManager.getMainServicesForBaseImage(oldBaseImageID),
-                                                 repoManager.getVMIMasterDescriptorFromBaseID(oldBaseImageID).getSubGraphForMainServices())
-            masterDescriptor.saveGraph()
-
-            # Replace base images in database (also removes old images and graphs from filesystem)
-            repoManager.replaceAndRemoveBaseImages(chosenBaseImage, replacingList)
-
-            print "\nVMI successfully decomposed and added to repository."
-
-            # for evaluation purposes
-            if evalDecomp is not None:
-                if len(replacingList) > 0:
-                    replacedBaseImagesString = ""
-                    for b in replacingList:
-                        replacedBaseImagesString = replacedBaseImagesString + b.pathToVMI.split("/")[-1] + ","
-                    baseImageTreatmentString = "\"%s\" replaces \"%s\"" % (chosenBaseImageOrigFileName,
-                                                                           replacedBaseImagesString[:-1])
+                    print "\tThe new VMI is compatible with the following existing base image which will be used instead of the original."
+                    print "\t\t" + chosenBaseImage.pathToVMI
+                    if len(replacingList) > 0:
+                        print"\tThe following base images will be replaced."
+                        for oldBaseImage in replacingList:
+                            print "\t\t" + oldBaseImage.pathToVMI
+                    chosenBaseImageID = repoManager.getBaseImageId(chosenBaseImage.pathToVMI)
+                    masterDescriptor = repoManager.getVMIMasterDescriptorFromBaseID(chosenBaseImageID)
+                    # the subgraphs appended below are discarded again if the registration fails
+                    VMIMasterDescriptor.waitForCompaction(masterDescriptor.graphFileName)
+                    masterGraphLogSize = GraphFileLog.getLogSize(masterDescriptor.graphFileName)
+
+                # Add VMI info to repository
+                vmiID = repoManager.addVMI(vmi.vmiName,
+                                           localPathToUserDir,
+                                           chosenBaseImageID)
+
+                # add VMI's main services and its dependencies to repository
+                repoManager.addMainServicesDepListForVMI(vmiID, chosenBaseImage.distribution, MSDepList)
+
+                # add new main services and dependencies to mastergraph
+                masterDescriptor.addSubGraph(newMainServices, MSSubGraph)
+
+                # add main services and dependencies mastergraphs that will be replaced
+                for oldBaseImage in replacingList:
+                    if oldBaseImage != newBaseImage:
+                        oldBaseImageID = repoManager.getBaseImageId(oldBaseImage.pathToVMI)
+                        masterDescriptor.addSubGraph(repoManager.getMainServicesForBaseImage(oldBaseImageID),
+                                                     repoManager.getVMIMasterDescriptorFromBaseID(oldBaseImageID).getSubGraphForMainServices())
+                masterDescriptor.saveGraph(compact=False)
+                repoManager.updateMasterGraphSummary(chosenBaseImageID, masterDescriptor)
+                repoManager.updateMasterGraphSignature(chosenBaseImageID, masterDescriptor)
+
+                # Replace base images in database, their files are removed after the commit
+                replacedGraphFileNames = repoManager.replaceAndRemoveBaseImages(chosenBaseImage, replacingList)
+
+                print "\nVMI successfully decomposed and added to repository."
+
+                # for evaluation purposes
+                if evalDecomp is not None:
+                    if len(replacingList) > 0:
+                        replacedBaseImagesString = ""
+                        for b in replacingList:
+                            replacedBaseImagesString = replacedBaseImagesString + b.pathToVMI.split("/")[-1] + ","
+                        baseImageTreatmentString = "\"%s\" replaces \"%s\"" % (chosenBaseImageOrigFileName,
+                                                                               replacedBaseImagesString[:-1])
+                    else:
+                        baseImageTreatmentString = "New base image added as \"%s\"" % chosenBaseImage.pathToVMI.split("/")[-1]
+                    evalDecomp.baseImageInfo = baseImageTreatmentString
+                    evalDecomp.timeHandlerCreation = handlerCreationTime
+        except BaseException:
+            print "\nRegistration of VMI \"%s\" failed, files written for it are removed." % vmi.vmiName
+            if masterGraphLogSize is not None:
+                GraphFileLog.truncate(masterDescriptor.graphFileName, masterGraphLogSize)
+            for graphFileName in createdGraphFileNames:
+                VMIMasterDescriptor.waitForCompaction(graphFileName)
+                GraphFileLog.remove(graphFileName)
+            if originalPathToBaseImage is not None and os.path.isfile(chosenBaseImage.pathToVMI):
+                if os.path.isfile(originalPathToBaseImage):
+                    # flattened copy of the original
+                    os.remove(chosenBaseImage.pathToVMI)
                 else:
-                    baseImageTreatmentString = "New base image added as \"%s\"" % chosenBaseImage.pathToVMI.split("/")[-1]
-                evalDecomp.baseImageInfo = baseImageTreatmentString
-                evalDecomp.timeHandlerCreation = handlerCreationTime
+                    shutil.move(chosenBaseImage.pathToVMI, originalPathToBaseImage)
+                chosenBaseImage.pathToVMI = originalPathToBaseImage
+            raise
+
+        # committed, the original of a flattened base image and the files of replaced base images are removed
+        if originalPathToBaseImage is not None and os.path.isfile(originalPathToBaseImage):
+            os.remove(originalPathToBaseImage)
+        masterDescriptor.startCompactionIfNeeded()
+        for graphFileName in replacedGraphFileNames:
+            VMIMasterDescriptor.waitForCompaction(graphFileName)
+            GraphFileLog.remove(graphFileName)
+        with RepositoryDatabase() as repoManager:
+            repoManager.removeUnusedBaseImageFiles()
 
     #TODO: rename (only export main services + deps)
     @staticmethod
@@ -181,45 +398,139 @@ class Decomposer:
         # in the form of {pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False}}
         #packageDict = self.graph.getNodeDataFromSubTrees(self.mainServices)
         packageDict = vmi.getNodeDataFromSubTrees(vmi.mainServices)
+
+        Decomposer.exportMissingPackages(vmi, manipulator, packageDict, evalDecomp=evalDecomp)
+
+    @staticmethod
+    @contextmanager
+    def packageExportLock():
+        """
+            Serializes the decisions which packages a decomposition exports and their registration, the export itself
+            runs outside of the lock (see exportMissingPackages).
+        """
+        with open(StaticInfo.relPathLocalRepositoryPackagesLock, "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    @staticmethod
+    def getExportMarker(distribution, pkg, pkgInfo):
+        key = "\n".join([distribution, pkg, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture]])
+        return StaticInfo.relPathLocalRepositoryPackagesInExport + "/" + hashlib.sha1(key).hexdigest()
+
+    @staticmethod
+    def claimPackages(distribution, packageDict):
+        """
+            Marks the packages as being exported by this process, has to be called with packageExportLock held.
+            Markers of processes that no longer exist are taken over.
+        :param dict() packageDict: packages missing in the repository, in the form of {pkg:pkgInfo}
+        :return: tuple (packages claimed by this process, packages being exported by parallel decompositions)
+        """
+        if not os.path.isdir(StaticInfo.relPathLocalRepositoryPackagesInExport):
+            os.mkdir(StaticInfo.relPathLocalRepositoryPackagesInExport)
+        claimedPackages = dict()
+        pendingPackages = dict()
+        for pkg, pkgInfo in packageDict.iteritems():
+            marker = Decomposer.getExportMarker(distribution, pkg, pkgInfo)
+            if os.path.isfile(marker):
+                with open(marker) as markerFile:
+                    ownerPID = markerFile.read()
+                if ownerPID.isdigit() and int(ownerPID) != os.getpid() and Decomposer.processExists(int(ownerPID)):
+                    pendingPackages[pkg] = pkgInfo
+                    continue
+            with open(marker, "w") as markerFile:
+                markerFile.write(str(os.getpid()))
+            claimedPackages[pkg] = pkgInfo
+        return (claimedPackages, pendingPackages)
+
+    @staticmethod
+    def processExists(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return pid > 0
+
+    @staticmethod
+    def releasePackages(distribution, packageDict):
+        for pkg, pkgInfo in packageDict.iteritems():
+            marker = Decomposer.getExportMarker(distribution, pkg, pkgInfo)
+            if os.path.isfile(marker):
+                os.remove(marker)
+
+    @staticmethod
+    def exportMissingPackages(vmi, manipulator, packageDict, evalDecomp=None):
         numAllPackages = len(packageDict)
 
         # Save install sizes of required/exported Packages
         sumSizesReqPkgs = 0
         sumSizesExpPkgs = 0
 
-        # Remove packages that already exist in host repository
-        tmp = dict(packageDict)
-        with RepositoryDatabase() as repoManager:
-            for pkg, pkgInfo in tmp.iteritems():
-                if repoManager.packageExists(pkg,
-                                             pkgInfo[StaticInfo.dictKeyVersion],
-                                             pkgInfo[StaticInfo.dictKeyArchitecture],
-                                             vmi.distribution):
-                    del packageDict[pkg]
-                    sumSizesReqPkgs = sumSizesReqPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
-                else:
-                    sumSizesReqPkgs = sumSizesReqPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
-                    sumSizesExpPkgs = sumSizesExpPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
-
-        numReqPackages = len(packageDict)
-
-        # Export packages from VMI
-        print "Package Export:\n" \
-              "\tMain Services:\t\t\t\t%s\n" \
-              "\tPackage(s) required:\t\t%i\n" \
-              "\tAlready existing locally:\t%i\n" \
-              "\tPackages to be exported:\t%i" \
-              % (",".join(vmi.mainServices),numAllPackages, numAllPackages - numReqPackages, numReqPackages)
+        for pkgInfo in packageDict.values():
+            sumSizesReqPkgs = sumSizesReqPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
 
+        # Packages that are neither in the host repository nor being exported by a parallel decomposition are claimed
+        # and exported by this decomposition. Packages exported by parallel decompositions are waited for, they are
+        # claimed as well if their decomposition fails.
+        numReqPackages = 0
         exportTime = 0.0
-        if numReqPackages > 0:
-            startTime = time.time()
-            packageInfoDict = manipulator.exportPackages(packageDict)
-            exportTime = time.time() - startTime
+        firstRound = True
+        while True:
+            with Decomposer.packageExportLock():
+                with RepositoryDatabase() as repoManager:
+                    existingPackages = repoManager.getExistingPackages([(pkg,
+                                                                         pkgInfo[StaticInfo.dictKeyVersion],
+                                                                         pkgInfo[StaticInfo.dictKeyArchitecture])
+                                                                        for pkg, pkgInfo in packageDict.iteritems()],
+                                                                       vmi.distribution)
+                for pkg, pkgInfo in packageDict.items():
+                    if (pkg, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture]) in existingPackages:
+                        del packageDict[pkg]
+                (claimedPackages, pendingPackages) = Decomposer.claimPackages(vmi.distribution, packageDict)
+
+            if firstRound:
+                print "Package Export:\n" \
+                      "\tMain Services:\t\t\t\t%s\n" \
+                      "\tPackage(s) required:\t\t%i\n" \
+                      "\tAlready existing locally:\t%i\n" \
+                      "\tExported in parallel:\t\t%i\n" \
+                      "\tPackages to be exported:\t%i" \
+                      % (",".join(vmi.mainServices), numAllPackages, numAllPackages - len(packageDict),
+                         len(pendingPackages), len(claimedPackages))
+                firstRound = False
+            elif len(claimedPackages) > 0:
+                print "\t%i package(s) of failed parallel decompositions are exported." % len(claimedPackages)
+
+            if len(claimedPackages) > 0:
+                try:
+                    startTime = time.time()
+                    packageInfoDict = manipulator.exportPackages(claimedPackages)
+                    exportTime = exportTime + time.time() - startTime
+
+                    # Deduplicate package files by content
+                    for pkgInfo in packageInfoDict.values():
+                        pkgInfo[StaticInfo.dictKeyChecksum] = PackageStore.store(pkgInfo[StaticInfo.dictKeyFilePath],
+                                                                                 pkgInfo.get(StaticInfo.dictKeyChecksum))
+
+                    # Update Repository Database
+                    with Decomposer.packageExportLock():
+                        with RepositoryDatabase() as repoManager:
+                            repoManager.addPackageDict(packageInfoDict, vmi.distribution)
+                        Decomposer.releasePackages(vmi.distribution, claimedPackages)
+                finally:
+                    # released on failure as well, parallel decompositions take them over
+                    Decomposer.releasePackages(vmi.distribution, claimedPackages)
+                numReqPackages = numReqPackages + len(claimedPackages)
+                for pkg, pkgInfo in claimedPackages.iteritems():
+                    sumSizesExpPkgs = sumSizesExpPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
+                    del packageDict[pkg]
+            elif len(pendingPackages) > 0:
+                time.sleep(StaticInfo.packageExportPollInterval)
+            else:
+                break
 
-            # Update Repository Database
-            with RepositoryDatabase() as repoManager:
-                repoManager.addPackageDict(packageInfoDict, vmi.distribution)
         if evalDecomp is not None:
             evalDecomp.reqPkgsNum = numAllPackages
             evalDecomp.expPkgsNum = numReqPackages
@@ -245,8 +556,15 @@ class Decomposer:
 
     @staticmethod
     def moveBaseImageToRepository(baseImage):
-        # Move new base image to special folder
-        format = baseImage.pathToVMI.split(".")[-1]
+        """
+            Moves the new base image to the base image folder of the repository. Base images of decomposed overlays
+            (e.g. reassembled VMIs) are flattened instead, so that no base image depends on another file. The original
+            of a flattened base image is kept, it is removed once the base image is registered.
+        :param BaseImageDescriptor baseImage:
+        :return: original path of the base image
+        """
+        backingFile = GuestFSHelper.getBackingFile(baseImage.pathToVMI)
+        format = "qcow2" if backingFile is not None else baseImage.pathToVMI.split(".")[-1]
         newPath = StaticInfo.relPathLocalRepositoryBaseImages + "/" + \
                   baseImage.distribution + "_" + \
                   baseImage.distributionVersion + "_" + \
@@ -261,8 +579,14 @@ class Decomposer:
                       baseImage.pkgManager + "_" + \
                       baseImage.architecture + "_" + \
                       str(number) + "." + format
-        shutil.move(baseImage.pathToVMI, newPath)
+        originalPath = baseImage.pathToVMI
+        if backingFile is not None:
+            if not GuestFSHelper.flattenImage(baseImage.pathToVMI, newPath):
+                sys.exit("Error: Cannot flatten base image \"%s\" backed by \"%s\"." % (baseImage.pathToVMI, backingFile))
+        else:
+            shutil.move(baseImage.pathToVMI, newPath)
         baseImage.pathToVMI = newPath
+        return originalPath
 
 
     @staticmethod
@@ -286,69 +610,50 @@ class Decomposer:
         if existingBaseImagesAndMSPackages == None or len(existingBaseImagesAndMSPackages) == 0:
             return (newBaseImage,list())
 
-        compatibilities = defaultdict(dict)
-        # in form       B1      B2      B3      count   new
-        #           B1  True    False   False   1       1
-        #           B2  False   True    True    2       0
-        #           B3  True    False   True    2       0
-        #
-        #           compatibilities[B3][B1] = True  -> means main services of B1 are compatible in B3
-        #                                           -> B3 can replace B1
+        # compatibilities[B3] is a mask of base images:
+        #           bit of B1 set   -> means main services of B1 are compatible in B3
+        #                           -> B3 can replace B1
         allBaseImagesAndMSPkgs = dict(existingBaseImagesAndMSPackages)
         allBaseImagesAndMSPkgs[newBaseImage] = newMSPackages
-        # by row
-        for b1 in allBaseImagesAndMSPkgs.keys():
-            if b1 == newBaseImage:
-                compatibilities[b1]["new"] = 1
-            else:
-                compatibilities[b1]["new"] = 0
-
-            compatibilities[b1]["count"] = 0
-            rowString = ""
-            # by column
-            for b2 in allBaseImagesAndMSPkgs.keys():
-                # if same or compatible
-                if b1 == b2 or b1.checkCompatibilityForPackages(allBaseImagesAndMSPkgs[b2]):
-                    compatibilities[b1][b2] = True
-                    compatibilities[b1]["count"] = compatibilities[b1]["count"] + 1
-                else:
-                    compatibilities[b1][b2] = False
-                rowString = rowString + b2.pathToVMI + ":" + str(compatibilities[b1][b2]) + ", "
-            rowString = rowString + "\t" + b1.pathToVMI
-            #print rowString
+        index = BaseImageCompatibilityIndex(allBaseImagesAndMSPkgs.keys())
+        compatibilities = dict((baseImage, 0) for baseImage in index.baseImages)
+        # by column: all base images that can host the main services of b2
+        for (position, b2) in enumerate(index.baseImages):
+            bit = 1 << position
+            for b1 in index.getBaseImagesInMask(index.getCompatibleMask(allBaseImagesAndMSPkgs[b2]) | bit):
+                compatibilities[b1] |= bit
+        newBaseImageBit = 1 << index.baseImages.index(newBaseImage)
 
         # sort base images by count (number of base images it is compatible for)
-        sortedBaseImages = sorted(compatibilities.keys(),
+        sortedBaseImages = sorted(index.baseImages,
                                   key=lambda baseImage: (
-                                      -compatibilities[baseImage]["count"],
+                                      -bin(compatibilities[baseImage]).count("1"),
                                       int(baseImage.getPkgsInstallSize()),
-                                      compatibilities[baseImage]["new"]
+                                      1 if baseImage == newBaseImage else 0
                                   ))
-        #print "Sorted base images by 1. incr. comp count, 2. decr. #(pkgs)"
-        #for baseImage in sortedBaseImages:
-        #    print baseImage.pathToVMI + "\t" + str(baseImage.getNumberOfPackages())
 
-        while len(sortedBaseImages) != 0:
-            candidateBaseImage = sortedBaseImages.pop(0)
+        for candidateBaseImage in sortedBaseImages:
             # chosen base image is the new one or the chosen one is compatible with the MSpackages from the new one
-            if candidateBaseImage == newBaseImage or compatibilities[candidateBaseImage][newBaseImage] == True:
-                replacingList = list()
-                for baseImageToReplace in allBaseImagesAndMSPkgs.keys():
-                    if candidateBaseImage != baseImageToReplace and compatibilities[candidateBaseImage][baseImageToReplace] == True:
-                        replacingList.append(baseImageToReplace)
+            if candidateBaseImage == newBaseImage or compatibilities[candidateBaseImage] & newBaseImageBit:
+                replacingList = [baseImageToReplace
+                                 for baseImageToReplace in index.getBaseImagesInMask(compatibilities[candidateBaseImage])
+                                 if baseImageToReplace != candidateBaseImage]
                 return (candidateBaseImage,replacingList)
 
-        # Worst case, no replacing possible, should be handled in while above
+        # Worst case, no replacing possible, should be handled in loop above
         return (newBaseImage,list())
 
     @staticmethod
     def compareWithMasterGraphs(vmi, evalDecomp=None):
+        """
+            Computes the similarity of vmi to the candidate master graphs found by the MinHash index.
+        """
         print "Comparison to mastergraphs:"
         if evalDecomp is not None:
             startTime = time.time()
             simAndMasterList = list()
             with RepositoryDatabase() as repoManager:
-                masterDescriptors = repoManager.getVMIMasterDescriptors()
+                masterDescriptors = repoManager.getCandidateMasterDescriptors(vmi)
                 for master in masterDescriptors:
                     similarity = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi, master,
                                                                                                      onlyOnMainServices=True,
@@ -362,7 +667,7 @@ class Decomposer:
 
         else:
             with RepositoryDatabase() as repoManager:
-                masterDescriptors = repoManager.getVMIMasterDescriptors()
+                masterDescriptors = repoManager.getCandidateMasterDescriptors(vmi)
                 for master in masterDescriptors:
                     similarity = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi, master,
                                                                                                      onlyOnMainServices=True,
@@ -1,5 +1,5 @@
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import sys
 
@@ -45,11 +45,13 @@ class DecompositionEvaluation(Evaluation):
                           "reqPkgsNum;expPkgsNum;"
                           "reqPkgsSize[bytes];expPkgsSize[bytes];"
                           "baseImageInfo;"
-                          "highest similarity;base with highest similarity;numPkgs in master;comparisons;time to calc sim")
+                          "highest similarity;base with highest similarity;numPkgs in master;comparisons;time to calc sim;"
+                          "pkgDedupRatio")
         self.vmiFilename = None
         self.vmiMainServices = None
         self.sumRepoStorageSize = None
         self.dbSize = None
+        self.pkgDedupRatio = None
         self.timeDecompAll = None
         self.timeHandlerCreation = None
         self.timeExport = None
@@ -74,6 +76,7 @@ class DecompositionEvaluation(Evaluation):
         self.vmiMainServices = None
         self.sumRepoStorageSize = None
         self.dbSize = None
+        self.pkgDedupRatio = None
         self.timeDecompAll = None
         self.timeHandlerCreation = None
         self.timeExport = None
@@ -90,6 +93,17 @@ class DecompositionEvaluation(Evaluation):
     def addVmiOrigSize(self, vmiOrigSize):
         self.sumOrigStorageSize = self.sumOrigStorageSize + vmiOrigSize
 
+    def setGuestInfo(self, guestEvalDecomp):
+        """
+            Takes over the results of the guest phase of a decomposition that ran in a worker process.
+        :param DecompositionEvaluation guestEvalDecomp:
+        """
+        self.timeExport = guestEvalDecomp.timeExport
+        self.reqPkgsNum = guestEvalDecomp.reqPkgsNum
+        self.expPkgsNum = guestEvalDecomp.expPkgsNum
+        self.reqPkgsSize = guestEvalDecomp.reqPkgsSize
+        self.expPkgsSize = guestEvalDecomp.expPkgsSize
+
     def setSimilarity(self, simAndMasterList):
         self.comparisons = len(simAndMasterList)
         for (similarity,master) in simAndMasterList:
@@ -116,7 +130,8 @@ class DecompositionEvaluation(Evaluation):
                           str(self.masterPathToImage) + ";" +
                           str(self.masterNumPkgs) + ";" +
                           str(self.comparisons) + ";" +
-                          str(self.timeSimToMasterCalc))
+                          str(self.timeSimToMasterCalc) + ";" +
+                          str(self.pkgDedupRatio))
         self.resetAttributes()
 
 class ReassemblingEvaluation(Evaluation):
@@ -128,7 +143,7 @@ class ReassemblingEvaluation(Evaluation):
                           "reassembling time [s];copy time [s];reset time [s];import time [s];handler creation time [s];"
                           "number of required packages;number of imported packages;"
                           "required PkgsSize[bytes];imported PkgsSize[bytes];"
-                          "reassembling info")
+                          "reassembling info;relabel time [s];reassembly mode;flatten time [s]")
         self.vmiFilename = None
         self.vmiMainServices = None
         self.vmiSize = None
@@ -138,12 +153,16 @@ class ReassemblingEvaluation(Evaluation):
         self.copyTime = None
         self.resetTime = None
         self.importTime = None
+        self.relabelTime = None
         self.handlerCreationTime = None
         self.reqPkgsNum = None
         self.expPkgsNum = None
         self.reqPkgsSize = None
         self.impPkgsSize = None
         self.info = None
+        # "copy", "overlay" or "flattened overlay", copy time and vmi size refer to the image created in this mode
+        self.reassemblyMode = None
+        self.flattenTime = None
 
     def resetAttributes(self):
         self.vmiFilename = None
@@ -155,18 +174,31 @@ class ReassemblingEvaluation(Evaluation):
         self.copyTime = None
         self.resetTime = None
         self.importTime = None
+        self.relabelTime = None
         self.handlerCreationTime = None
         self.reqPkgsNum = None
         self.expPkgsNum = None
         self.reqPkgsSize = None
         self.impPkgsSize = None
         self.info = None
+        self.reassemblyMode = None
+        self.flattenTime = None
+
+    def setReassemblyInfo(self, workerEvalReassembly):
+        """
+            Takes over the results of a reassembly that ran in a worker process.
+        :param ReassemblingEvaluation workerEvalReassembly:
+        """
+        for attribute in ["vmiFilename", "vmiMainServices", "pathToBase", "baseImageSize", "copyTime", "resetTime",
+                          "importTime", "relabelTime", "handlerCreationTime", "reqPkgsNum", "impPkgsNum",
+                          "reqPkgsSize", "impPkgsSize", "info", "reassemblyMode", "flattenTime"]:
+            setattr(self, attribute, getattr(workerEvalReassembly, attribute, None))
 
     def newLine(self):
-        self.lines.append(self.vmiFilename + ";" +
-                          self.pathToBase + ";" +
+        self.lines.append(str(self.vmiFilename) + ";" +
+                          str(self.pathToBase) + ";" +
                           str(self.baseImageSize) + ";" +
-                          ",".join(self.vmiMainServices) + ";" +
+                          ",".join(self.vmiMainServices or []) + ";" +
                           str(self.vmiSize) + ";" +
                           str(self.reassemblingTime) + ";" +
                           str(self.copyTime) + ";" +
@@ -177,18 +209,129 @@ class ReassemblingEvaluation(Evaluation):
                           str(self.impPkgsNum) + ";" +
                           str(self.reqPkgsSize) + ";" +
                           str(self.impPkgsSize) + ";" +
-                          str(self.info))
+                          str(self.info) + ";" +
+                          str(self.relabelTime) + ";" +
+                          str(self.reassemblyMode) + ";" +
+                          str(self.flattenTime))
         self.resetAttributes()
 
+class GraphRepresentationEvaluation(Evaluation):
+    def __init__(self, evaluationLogPath):
+        super(GraphRepresentationEvaluation, self).__init__(evaluationLogPath)
+        # First line in output
+        self.lines.append("graphFilename;numPkgs;numDeps;"
+                          "memory networkx [bytes];memory PackageGraph [bytes];"
+                          "pickle size networkx [bytes];pickle size PackageGraph [bytes];"
+                          "load time networkx [s];load time PackageGraph [s];"
+                          "closure time networkx [s];closure time PackageGraph [s]")
+        self.graphFilename = None
+        self.numPkgs = None
+        self.numDeps = None
+        self.memoryNX = None
+        self.memoryPG = None
+        self.pickleSizeNX = None
+        self.pickleSizePG = None
+        self.loadTimeNX = None
+        self.loadTimePG = None
+        self.closureTimeNX = None
+        self.closureTimePG = None
 
+    def resetAttributes(self):
+        self.graphFilename = None
+        self.numPkgs = None
+        self.numDeps = None
+        self.memoryNX = None
+        self.memoryPG = None
+        self.pickleSizeNX = None
+        self.pickleSizePG = None
+        self.loadTimeNX = None
+        self.loadTimePG = None
+        self.closureTimeNX = None
+        self.closureTimePG = None
 
+    def newLine(self):
+        self.lines.append(self.graphFilename + ";" +
+                          str(self.numPkgs) + ";" +
+                          str(self.numDeps) + ";" +
+                          str(self.memoryNX) + ";" +
+                          str(self.memoryPG) + ";" +
+                          str(self.pickleSizeNX) + ";" +
+                          str(self.pickleSizePG) + ";" +
+                          str(self.loadTimeNX) + ";" +
+                          str(self.loadTimePG) + ";" +
+                          str(self.closureTimeNX) + ";" +
+                          str(self.closureTimePG))
+        self.resetAttributes()
 
+    @staticmethod
+    def getDeepSize(obj, seen=None):
+        """
+            Approximates the memory used by obj and all objects reachable from it.
+        :param obj:
+        :param set() seen: ids of objects already counted
+        :return: size in bytes
+        """
+        if seen is None:
+            seen = set()
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            size = size + sum(GraphRepresentationEvaluation.getDeepSize(key, seen) +
+                              GraphRepresentationEvaluation.getDeepSize(value, seen)
+                              for (key, value) in obj.iteritems())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            size = size + sum(GraphRepresentationEvaluation.getDeepSize(item, seen) for item in obj)
+        elif hasattr(obj, "__dict__"):
+            size = size + GraphRepresentationEvaluation.getDeepSize(obj.__dict__, seen)
+        return size
+
+
+class GraphFileEvaluation(Evaluation):
+    def __init__(self, evaluationLogPath):
+        super(GraphFileEvaluation, self).__init__(evaluationLogPath)
+        # First line in output
+        self.lines.append("graphFilename;numPkgs;numDeps;"
+                          "file size pickle [bytes];file size graph file [bytes];"
+                          "save time pickle [s];save time graph file [s];"
+                          "load time pickle [s];load time graph file [s];"
+                          "open time mapped graph file [s];closure time mapped graph file [s]")
+        self.graphFilename = None
+        self.numPkgs = None
+        self.numDeps = None
+        self.fileSizePickle = None
+        self.fileSizeGraphFile = None
+        self.saveTimePickle = None
+        self.saveTimeGraphFile = None
+        self.loadTimePickle = None
+        self.loadTimeGraphFile = None
+        self.openTimeMapped = None
+        self.closureTimeMapped = None
 
+    def resetAttributes(self):
+        self.graphFilename = None
+        self.numPkgs = None
+        self.numDeps = None
+        self.fileSizePickle = None
+        self.fileSizeGraphFile = None
+        self.saveTimePickle = None
+        self.saveTimeGraphFile = None
+        self.loadTimePickle = None
+        self.loadTimeGraphFile = None
+        self.openTimeMapped = None
+        self.closureTimeMapped = None
 
-
-
-
-
-
-
-
+    def newLine(self):
+        self.lines.append(self.graphFilename + ";" +
+                          str(self.numPkgs) + ";" +
+                          str(self.numDeps) + ";" +
+                          str(self.fileSizePickle) + ";" +
+                          str(self.fileSizeGraphFile) + ";" +
+                          str(self.saveTimePickle) + ";" +
+                          str(self.saveTimeGraphFile) + ";" +
+                          str(self.loadTimePickle) + ";" +
+                          str(self.loadTimeGraphFile) + ";" +
+                          str(self.openTimeMapped) + ";" +
+                          str(self.closureTimeMapped))
+        self.resetAttributes()
@@ -3,8 +3,11 @@ import sys
 import time
 
 import shutil
+import tempfile
 from threading import Thread
 
+import networkx as nx
+
 from Decomposer import Decomposer
 from GuestFSHelper import GuestFSHelper
 from VMISimilarity import SimilarityCalculator
@@ -13,7 +16,10 @@ from RepositoryDatabase import RepositoryDatabase
 from StaticInfo import StaticInfo
 from VMIDescription import VMIDescriptor
 from Evaluation import SimilarityToAllEvaluation, DecompositionEvaluation, \
-    ReassemblingEvaluation
+    ReassemblingEvaluation, GraphRepresentationEvaluation, GraphFileEvaluation
+from GraphFile import GraphFile
+from PackageStore import PackageStore
+from PackageGraph import PackageGraph
 
 
 class Expelliarmus:
@@ -36,14 +42,32 @@ class Expelliarmus:
         if not os.path.isdir(StaticInfo.relPathLocalVMIFolder):
             os.mkdir(StaticInfo.relPathLocalVMIFolder)
 
-    def printVMIs(self):
+    def getListingWindow(self, page):
+        """
+        :param page: page number starting with 1, None for all rows
+        :return: tuple (limit, offset) for listing queries
+        """
+        if page is None:
+            return (None, 0)
+        return (StaticInfo.cliListPageSize, (page - 1) * StaticInfo.cliListPageSize)
+
+    def printListingFooter(self, itemName, numPrinted, offset, numOverall, page):
+        if page is None:
+            print "Overall %s in repository: %i\n" % (itemName, numOverall)
+        elif numPrinted == 0:
+            print "Page %i: no %s, overall %s in repository: %i\n" % (page, itemName, itemName, numOverall)
+        else:
+            print "Page %i: %s %i-%i of %i\n" % (page, itemName, offset + 1, offset + numPrinted, numOverall)
+
+    def printVMIs(self, page=None):
+        (limit, offset) = self.getListingWindow(page)
         with RepositoryDatabase() as repoManager:
             print "\nVMIs in repository:\n"
             print "{:22s} {:10s} {:10s} {:10s} {:11s} {:13s}".format("Name", "Distro", "Version", "Arch", "PkgManager",
                                                                      "Main-Services")
             print "-----------------------------------------------------------------------------------------------------------"
-            vmiDataList = sorted(repoManager.getDataForAllVMIs(), key=lambda vmiData: vmiData[0].lower())
-            for vmiData in vmiDataList:
+            numPrinted = 0
+            for vmiData in repoManager.iterateVMIListing(limit, offset):
                 name = (vmiData[0][:19] + '..') if len(vmiData[0]) > 21 else vmiData[0]
                 distribution = (vmiData[1][:7] + '..') if len(vmiData[1]) > 9 else vmiData[1]
                 distVersion = (vmiData[2][:7] + '..') if len(vmiData[2]) > 9 else vmiData[2]
@@ -52,38 +76,43 @@ class Expelliarmus:
                 mainServices = vmiData[7]
                 print "{:22s} {:10s} {:10s} {:10s} {:11s} {:s}".format(name, distribution, distVersion, arch,
                                                                        pkgManager, mainServices)
+                numPrinted = numPrinted + 1
             print "-----------------------------------------------------------------------------------------------------------"
-            print "Overall VMIs in repository: " + str(len(vmiDataList)) + "\n"
+            self.printListingFooter("VMIs", numPrinted, offset, repoManager.getRepositorySummary()[0], page)
 
-    def printPackages(self):
+    def printPackages(self, page=None):
+        (limit, offset) = self.getListingWindow(page)
         with RepositoryDatabase() as repoManager:
             print "\nPackages in repository:\n"
             print "{:30s} {:20s} {:10s} {:10s}".format("Name", "Version", "Arch", "Distribution")
             print "---------------------------------------------------------------------------"
-            packageDataList = sorted(repoManager.getAllPackages(), key=lambda pkgData: (pkgData[3], pkgData[0].lower()))
-            for packageData in packageDataList:
+            numPrinted = 0
+            for packageData in repoManager.iteratePackageListing(limit, offset):
                 name = (packageData[0][:27] + '..') if len(packageData[0]) > 29 else packageData[0]
                 version = (packageData[1][:17] + '..') if len(packageData[1]) > 19 else packageData[1]
                 arch = (packageData[2][:7] + '..') if len(packageData[2]) > 9 else packageData[2]
                 distro = (packageData[3][:7] + '..') if len(packageData[3]) > 9 else packageData[3]
                 print "{:30s} {:20s} {:10s} {:10s}".format(name, version, arch, distro)
+                numPrinted = numPrinted + 1
             print "---------------------------------------------------------------------------"
-            print "Overall Packages in repository: " + str(len(packageDataList)) + "\n"
+            self.printListingFooter("Packages", numPrinted, offset, repoManager.getRepositorySummary()[2], page)
 
-    def printBaseImages(self):
+    def printBaseImages(self, page=None):
+        (limit, offset) = self.getListingWindow(page)
         with RepositoryDatabase() as repoManager:
             print "\nBase images in repository:\n"
             print "{:12s} {:10s} {:10s} {:10s}".format("Distribution", "Version", "Arch", "PkgManager")
             print "---------------------------------------------"
-            baseDataList = sorted(repoManager.getAllBaseImages(), key=lambda baseData: baseData[0].lower())
-            for baseData in baseDataList:
+            numPrinted = 0
+            for baseData in repoManager.iterateBaseImageListing(limit, offset):
                 distro = (baseData[0][:9] + '..') if len(baseData[0]) > 11 else baseData[0]
                 version = (baseData[1][:7] + '..') if len(baseData[1]) > 9 else baseData[1]
                 arch = (baseData[2][:7] + '..') if len(baseData[2]) > 9 else baseData[2]
                 pkgManager = (baseData[3][:7] + '..') if len(baseData[3]) > 9 else baseData[3]
                 print "{:12s} {:10s} {:10s} {:10s}".format(distro, version, arch, pkgManager)
+                numPrinted = numPrinted + 1
             print "---------------------------------------------"
-            print "Overall base images in repository: " + str(len(baseDataList)) + "\n"
+            self.printListingFooter("base images", numPrinted, offset, repoManager.getRepositorySummary()[1], page)
 
     def inspectVMIsInFolder(self, pathToDir):
         if not os.path.isdir(pathToDir):
@@ -121,15 +150,22 @@ class Expelliarmus:
             vmiPathsToInspect = vmiPaths
 
         if len(vmiPathsToInspect) > 0:
+            # package graphs of all VMIs are created in batch before the user is asked for main services
+            print "Creating VMIDescriptors for %i VMIs" % len(vmiPathsToInspect)
+            vmiDescriptors = SimilarityCalculator.createVMIDescriptors(
+                list((pathToVMI, "test", []) for pathToVMI in vmiPathsToInspect), skipFailed=True)
             count = 1
-            for pathToVMI in vmiPathsToInspect:
+            for (pathToVMI, vmi) in zip(vmiPathsToInspect, vmiDescriptors):
                 print "VMI %i/%i" % (count,len(vmiPathsToInspect))
-                self.inspectVMI(pathToVMI,replaceMetaFiles=replaceMetaFiles)
+                if vmi is None:
+                    print "\tVMI \"%s\" could not be inspected and is skipped." % pathToVMI
+                else:
+                    self.inspectVMI(pathToVMI,replaceMetaFiles=replaceMetaFiles, vmi=vmi)
                 count = count +1
         else:
             print "No VMIs to inspect."
 
-    def inspectVMI(self, pathToVMI, replaceMetaFiles=None):
+    def inspectVMI(self, pathToVMI, replaceMetaFiles=None, vmi=None):
         extension = pathToVMI.split(".")[-1]
         pathToMeta = pathToVMI.rsplit(".", 1)[0] + ".meta"
 
@@ -153,21 +189,22 @@ class Expelliarmus:
                     print "\tInput not recognized, Meta file will not be replaced."
                 else:
                     print "\tExisting meta file will be replaced"
-                    self.createMetaFileForVMI(pathToVMI, pathToMeta)
+                    self.createMetaFileForVMI(pathToVMI, pathToMeta, vmi=vmi)
             elif replaceMetaFiles == True:
                 print "\tExisting meta file will be replaced"
-                self.createMetaFileForVMI(pathToVMI, pathToMeta)
+                self.createMetaFileForVMI(pathToVMI, pathToMeta, vmi=vmi)
             else:
                 print "\tMeta file already exists for VMI."
         else:
-            self.createMetaFileForVMI(pathToVMI,pathToMeta)
-
-    def createMetaFileForVMI(self, pathToVMI, pathToMetafile):
-        print "\tCreating Handler for \"%s\"" % pathToVMI
-        guest, root = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
-        print "\tCreating VMIDescriptor"
-        vmi = VMIDescriptor(pathToVMI, "test", [], guest, root)
-        GuestFSHelper.shutdownHandle(guest)
+            self.createMetaFileForVMI(pathToVMI,pathToMeta, vmi=vmi)
+
+    def createMetaFileForVMI(self, pathToVMI, pathToMetafile, vmi=None):
+        if vmi is None:
+            print "\tCreating Handler for \"%s\"" % pathToVMI
+            guest, root = GuestFSHelper.getHandle(pathToVMI, rootRequired=True, readOnly=True)
+            print "\tCreating VMIDescriptor"
+            vmi = VMIDescriptor(pathToVMI, "test", [], guest, root)
+            GuestFSHelper.shutdownHandle(guest)
         correctMS = False
         while not correctMS:
             userInputMS = raw_input("\tEnter Main Services in format \"MS1,MS2,...\"\n\t")
@@ -200,7 +237,11 @@ class Expelliarmus:
                            ",".join(vmi.mainServices))
         print "\tFinished Inspection of VMI \"%s\". Meta file written to \"%s\"" % (pathToVMI, pathToMetafile)
 
-    def decomposeVMIsInFolder(self, pathToDir):
+    def decomposeVMIsInFolder(self, pathToDir, numWorkers=None):
+        """
+        :param pathToDir:
+        :param numWorkers: number of VMIs processed in parallel, default is StaticInfo.decompositionWorkers
+        """
         if not os.path.isdir(pathToDir):
             print "Error while decomposing VMIs. \"%s\" is not a directory." % pathToDir
             return
@@ -234,40 +275,59 @@ class Expelliarmus:
         else:
             vmiPathsToDecompose = vmiPaths
 
-        if len(vmiPathsToDecompose) > 0:
+        vmiDataList = list()
+        for pathToVMI in vmiPathsToDecompose:
+            vmiData = self.getDecompositionData(pathToVMI)
+            if vmiData is not None:
+                vmiDataList.append(vmiData)
+
+        if len(vmiDataList) > 0:
             count = 1
-            for pathToVMI in vmiPathsToDecompose:
-                print "VMI %i/%i" % (count,len(vmiPathsToDecompose))
-                self.decomposeVMI(pathToVMI)
+            for guestDecomposition in Decomposer.decomposeBatch(vmiDataList, numWorkers=numWorkers):
+                print "VMI %i/%i done" % (count,len(vmiDataList))
+                if guestDecomposition.error is None:
+                    os.remove(guestDecomposition.vmi.pathToVMI.rsplit(".", 1)[0] + ".meta")
                 count = count +1
         else:
             pass
 
     def decomposeVMI(self, pathToVMI):
+        vmiData = self.getDecompositionData(pathToVMI)
+        if vmiData is None:
+            return
+        (pathToVMI, vmiFileName, mainServices) = vmiData
+
+        # decompose and clean up
+        Decomposer.decompose(pathToVMI, vmiFileName, mainServices)
+        os.remove(pathToVMI.rsplit(".", 1)[0] + ".meta")
+
+    def getDecompositionData(self, pathToVMI):
+        """
+            Checks that pathToVMI can be decomposed and reads its main services from the meta file.
+        :param pathToVMI:
+        :return: tuple (pathToVMI, vmiFileName, mainServices), None if the VMI cannot be decomposed
+        """
         vmiFileName = pathToVMI.split("/")[-1]
         extension = pathToVMI.split(".")[-1]
         pathToMeta = pathToVMI.rsplit(".", 1)[0] + ".meta"
         # check if VMI exists
         if not os.path.isfile(pathToVMI):
             print "\tError while decomposing VMI. File \"%s\" does not exist." % pathToVMI
-            return
+            return None
         # check if valid format
         if not extension in StaticInfo.validVMIFormats:
             print "\tError while decomposing VMI. File extension \"%s\" is not supported." % extension
             print "\tSupported extensions: " + ",".join(StaticInfo.validVMIFormats)
-            return
+            return None
         # check if meta file exists
         if not os.path.isfile(pathToMeta):
             print "\tError while decomposing VMI. Meta File \"%s\" does not exist." % pathToMeta
-            return
+            return None
 
         # obtain main services from meta data file
         vmiMetaData = open(pathToMeta).read().split("\n")[0].split(";")
         mainServices = vmiMetaData[2].split(",")
-
-        # decompose and clean up
-        Decomposer.decompose(pathToVMI, vmiFileName, mainServices)
-        os.remove(pathToMeta)
+        return (pathToVMI, vmiFileName, mainServices)
 
     def reassembleAllVMIs(self):
         vmisInFolder = self.getVmiPaths(StaticInfo.relPathLocalVMIFolder)
@@ -294,14 +354,21 @@ class Expelliarmus:
         numVMIs = len(vmiNames)
         vmiPaths = []
         if numVMIs > 0:
-            print "Reassembling %i VMIs\n"
+            print "Reassembling %i VMIs\n" % numVMIs
             count = 1
-            for vmiName in vmiNames:
+            for result in Reassembler.reassembleBatch(vmiNames):
                 print "VMI %i/%i" % (count, numVMIs)
-                vmiPaths.append(self.reassembleVMI(vmiName))
+                if result.error is None:
+                    vmiPaths.append(result.pathToVMI)
                 count = count + 1
-            print "\nVMIs reassembled: %i" % numVMIs
-            print "Reassembled VMIs stored at:%s" % "\n\t".join(vmiPaths)
+            Reassembler.waitForFlatten()
+            # replaced base images that were only kept for overlays removed above
+            with RepositoryDatabase() as repoManager:
+                repoManager.removeUnusedBaseImageFiles()
+            print "\nVMIs reassembled: %i" % len(vmiPaths)
+            if len(vmiPaths) < numVMIs:
+                print "VMIs failed: %i" % (numVMIs - len(vmiPaths))
+            print "Reassembled VMIs stored at:\n\t%s" % "\n\t".join(vmiPaths)
         else:
             print "No VMIs to reassemble"
 
@@ -354,36 +421,48 @@ class Expelliarmus:
             self.evaluateDecompositionOnce(StaticInfo.relPathLocalVMIFolder, evalLogFileName, resetBeforeEachDecomposition)
         print "\n\nEvaluation completed, results saved in \"%s\"." % StaticInfo.relPathLocalEvaluation
 
-    def evaluateDecompositionOnce(self, pathToDir, evalLogFileName, resetBeforeEachDecomposition):
+    def evaluateDecompositionOnce(self, pathToDir, evalLogFileName, resetBeforeEachDecomposition, numWorkers=None):
+        """
+        :param numWorkers: number of VMIs processed in parallel, default is StaticInfo.decompositionWorkers.
+                           VMIs are processed one after another if the repository is reset before each decomposition.
+        """
         evalDecomp = DecompositionEvaluation(evalLogFileName)
 
         sortedVmiData = self.getSortedVmiData(pathToDir)
+        if resetBeforeEachDecomposition:
+            numWorkers = 1
+            self.resetRepo()
+        # sizes are taken before decomposition, VMIs of a parallel batch are manipulated ahead of their evaluation
+        origSizes = [os.path.getsize(pathToVMI) for (pathToVMI, vmiFileName, mainServices) in sortedVmiData]
         i = 0
-        for (pathToVMI, vmiFileName, mainServices) in sortedVmiData:
-            if resetBeforeEachDecomposition:
-                self.resetRepo()
+        # with one worker, the guest phase of a VMI starts after the previous VMI has been evaluated
+        for guestDecomposition in Decomposer.decomposeBatch(sortedVmiData, numWorkers=numWorkers, evalDecomp=evalDecomp):
+            (pathToVMI, vmiFileName, mainServices) = sortedVmiData[i]
             i = i + 1
             print ""
             print "        VMI %i/%i" % (i, len(sortedVmiData))
             print "============================="
+            if guestDecomposition.error is not None:
+                evalDecomp.resetAttributes()
+                continue
             evalDecomp.vmiFilename = vmiFileName
             evalDecomp.vmiMainServices = mainServices
-            evalDecomp.addVmiOrigSize(os.path.getsize(pathToVMI))
-
-            startTime = time.time()
-            Decomposer.decompose(pathToVMI, vmiFileName, mainServices, evalDecomp=evalDecomp)
-            decompTime = time.time() - startTime
+            evalDecomp.addVmiOrigSize(origSizes[i - 1])
 
             repoStorageSize = self.getDirSize(StaticInfo.relPathLocalRepository)
 
             evalDecomp.sumRepoStorageSize = repoStorageSize
-            evalDecomp.dbSize = os.path.getsize(StaticInfo.relPathLocalRepositoryDatabase)
-            evalDecomp.timeDecompAll = decompTime
+            evalDecomp.dbSize = RepositoryDatabase.getDatabaseSize()
+            evalDecomp.pkgDedupRatio = PackageStore.getDedupRatio()
+            evalDecomp.timeDecompAll = guestDecomposition.timeGuest + guestDecomposition.timeCommit
             evalDecomp.newLine()
 
             # remove meta data file
             pathToMetaData = pathToVMI.rsplit(".", 1)[0] + ".meta"
             os.remove(pathToMetaData)
+
+            if resetBeforeEachDecomposition and i < len(sortedVmiData):
+                self.resetRepo()
         evalDecomp.saveEvaluation()
 
     def evaluateReassembly(self, repetitions):
@@ -397,7 +476,10 @@ class Expelliarmus:
             os.mkdir(StaticInfo.relPathLocalVMIFolder)
             self.evaluateReassemblyOnce(StaticInfo.relPathLocalEvaluation + "/reassembly_" + str(i) + ".csv")
 
-    def evaluateReassemblyOnce(self, evalLogFileName):
+    def evaluateReassemblyOnce(self, evalLogFileName, numWorkers=None):
+        """
+        :param numWorkers: number of VMIs reassembled in parallel, default is StaticInfo.reassemblyWorkers
+        """
         evalReassembly = ReassemblingEvaluation(evalLogFileName)
         with RepositoryDatabase() as repoManager:
             vmiNameList = repoManager.getAllVmiNames()
@@ -405,24 +487,151 @@ class Expelliarmus:
         # filter out snapshots
         # vmiNameList = [x for x in vmiNameList if "Snapshot" not in x]
 
+        shutil.rmtree(StaticInfo.relPathLocalVMIFolder)
+        os.mkdir(StaticInfo.relPathLocalVMIFolder)
+
         i = 0
-        for vmiName in vmiNameList:
+        for result in Reassembler.reassembleBatch(vmiNameList, numWorkers=numWorkers, evaluate=True):
             i = i + 1
             print ""
             print "        VMI %i/%i" % (i, len(vmiNameList))
             print "============================="
-            shutil.rmtree(StaticInfo.relPathLocalVMIFolder)
-            os.mkdir(StaticInfo.relPathLocalVMIFolder)
-            startTime = time.time()
-            pathToNewVMI = Reassembler.reassemble(vmiName, evalReassembly=evalReassembly)
-            reassemblingTime = time.time() - startTime
-
-            evalReassembly.reassemblingTime = reassemblingTime
-            evalReassembly.vmiSize = os.path.getsize(pathToNewVMI)
+            evalReassembly.setReassemblyInfo(result.evalReassembly)
+            evalReassembly.reassemblingTime = result.reassemblingTime
+            if result.error is not None:
+                # failed VMIs are part of the results as well
+                if evalReassembly.vmiFilename is None:
+                    evalReassembly.vmiFilename = result.vmiName
+                evalReassembly.info = "reassembly failed: " + " ".join(result.error.replace(";", ",").split())
+                evalReassembly.newLine()
+                continue
+            # size of the image in its reassembly mode, flattened overlays are measured after flattening
+            evalReassembly.vmiSize = os.path.getsize(result.pathToVMI)
             evalReassembly.newLine()
+            # reassembled VMIs are only measured, not kept
+            os.remove(result.pathToVMI)
         evalReassembly.saveEvaluation()
+        with RepositoryDatabase() as repoManager:
+            repoManager.removeUnusedBaseImageFiles()
+
 
 
+    def evaluateGraphRepresentation(self, repetitions):
+        """
+            Compares PackageGraph with networkx.MultiDiGraph for all master graphs in the local repository:
+            memory usage, size of the pickled graph, load time and time to compute the closure of all main services.
+            Load and closure times are averaged over the number of repetitions.
+        :param repetitions:
+        """
+        evalGraphs = GraphRepresentationEvaluation(StaticInfo.relPathLocalEvaluation + "/graphRepresentation.csv")
+        with RepositoryDatabase() as repoManager:
+            masterDescriptors = repoManager.getVMIMasterDescriptors()
+
+        pathToTempFolder = tempfile.mkdtemp(prefix="expelliarmus_graphs_")
+        try:
+            for master in masterDescriptors:
+                print "Evaluating graph \"%s\"" % master.graphFileName
+                packageGraph = master.graph
+                nxGraph = packageGraph.toNetworkX()
+                mainServices = list(master.mainServices)
+
+                pathToPickleNX = os.path.join(pathToTempFolder, "networkx.pkl")
+                pathToPicklePG = os.path.join(pathToTempFolder, "packagegraph.pkl")
+                nx.write_gpickle(nxGraph, pathToPickleNX)
+                packageGraph.writePickle(pathToPicklePG)
+
+                startTime = time.time()
+                for i in range(repetitions):
+                    nx.read_gpickle(pathToPickleNX)
+                evalGraphs.loadTimeNX = (time.time() - startTime) / repetitions
+                startTime = time.time()
+                for i in range(repetitions):
+                    PackageGraph.readPickle(pathToPicklePG)
+                evalGraphs.loadTimePG = (time.time() - startTime) / repetitions
+
+                startTime = time.time()
+                for i in range(repetitions):
+                    nodeList = list()
+                    for name in mainServices:
+                        nodeList = nodeList + list(nx.bfs_tree(nxGraph, name))
+                    nx.MultiDiGraph(nxGraph.subgraph(nodeList))
+                evalGraphs.closureTimeNX = (time.time() - startTime) / repetitions
+                startTime = time.time()
+                for i in range(repetitions):
+                    packageGraph.subgraph(packageGraph.bfsNodes(mainServices))
+                evalGraphs.closureTimePG = (time.time() - startTime) / repetitions
+
+                evalGraphs.graphFilename = master.graphFileName
+                evalGraphs.numPkgs = packageGraph.number_of_nodes()
+                evalGraphs.numDeps = packageGraph.number_of_edges()
+                evalGraphs.memoryNX = GraphRepresentationEvaluation.getDeepSize(nxGraph)
+                evalGraphs.memoryPG = GraphRepresentationEvaluation.getDeepSize(packageGraph)
+                evalGraphs.pickleSizeNX = os.path.getsize(pathToPickleNX)
+                evalGraphs.pickleSizePG = os.path.getsize(pathToPicklePG)
+                evalGraphs.newLine()
+        finally:
+            shutil.rmtree(pathToTempFolder, ignore_errors=True)
+        evalGraphs.saveEvaluation()
+        print "\n\nEvaluation completed, results saved in \"%s\"." % StaticInfo.relPathLocalEvaluation
+
+    def evaluateGraphFiles(self, repetitions):
+        """
+            Compares the graph file format with pickled PackageGraphs for all master graphs in the local repository:
+            file size, save and load time, and the time to open a memory-mapped graph file and compute the closure of
+            all main services on it. Times are averaged over the number of repetitions.
+        :param repetitions:
+        """
+        evalGraphFiles = GraphFileEvaluation(StaticInfo.relPathLocalEvaluation + "/graphFiles.csv")
+        with RepositoryDatabase() as repoManager:
+            masterDescriptors = repoManager.getVMIMasterDescriptors()
+
+        pathToTempFolder = tempfile.mkdtemp(prefix="expelliarmus_graphfiles_")
+        try:
+            for master in masterDescriptors:
+                print "Evaluating graph \"%s\"" % master.graphFileName
+                packageGraph = master.graph
+                mainServices = list(master.mainServices)
+                pathToPickle = os.path.join(pathToTempFolder, "packagegraph.pkl")
+                pathToGraphFile = os.path.join(pathToTempFolder, "packagegraph" + StaticInfo.graphFileExtension)
+
+                startTime = time.time()
+                for i in range(repetitions):
+                    packageGraph.writePickle(pathToPickle)
+                evalGraphFiles.saveTimePickle = (time.time() - startTime) / repetitions
+                startTime = time.time()
+                for i in range(repetitions):
+                    GraphFile.write(packageGraph, pathToGraphFile)
+                evalGraphFiles.saveTimeGraphFile = (time.time() - startTime) / repetitions
+
+                startTime = time.time()
+                for i in range(repetitions):
+                    PackageGraph.readPickle(pathToPickle)
+                evalGraphFiles.loadTimePickle = (time.time() - startTime) / repetitions
+                startTime = time.time()
+                for i in range(repetitions):
+                    GraphFile.read(pathToGraphFile)
+                evalGraphFiles.loadTimeGraphFile = (time.time() - startTime) / repetitions
+
+                startTime = time.time()
+                for i in range(repetitions):
+                    GraphFile.open(pathToGraphFile).close()
+                evalGraphFiles.openTimeMapped = (time.time() - startTime) / repetitions
+                with GraphFile.open(pathToGraphFile) as mappedGraph:
+                    startTime = time.time()
+                    for i in range(repetitions):
+                        mappedGraph.bfsNodes(mainServices)
+                    evalGraphFiles.closureTimeMapped = (time.time() - startTime) / repetitions
+
+                evalGraphFiles.graphFilename = master.graphFileName
+                evalGraphFiles.numPkgs = packageGraph.number_of_nodes()
+                evalGraphFiles.numDeps = packageGraph.number_of_edges()
+                evalGraphFiles.fileSizePickle = os.path.getsize(pathToPickle)
+                evalGraphFiles.fileSizeGraphFile = os.path.getsize(pathToGraphFile)
+                evalGraphFiles.newLine()
+        finally:
+            shutil.rmtree(pathToTempFolder, ignore_errors=True)
+        evalGraphFiles.saveEvaluation()
+        print "\n\nEvaluation completed, results saved in \"%s\"." % StaticInfo.relPathLocalEvaluation
 
     def verifySourceFolder(self, pathToDir):
         if not os.path.isdir(pathToDir):
@@ -467,6 +676,7 @@ class Expelliarmus:
         if verbose:
             print "Resetting Repository."
         # Remove old repository
+        RepositoryDatabase.closeSessions()
         if os.path.exists(StaticInfo.relPathLocalRepository):
             shutil.rmtree(StaticInfo.relPathLocalRepository)
         # Create Folder Structure
@@ -518,11 +728,15 @@ class Expelliarmus:
         return sortedVmiData
 
     def getDirSize(self, start_path):
+        # hard linked files (see PackageStore) occupy disk space once
         total_size = 0
+        seenInodes = set()
         for dirpath, dirnames, filenames in os.walk(start_path):
             for f in filenames:
-                fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
+                stat = os.stat(os.path.join(dirpath, f))
+                if (stat.st_dev, stat.st_ino) not in seenInodes:
+                    seenInodes.add((stat.st_dev, stat.st_ino))
+                    total_size += stat.st_size
         return total_size
 
 
@@ -557,7 +771,7 @@ class Expelliarmus:
                               self.getDirSize(StaticInfo.relPathLocalRepositoryPackages)
 
             evalDecomp.sumRepoStorageSize = repoStorageSize
-            evalDecomp.dbSize = os.path.getsize(StaticInfo.relPathLocalRepositoryDatabase)
+            evalDecomp.dbSize = RepositoryDatabase.getDatabaseSize()
             evalDecomp.timeDecompAll = decompTime
             evalDecomp.newLine()
             os.remove(vmiMetaDataPath)
@@ -615,7 +829,7 @@ class Expelliarmus:
                               self.getDirSize(StaticInfo.relPathLocalRepositoryPackages)
 
             evalDecomp.sumRepoStorageSize = repoStorageSize
-            evalDecomp.dbSize = os.path.getsize(StaticInfo.relPathLocalRepositoryDatabase)
+            evalDecomp.dbSize = RepositoryDatabase.getDatabaseSize()
             evalDecomp.timeDecompAll = decompTime
             evalDecomp.newLine()
             os.remove(vmiMetaDataPath)
@@ -653,6 +867,7 @@ class Expelliarmus:
             print "============================="
             print "        VMI %i/%i" % (i, len(vmiNameListNoSnapshots))
             print "============================="
+            Reassembler.waitForFlatten()
             shutil.rmtree(StaticInfo.relPathLocalVMIFolder)
             os.mkdir(StaticInfo.relPathLocalVMIFolder)
             startTime = time.time()
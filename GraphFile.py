@@ -0,0 +1,505 @@
+import fcntl
+import mmap
+import os
+import struct
+from array import array
+from collections import deque
+
+import numpy as np
+
+from PackageGraph import PackageGraph
+from StaticInfo import StaticInfo
+
+
+class GraphFile:
+    """
+        Versioned binary file format for PackageGraphs (all values little-endian).
+
+        header:     magic "EXPGRAPH", format version (uint32), reserved (uint32),
+                    number of packages, number of dependencies, number of strings (uint64 each)
+        sections:   table of (offset, length) (uint64 each) for every section in GraphFile.sections,
+                    followed by the sections, each aligned to 8 bytes
+
+        Names and attribute strings are stored as string tables (offsets + concatenated bytes), node attributes
+        column-wise and dependencies as CSR arrays, in the same layout as in PackageGraph. The section "nameOrder"
+        lists the package ids sorted by name, which allows lookups by name in a memory-mapped file (see MappedGraph).
+    """
+    magic = "EXPGRAPH"
+    formatVersion = 1
+    headerFormat = "<8sIIQQQ"
+    headerSize = struct.calcsize(headerFormat)
+    alignment = 8
+
+    # (section, numpy dtype or None for raw bytes), order is part of the format
+    sections = [
+        ("nameOffsets", "<i8"),
+        ("nameData", None),
+        ("nameOrder", "<i4"),
+        ("stringOffsets", "<i8"),
+        ("stringData", None),
+        ("versionIDs", "<i4"),
+        ("archIDs", "<i4"),
+        ("essentials", "<i1"),
+        ("installSizes", "<i8"),
+        ("pathIDs", "<i4"),
+        ("indptr", "<i4"),
+        ("targets", "<i4"),
+        ("constraints", "<i1"),
+        ("operatorIDs", "<i4"),
+        ("edgeVersionIDs", "<i4")
+    ]
+    sectionTableFormat = "<" + "QQ" * len(sections)
+    sectionTableSize = struct.calcsize(sectionTableFormat)
+
+    @staticmethod
+    def encodeStringTable(strings):
+        """
+        :param list() strings: encoded strings
+        :return: tuple (offsets, data), offsets[i] to offsets[i+1] is the position of strings[i] in data
+        """
+        offsets = np.zeros(len(strings) + 1, dtype="<i8")
+        np.cumsum([len(value) for value in strings], out=offsets[1:])
+        return (offsets, "".join(strings))
+
+    @staticmethod
+    def encodeStrings(strings):
+        return [value.encode("utf-8") if isinstance(value, unicode) else value for value in strings]
+
+    @staticmethod
+    def decodeStringTable(offsets, data):
+        offsets = offsets.tolist()
+        return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    @staticmethod
+    def toString(graph):
+        """
+        :param PackageGraph graph:
+        :return: str containing the graph in graph file format
+        """
+        graph.compact()
+        names = GraphFile.encodeStrings(graph.names)
+        (nameOffsets, nameData) = GraphFile.encodeStringTable(names)
+        (stringOffsets, stringData) = GraphFile.encodeStringTable(GraphFile.encodeStrings(graph.strings))
+        sectionData = {
+            "nameOffsets": nameOffsets.tostring(),
+            "nameData": nameData,
+            # sorted by the encoded names, the order MappedGraph compares names in
+            "nameOrder": np.array(sorted(range(len(names)), key=names.__getitem__), dtype="<i4").tostring(),
+            "stringOffsets": stringOffsets.tostring(),
+            "stringData": stringData
+        }
+        for (section, dtype) in GraphFile.sections:
+            if section not in sectionData:
+                sectionData[section] = np.asarray(getattr(graph, section), dtype=dtype).tostring()
+
+        offset = GraphFile.headerSize + GraphFile.sectionTableSize
+        sectionTable = list()
+        for (section, dtype) in GraphFile.sections:
+            offset = offset + (-offset % GraphFile.alignment)
+            sectionTable.extend((offset, len(sectionData[section])))
+            offset = offset + len(sectionData[section])
+
+        parts = [struct.pack(GraphFile.headerFormat, GraphFile.magic, GraphFile.formatVersion, 0,
+                             len(graph.names), len(graph.targets), len(graph.strings)),
+                 struct.pack(GraphFile.sectionTableFormat, *sectionTable)]
+        position = GraphFile.headerSize + GraphFile.sectionTableSize
+        for (i, (section, dtype)) in enumerate(GraphFile.sections):
+            # padding up to the aligned offset of the section
+            parts.append("\0" * (sectionTable[2 * i] - position))
+            parts.append(sectionData[section])
+            position = sectionTable[2 * i] + sectionTable[2 * i + 1]
+        return "".join(parts)
+
+    @staticmethod
+    def write(graph, graphFileName):
+        """
+            Writes graph to a temporary file that atomically replaces graphFileName, readers never see a partial file.
+        :param PackageGraph graph:
+        :param graphFileName:
+        """
+        buf = GraphFile.toString(graph)
+        tempFileName = graphFileName + ".tmp"
+        with open(tempFileName, "wb") as graphFile:
+            graphFile.write(buf)
+            graphFile.flush()
+            os.fsync(graphFile.fileno())
+        os.rename(tempFileName, graphFileName)
+
+    @staticmethod
+    def readHeader(buf):
+        """
+        :param buf: str or mmap containing the graph file
+        :return: tuple (numPkgs, numDeps, numStrings, sectionTable), sectionTable in the form of {section:(offset, length)}
+        """
+        if len(buf) < GraphFile.headerSize + GraphFile.sectionTableSize:
+            raise ValueError("Graph file is truncated")
+        (magic, formatVersion, _, numPkgs, numDeps, numStrings) = \
+            struct.unpack(GraphFile.headerFormat, buf[:GraphFile.headerSize])
+        if magic != GraphFile.magic:
+            raise ValueError("Not a graph file")
+        if formatVersion != GraphFile.formatVersion:
+            raise ValueError("Unsupported graph file version %i" % formatVersion)
+        values = struct.unpack(GraphFile.sectionTableFormat,
+                               buf[GraphFile.headerSize:GraphFile.headerSize + GraphFile.sectionTableSize])
+        sectionTable = dict((section, (values[2 * i], values[2 * i + 1]))
+                            for (i, (section, dtype)) in enumerate(GraphFile.sections))
+        return (numPkgs, numDeps, numStrings, sectionTable)
+
+    @staticmethod
+    def getSectionArray(buf, sectionTable, section, dtype):
+        (offset, length) = sectionTable[section]
+        return np.frombuffer(buf, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+
+    @staticmethod
+    def read(graphFileName):
+        """
+            Loads a graph file completely into a PackageGraph.
+        :param graphFileName:
+        :return: PackageGraph
+        """
+        with open(graphFileName, "rb") as graphFile:
+            return GraphFile.fromString(graphFile.read())
+
+    @staticmethod
+    def fromString(buf):
+        """
+        :param str buf: graph in graph file format
+        :return: PackageGraph
+        """
+        (numPkgs, numDeps, numStrings, sectionTable) = GraphFile.readHeader(buf)
+
+        def getBytes(section):
+            (offset, length) = sectionTable[section]
+            return buf[offset:offset + length]
+
+        graph = PackageGraph()
+        graph.names = GraphFile.decodeStringTable(GraphFile.getSectionArray(buf, sectionTable, "nameOffsets", "<i8"),
+                                                  getBytes("nameData"))
+        graph.nodeIDs = dict((name, pkgID) for (pkgID, name) in enumerate(graph.names))
+        graph.strings = GraphFile.decodeStringTable(GraphFile.getSectionArray(buf, sectionTable, "stringOffsets", "<i8"),
+                                                    getBytes("stringData"))
+        graph.stringIDs = dict((value, stringID) for (stringID, value) in enumerate(graph.strings))
+        for column in PackageGraph.arrayColumns:
+            dtype = dict(GraphFile.sections)[column]
+            values = array(getattr(graph, column).typecode)
+            # conversion from file to native layout, e.g. int64 sizes on platforms with 32 bit long
+            values.fromstring(GraphFile.getSectionArray(buf, sectionTable, column, dtype)
+                              .astype(np.dtype(values.typecode)).tostring())
+            setattr(graph, column, values)
+        return graph
+
+    @staticmethod
+    def isGraphFile(graphFileName):
+        with open(graphFileName, "rb") as graphFile:
+            return graphFile.read(len(GraphFile.magic)) == GraphFile.magic
+
+    @staticmethod
+    def load(graphFileName):
+        """
+            Loads a graph file or a graph saved as pickle (PackageGraph or networkx graph).
+        :param graphFileName:
+        :return: PackageGraph
+        """
+        if GraphFile.isGraphFile(graphFileName):
+            return GraphFile.read(graphFileName)
+        return PackageGraph.readPickle(graphFileName)
+
+    @staticmethod
+    def open(graphFileName):
+        """
+        :param graphFileName:
+        :return: MappedGraph for queries without loading the graph
+        """
+        return MappedGraph(graphFileName)
+
+    @staticmethod
+    def getGraphFileName(pickleFileName):
+        return pickleFileName[:-len(".pkl")] + StaticInfo.graphFileExtension \
+            if pickleFileName.endswith(".pkl") else pickleFileName + StaticInfo.graphFileExtension
+
+    @staticmethod
+    def convertPickle(pickleFileName):
+        """
+            Converts a graph saved as pickle into a graph file next to it and removes the pickle.
+        :param pickleFileName:
+        :return: name of the graph file
+        """
+        graphFileName = GraphFile.getGraphFileName(pickleFileName)
+        GraphFile.write(GraphFile.load(pickleFileName), graphFileName)
+        os.remove(pickleFileName)
+        return graphFileName
+
+
+class GraphFileLog:
+    """
+        Append-only log of subgraphs that were merged into the graph of a snapshot graph file, stored next to it as
+        "<graph file>.log". A graph is loaded by reading the snapshot and merging all logged subgraphs in order.
+        Since merging a subgraph a second time does not change the graph, a record that is already contained in the
+        snapshot (e.g. compaction interrupted before the log was truncated) does no harm.
+
+        record:     marker "EXPDELTA", length of the main services, length of the subgraph (uint64 each),
+                    main services separated by newlines, subgraph in graph file format
+        The main services of a record are the roots of its subgraph. Compaction only keeps the merged graph, the main
+        services of master graphs are stored in the repository database.
+        Appending and compacting hold an exclusive lock on the log, loading a shared one.
+    """
+    recordMarker = "EXPDELTA"
+    recordHeaderFormat = "<8sQQ"
+    recordHeaderSize = struct.calcsize(recordHeaderFormat)
+
+    @staticmethod
+    def getLogFileName(graphFileName):
+        return graphFileName + ".log"
+
+    @staticmethod
+    def append(graphFileName, records):
+        """
+        :param graphFileName: snapshot graph file
+        :param records: list of tuples (mainServices, PackageGraph)
+        :return: size of the log in bytes
+        """
+        with open(GraphFileLog.getLogFileName(graphFileName), "ab") as logFile:
+            fcntl.flock(logFile, fcntl.LOCK_EX)
+            for (mainServices, subGraph) in records:
+                mainServicesData = "\n".join(GraphFile.encodeStrings(sorted(mainServices)))
+                graphData = GraphFile.toString(subGraph)
+                logFile.write(struct.pack(GraphFileLog.recordHeaderFormat, GraphFileLog.recordMarker,
+                                          len(mainServicesData), len(graphData)))
+                logFile.write(mainServicesData)
+                logFile.write(graphData)
+            logFile.flush()
+            os.fsync(logFile.fileno())
+            return os.fstat(logFile.fileno()).st_size
+
+    @staticmethod
+    def parseRecords(buf):
+        """
+            Incomplete records at the end of the log (interrupted append) are ignored.
+        :param str buf: content of a log
+        :return: generator of tuples (mainServices, PackageGraph)
+        """
+        position = 0
+        while position + GraphFileLog.recordHeaderSize <= len(buf):
+            (marker, mainServicesLength, graphLength) = \
+                struct.unpack(GraphFileLog.recordHeaderFormat, buf[position:position + GraphFileLog.recordHeaderSize])
+            position = position + GraphFileLog.recordHeaderSize
+            if marker != GraphFileLog.recordMarker or position + mainServicesLength + graphLength > len(buf):
+                return
+            mainServicesData = buf[position:position + mainServicesLength]
+            position = position + mainServicesLength
+            subGraph = GraphFile.fromString(buf[position:position + graphLength])
+            position = position + graphLength
+            yield ([] if mainServicesData == "" else mainServicesData.split("\n"), subGraph)
+
+    @staticmethod
+    def mergeRecords(graph, buf):
+        """
+            Merges the logged subgraphs into graph in place, attributes of packages already in graph are kept.
+        :return: set of logged main services
+        """
+        mainServices = set()
+        for (recordMainServices, subGraph) in GraphFileLog.parseRecords(buf):
+            graph.addGraph(subGraph, keepAttributes=True)
+            mainServices.update(recordMainServices)
+        return mainServices
+
+    @staticmethod
+    def load(graphFileName):
+        """
+        :param graphFileName: snapshot graph file
+        :return: tuple (PackageGraph, set of logged main services)
+        """
+        logFileName = GraphFileLog.getLogFileName(graphFileName)
+        if not os.path.isfile(logFileName):
+            return (GraphFile.load(graphFileName), set())
+        with open(logFileName, "rb") as logFile:
+            fcntl.flock(logFile, fcntl.LOCK_SH)
+            graph = GraphFile.load(graphFileName)
+            return (graph, GraphFileLog.mergeRecords(graph, logFile.read()))
+
+    @staticmethod
+    def getLogSize(graphFileName):
+        logFileName = GraphFileLog.getLogFileName(graphFileName)
+        return os.path.getsize(logFileName) if os.path.isfile(logFileName) else 0
+
+    @staticmethod
+    def compact(graphFileName):
+        """
+            Merges the log into a new snapshot that atomically replaces the old one, afterwards the log is emptied.
+        :param graphFileName: snapshot graph file
+        """
+        logFileName = GraphFileLog.getLogFileName(graphFileName)
+        if not os.path.isfile(logFileName):
+            return
+        with open(logFileName, "r+b") as logFile:
+            fcntl.flock(logFile, fcntl.LOCK_EX)
+            buf = logFile.read()
+            if len(buf) == 0:
+                return
+            graph = GraphFile.load(graphFileName)
+            GraphFileLog.mergeRecords(graph, buf)
+            GraphFile.write(graph, graphFileName)
+            logFile.truncate(0)
+
+    @staticmethod
+    def truncate(graphFileName, logSize):
+        """
+            Discards the records appended after the log had logSize bytes, a log that did not exist before is removed.
+        :param graphFileName: snapshot graph file
+        :param logSize: size of the log before the records were appended, see getLogSize
+        """
+        logFileName = GraphFileLog.getLogFileName(graphFileName)
+        if not os.path.isfile(logFileName):
+            return
+        if logSize == 0:
+            os.remove(logFileName)
+            return
+        with open(logFileName, "r+b") as logFile:
+            fcntl.flock(logFile, fcntl.LOCK_EX)
+            logFile.truncate(logSize)
+
+    @staticmethod
+    def removeLog(graphFileName):
+        logFileName = GraphFileLog.getLogFileName(graphFileName)
+        if os.path.isfile(logFileName):
+            os.remove(logFileName)
+
+    @staticmethod
+    def remove(graphFileName):
+        """
+            Removes the snapshot and its log.
+        """
+        GraphFileLog.removeLog(graphFileName)
+        if os.path.isfile(graphFileName):
+            os.remove(graphFileName)
+
+
+class MappedGraph:
+    """
+        Read-only view of a memory-mapped graph file. Packages are looked up by binary search over the sorted names,
+        node data and dependencies are decoded on demand only.
+        So far only used by the evaluation of graph files ("evaluate graphfiles").
+    """
+    def __init__(self, graphFileName):
+        self.graphFileName = graphFileName
+        self.file = open(graphFileName, "rb")
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (self.numPkgs, self.numDeps, self.numStrings, self.sectionTable) = GraphFile.readHeader(self.buf)
+        for (section, dtype) in GraphFile.sections:
+            if dtype is not None:
+                setattr(self, section, GraphFile.getSectionArray(self.buf, self.sectionTable, section, dtype))
+        self.nameDataOffset = self.sectionTable["nameData"][0]
+        self.stringDataOffset = self.sectionTable["stringData"][0]
+
+    def close(self):
+        # numpy views keep the buffer alive, they have to be released before the map can be closed
+        for (section, dtype) in GraphFile.sections:
+            if dtype is not None:
+                setattr(self, section, None)
+        self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def name(self, pkgID):
+        return self.buf[self.nameDataOffset + self.nameOffsets[pkgID]:self.nameDataOffset + self.nameOffsets[pkgID + 1]]
+
+    def string(self, stringID):
+        if stringID < 0:
+            return None
+        return self.buf[self.stringDataOffset + self.stringOffsets[stringID]:
+                        self.stringDataOffset + self.stringOffsets[stringID + 1]]
+
+    def getID(self, name):
+        """
+        :param name:
+        :return: package id of name, None if it does not exist
+        """
+        low = 0
+        high = self.numPkgs
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(self.nameOrder[middle]) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.numPkgs and self.name(self.nameOrder[low]) == name:
+            return int(self.nameOrder[low])
+        return None
+
+    def __contains__(self, name):
+        return self.getID(name) is not None
+
+    def __len__(self):
+        return self.numPkgs
+
+    def number_of_nodes(self):
+        return self.numPkgs
+
+    def number_of_edges(self):
+        return self.numDeps
+
+    def getPkgsInstallSize(self):
+        return int(self.installSizes.sum())
+
+    def nodeData(self, name):
+        """
+            Raises KeyError if package "name" does not exist (same as PackageGraph).
+        """
+        pkgID = self.getID(name)
+        if pkgID is None:
+            raise KeyError(name)
+        return {
+            StaticInfo.dictKeyName: name,
+            StaticInfo.dictKeyVersion: self.string(self.versionIDs[pkgID]),
+            StaticInfo.dictKeyArchitecture: self.string(self.archIDs[pkgID]),
+            StaticInfo.dictKeyEssential: self.essentials[pkgID] == 1,
+            StaticInfo.dictKeyInstallSize: int(self.installSizes[pkgID]),
+            StaticInfo.dictKeyFilePath: self.string(self.pathIDs[pkgID])
+        }
+
+    def iterPackageVersions(self):
+        """
+        :return: generator of tuples (name, version, architecture)
+        """
+        for pkgID in range(self.numPkgs):
+            yield (self.name(pkgID), self.string(self.versionIDs[pkgID]), self.string(self.archIDs[pkgID]))
+
+    def successors(self, name):
+        pkgID = self.getID(name)
+        if pkgID is None:
+            raise KeyError(name)
+        return [self.name(depPkgID) for depPkgID in self.targets[self.indptr[pkgID]:self.indptr[pkgID + 1]]]
+
+    def bfsNodes(self, rootNames):
+        """
+            Same as PackageGraph.bfsNodes, raises KeyError if a root does not exist.
+        :param rootNames: name of root package or iterable of names
+        :return: list of names of all packages reachable from the root(s) (including roots) in breadth-first order
+        """
+        if isinstance(rootNames, basestring):
+            rootNames = [rootNames]
+        indptr = self.indptr
+        targets = self.targets
+        visited = bytearray(self.numPkgs)
+        order = list()
+        queue = deque()
+        for name in rootNames:
+            rootID = self.getID(name)
+            if rootID is None:
+                raise KeyError(name)
+            if not visited[rootID]:
+                visited[rootID] = 1
+                queue.append(rootID)
+        while queue:
+            pkgID = queue.popleft()
+            order.append(pkgID)
+            for depPkgID in targets[indptr[pkgID]:indptr[pkgID + 1]].tolist():
+                if not visited[depPkgID]:
+                    visited[depPkgID] = 1
+                    queue.append(depPkgID)
+        return [self.name(pkgID) for pkgID in order]
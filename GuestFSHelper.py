@@ -1,23 +1,274 @@
+import atexit
+import multiprocessing.util
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
 import guestfs
 
+from StaticInfo import StaticInfo
+
+
+class GuestFSAppliance:
+    """
+        A launched libguestfs appliance that VMI drives are hot-plugged onto (and removed from) while it keeps running.
+        Only holds one VMI drive at a time, next to a small scratch drive that is required to launch it without any VMI.
+    """
+    def __init__(self):
+        self.guest = guestfs.GuestFS(python_return_dict=True)
+        self.guest.add_drive_scratch(StaticInfo.guestfsScratchDriveSize)
+        self.guest.set_smp(StaticInfo.guestfsApplianceCPUs)
+        self.guest.set_memsize(StaticInfo.guestfsApplianceMemory)
+        self.guest.launch()
+        self.uses = 0
+        self.label = None
+        self.pathToVMI = None
+
+    def attach(self, pathToVMI, readonly=False):
+        """
+            Hot-plugs the VMI located at pathToVMI. Raises RuntimeError if the backend does not support hot-plugging.
+        :param pathToVMI:
+        :param readonly:
+        """
+        self.uses = self.uses + 1
+        label = "vmi%i" % self.uses
+        self.guest.add_drive_opts(pathToVMI, readonly=readonly, label=label)
+        self.label = label
+        self.pathToVMI = pathToVMI
+
+    def detach(self):
+        """
+            Unmounts and removes the hot-plugged VMI drive, the appliance itself keeps running.
+        """
+        self.guest.umount_all()
+        self.guest.sync()
+        if self.label is not None:
+            self.guest.remove_drive(self.label)
+        self.label = None
+        self.pathToVMI = None
+
+    def isHealthy(self):
+        """
+        :return: True if the appliance is still running and only holds its scratch drive
+        """
+        try:
+            return self.guest.is_ready() and len(self.guest.list_devices()) == 1
+        except RuntimeError:
+            return False
+
+    def close(self):
+        try:
+            self.guest.shutdown()
+        except RuntimeError:
+            pass
+        self.guest.close()
+
+
+class GuestFSAppliancePool:
+    """
+        Keeps up to "size" launched appliances so that a new handle does not have to boot a new appliance.
+        Appliances are retired after "maxReuse" checkouts or if their health check fails on checkin.
+    """
+    def __init__(self, size, maxReuse):
+        self.size = size
+        self.maxReuse = maxReuse
+        self.hotplugSupported = True
+        self.idleAppliances = list()  # type: list(GuestFSAppliance)
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        """
+        :return: launched GuestFSAppliance without a VMI drive
+        """
+        with self.lock:
+            appliance = self.idleAppliances.pop() if len(self.idleAppliances) > 0 else None
+        if appliance is None:
+            appliance = GuestFSAppliance()
+        return appliance
+
+    def checkin(self, appliance):
+        """
+            Detaches the VMI drive and keeps the appliance for reuse if it is healthy and not worn out.
+        :param GuestFSAppliance appliance:
+        """
+        try:
+            appliance.detach()
+        except RuntimeError as e:
+            print "\tGuestFS appliance retired, removing drive failed: %s" % e
+            appliance.close()
+            return
+        if appliance.uses >= self.maxReuse or not appliance.isHealthy():
+            appliance.close()
+            return
+        with self.lock:
+            if len(self.idleAppliances) < self.size:
+                self.idleAppliances.append(appliance)
+                return
+        appliance.close()
+
+    def warmUp(self):
+        """
+            Launches appliances until the pool holds "size" idle appliances.
+        """
+        while self.hotplugSupported and len(self.idleAppliances) < self.size:
+            appliance = GuestFSAppliance()
+            if appliance.guest.get_backend().split(":")[0] != "libvirt":
+                # the direct backend does not support hot-plugging drives
+                self.hotplugSupported = False
+                appliance.close()
+                return
+            with self.lock:
+                self.idleAppliances.append(appliance)
+
+    def shutdown(self):
+        with self.lock:
+            appliances = self.idleAppliances
+            self.idleAppliances = list()
+        for appliance in appliances:
+            appliance.close()
+
+
 class GuestFSHelper:
+    pool = GuestFSAppliancePool(StaticInfo.guestfsPoolSize, StaticInfo.guestfsPoolMaxReuse)
+    # checked out appliances by id of their handle
+    checkedOutAppliances = dict()
+    # throw-away overlays of read-only handles by id of their handle
+    overlayFolders = dict()
+    # state inherited from the parent process by a worker process, kept so that it is never garbage collected
+    inheritedState = None
+
     @staticmethod
-    def getHandle(pathToVMI, rootRequired=False):
+    def getHandle(pathToVMI, rootRequired=False, readOnly=False):
         """
             Returns the guestfs handle for the vmi located at pathToVMI.
             If rootRequired is specified, a tuple (handle,root) is returned
+            If the appliance pool is enabled, the VMI is hot-plugged onto an already launched appliance.
+            If readOnly is specified, a throw-away qcow2 overlay backed by the VMI is attached instead of the VMI itself.
+            The VMI is never written to, several read-only handles can therefore work on the same VMI at once.
         :param pathToVMI:
         :param rootRequired:
+        :param readOnly:
         :return:
         """
-        def compare(a, b):
-            return len(a) - len(b)
+        if readOnly:
+            overlayFolder = tempfile.mkdtemp(prefix="expelliarmus_overlay_")
+            pathToOverlay = os.path.join(overlayFolder, "overlay.qcow2")
+            GuestFSHelper.createOverlay(pathToVMI, pathToOverlay)
+            guest = GuestFSHelper.attachDrive(pathToOverlay)
+            GuestFSHelper.overlayFolders[id(guest)] = overlayFolder
+        else:
+            guest = GuestFSHelper.attachDrive(pathToVMI)
+        root = GuestFSHelper.mountRoot(guest)
+
+        if rootRequired:
+            return (guest, root)
+        else:
+            return guest
+
+    @staticmethod
+    def createOverlay(pathToBackingVMI, pathToOverlay):
+        """
+            Creates a qcow2 overlay at pathToOverlay that is backed by the VMI at pathToBackingVMI.
+            Writes to the overlay never reach the backing VMI.
+        :param pathToBackingVMI:
+        :param pathToOverlay:
+        """
+        guest = guestfs.GuestFS(python_return_dict=True)
+        guest.disk_create(pathToOverlay, "qcow2", -1,
+                          backingfile=os.path.abspath(pathToBackingVMI),
+                          backingformat=pathToBackingVMI.rsplit(".", 1)[-1])
+        guest.close()
+
+    @staticmethod
+    def getBackingFile(pathToVMI):
+        """
+            Reads the backing file from the qcow2 header of the VMI located at pathToVMI.
+        :param pathToVMI:
+        :return: absolute path of the backing file, None for standalone images and other formats
+        """
+        with open(pathToVMI, "rb") as vmiFile:
+            header = vmiFile.read(20)
+            if len(header) < 20 or header[:4] != "QFI\xfb":
+                return None
+            (backingFileOffset, backingFileSize) = struct.unpack(">QI", header[8:20])
+            if backingFileOffset == 0 or backingFileSize == 0:
+                return None
+            vmiFile.seek(backingFileOffset)
+            backingFile = vmiFile.read(backingFileSize)
+        return os.path.join(os.path.dirname(os.path.abspath(pathToVMI)), backingFile)
+
+    @staticmethod
+    def getOverlays(pathToBackingVMI, folder):
+        """
+        :return: list of paths of the VMIs in folder that are overlays backed by the VMI located at pathToBackingVMI
+        """
+        overlays = []
+        if not os.path.isdir(folder):
+            return overlays
+        for fileName in sorted(os.listdir(folder)):
+            path = os.path.join(folder, fileName)
+            if os.path.isfile(path):
+                backingFile = GuestFSHelper.getBackingFile(path)
+                if backingFile is not None and os.path.realpath(backingFile) == os.path.realpath(pathToBackingVMI):
+                    overlays.append(path)
+        return overlays
+
+    @staticmethod
+    def flattenImage(pathToVMI, pathToFlatVMI):
+        """
+            Writes the content of the VMI located at pathToVMI (including all of its backing files) into a standalone
+            qcow2 image at pathToFlatVMI.
+        :return: True if the standalone image was written
+        """
+        try:
+            returnCode = subprocess.call(["qemu-img", "convert", "-O", "qcow2", pathToVMI, pathToFlatVMI])
+        except OSError as e:
+            returnCode = str(e)
+        if returnCode != 0:
+            print "ERROR: flattening \"%s\" failed (qemu-img: %s)." % (pathToVMI, returnCode)
+            if os.path.isfile(pathToFlatVMI):
+                os.remove(pathToFlatVMI)
+            return False
+        return True
+
+    @staticmethod
+    def attachDrive(pathToVMI):
+        """
+            Returns a launched handle with the VMI located at pathToVMI attached as drive.
+        :param pathToVMI:
+        :return:
+        """
+        pool = GuestFSHelper.pool
+        if pool.size > 0 and pool.hotplugSupported:
+            appliance = pool.checkout()
+            try:
+                appliance.attach(pathToVMI)
+            except RuntimeError as e:
+                print "\tHot-plugging drives not supported (%s), GuestFS appliance pool disabled." % e
+                pool.hotplugSupported = False
+                appliance.close()
+                pool.shutdown()
+            else:
+                GuestFSHelper.checkedOutAppliances[id(appliance.guest)] = appliance
+                return appliance.guest
 
         guest = guestfs.GuestFS(python_return_dict=True)
         guest.add_drive_opts(pathToVMI, readonly=False)
+        guest.set_smp(StaticInfo.guestfsApplianceCPUs)
+        guest.set_memsize(StaticInfo.guestfsApplianceMemory)
         guest.launch()
         #guest.set_verbose(1)
+        return guest
 
+    @staticmethod
+    def mountRoot(guest):
+        """
+            Inspects the attached drives and mounts all filesystems of the single operating system found.
+        :param guest:
+        :return: root device of operating system
+        """
         # Obtain root filesystem that contains the OS
         roots = guest.inspect_os()
         if len(roots) == 0:
@@ -26,13 +277,7 @@ class GuestFSHelper:
             raise (Exception("inspect_vm: more than one operating system found"))
         root = roots[0]
 
-        # Obtain and try to mount all required filesystems associated with OS
-        mps = guest.inspect_get_mountpoints(root)
-        for device in sorted(mps.keys(), compare):
-            try:
-                guest.mount(mps[device], device)
-            except RuntimeError as msg:
-                print "%s (ignored)" % msg
+        GuestFSHelper.mountFilesystems(guest, root)
 
         #guest.sh("mount -t proc proc proc/")
         #guest.sh("mount --rbind /sys sys/")
@@ -45,13 +290,154 @@ class GuestFSHelper:
         #print guest.dmesg()
 
         #print guest.sh("mount")
+        return root
 
-        if rootRequired:
-            return (guest, root)
-        else:
-            return guest
+    @staticmethod
+    def mountFilesystems(guest, root):
+        """
+            Mounts all filesystems associated with the operating system on root.
+        :param guest:
+        :param root:
+        """
+        def compare(a, b):
+            return len(a) - len(b)
+
+        # Obtain and try to mount all required filesystems associated with OS
+        mps = guest.inspect_get_mountpoints(root)
+        for device in sorted(mps.keys(), compare):
+            try:
+                guest.mount(mps[device], device)
+            except RuntimeError as msg:
+                print "%s (ignored)" % msg
+
+    @staticmethod
+    def iterateRoots(pathsToVMI):
+        """
+            Batch inspection: attaches many VMIs as separate drives to a single appliance and mounts the root of one VMI
+            after the other. VMIs are attached read-only through throw-away overlays.
+            At most StaticInfo.guestfsMaxDrivesPerAppliance VMIs share an appliance.
+            VMIs whose operating system cannot be assigned to their drive unambiguously (e.g. clones with identical
+            LVM volume groups) or whose appliance fails to launch are inspected with a handle of their own instead.
+        :param list() pathsToVMI:
+        :return: generator of triples (pathToVMI, guest, root) in the order of pathsToVMI,
+                 the filesystems of root are mounted until the next triple is requested,
+                 VMIs that cannot be inspected at all are yielded as (pathToVMI, None, error)
+        """
+        chunkSize = StaticInfo.guestfsMaxDrivesPerAppliance
+        for start in range(0, len(pathsToVMI), chunkSize):
+            chunk = pathsToVMI[start:start + chunkSize]
+            overlayFolder = tempfile.mkdtemp(prefix="expelliarmus_overlay_")
+            guest = guestfs.GuestFS(python_return_dict=True)
+            launched = False
+            try:
+                rootsByIndex = dict()
+                ambiguousIndices = set()
+                try:
+                    for index, pathToVMI in enumerate(chunk):
+                        pathToOverlay = os.path.join(overlayFolder, "overlay%i.qcow2" % index)
+                        GuestFSHelper.createOverlay(pathToVMI, pathToOverlay)
+                        guest.add_drive_opts(pathToOverlay, readonly=False)
+                    guest.launch()
+                    launched = True
+                except RuntimeError as msg:
+                    # e.g. a broken VMI in the chunk, fall back to a handle per VMI
+                    print "Batch inspection failed, inspecting VMIs one by one: %s" % msg
+
+                # assign roots to drives by device index (= order in which drives were added)
+                if launched:
+                    for root in guest.inspect_os():
+                        index = GuestFSHelper.getDriveIndex(guest, root)
+                        if index in rootsByIndex:
+                            ambiguousIndices.add(index)
+                        rootsByIndex[index] = root
+
+                for index, pathToVMI in enumerate(chunk):
+                    if index in rootsByIndex and index not in ambiguousIndices:
+                        guest.umount_all()
+                        GuestFSHelper.mountFilesystems(guest, rootsByIndex[index])
+                        yield (pathToVMI, guest, rootsByIndex[index])
+                    else:
+                        try:
+                            (singleGuest, singleRoot) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True, readOnly=True)
+                        except Exception as e:
+                            yield (pathToVMI, None, e)
+                            continue
+                        try:
+                            yield (pathToVMI, singleGuest, singleRoot)
+                        finally:
+                            GuestFSHelper.shutdownHandle(singleGuest)
+            finally:
+                if launched:
+                    guest.umount_all()
+                    guest.shutdown()
+                guest.close()
+                shutil.rmtree(overlayFolder, ignore_errors=True)
+
+    @staticmethod
+    def getDriveIndex(guest, device):
+        """
+            Returns the index of the drive that holds the filesystem on device.
+            Partitions are resolved to their drive, logical volumes to the drive of their volume group.
+        :param guest:
+        :param device:
+        :return: index of drive in the order the drives were added
+        """
+        try:
+            lvName = guest.lvm_canonical_lv_name(device)
+        except RuntimeError:
+            lvName = None
+        if lvName is not None:
+            # logical volume in the form of /dev/VG/LV
+            pvUUIDs = set(guest.vgpvuuids(lvName.split("/")[2]))
+            pvNames = sorted(pv["pv_name"] for pv in guest.pvs_full() if pv["pv_uuid"] in pvUUIDs)
+            device = pvNames[0]
+        try:
+            device = guest.part_to_dev(device)
+        except RuntimeError:
+            # device is not a partition but a whole drive
+            pass
+        return guest.device_index(device)
 
     @staticmethod
     def shutdownHandle(guest):
-        guest.umount_all()
-        guest.shutdown()
\ No newline at end of file
+        """
+            Pooled handles are given back to the appliance pool, all other handles are shut down.
+        :param guest:
+        """
+        appliance = GuestFSHelper.checkedOutAppliances.pop(id(guest), None)
+        overlayFolder = GuestFSHelper.overlayFolders.pop(id(guest), None)
+        if appliance is not None:
+            GuestFSHelper.pool.checkin(appliance)
+        else:
+            guest.umount_all()
+            guest.shutdown()
+        if overlayFolder is not None:
+            shutil.rmtree(overlayFolder, ignore_errors=True)
+
+    @staticmethod
+    def warmUpPool():
+        """
+            Launches the appliances of the pool in advance, intended to be called before batch operations.
+        """
+        if GuestFSHelper.pool.size > 0:
+            GuestFSHelper.pool.warmUp()
+
+    @staticmethod
+    def shutdownPool():
+        GuestFSHelper.pool.shutdown()
+
+    @staticmethod
+    def resetAfterFork():
+        """
+            Initializer of worker processes: appliances of the parent process are neither used nor closed by the worker,
+            the worker launches appliances of its own that are shut down when it exits.
+        """
+        GuestFSHelper.inheritedState = (GuestFSHelper.pool, GuestFSHelper.checkedOutAppliances,
+                                        GuestFSHelper.overlayFolders)
+        GuestFSHelper.pool = GuestFSAppliancePool(StaticInfo.guestfsPoolSize, StaticInfo.guestfsPoolMaxReuse)
+        GuestFSHelper.checkedOutAppliances = dict()
+        GuestFSHelper.overlayFolders = dict()
+        # worker processes do not run atexit handlers
+        multiprocessing.util.Finalize(None, GuestFSHelper.shutdownPool, exitpriority=10)
+
+atexit.register(GuestFSHelper.shutdownPool)
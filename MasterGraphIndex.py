@@ -0,0 +1,67 @@
+import hashlib
+import struct
+
+import numpy as np
+
+from StaticInfo import StaticInfo
+
+
+class MasterGraphIndex:
+    """
+        MinHash signatures over the main service packages of master graphs and their banding for
+        locality-sensitive hashing. Master graphs whose signatures share at least one band with the signature of a VMI
+        are candidates for an exact similarity computation.
+        Packages are hashed as triples (name, version, architecture).
+    """
+    # hash functions h(x) = (a * x + b) mod prime, identical in every run so that stored signatures stay valid
+    prime = (1 << 31) - 1
+    randomState = np.random.RandomState(20180801)
+    coefficientsA = randomState.randint(1, prime, size=StaticInfo.masterIndexNumHashes).astype(np.int64)
+    coefficientsB = randomState.randint(0, prime, size=StaticInfo.masterIndexNumHashes).astype(np.int64)
+
+    @staticmethod
+    def hashPackage(pkgName, pkgInfo):
+        """
+        :return: stable 31 bit hash of the triple (name, version, architecture)
+        """
+        triple = "%s;%s;%s" % (pkgName, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture])
+        return struct.unpack("<I", hashlib.md5(triple).digest()[:4])[0] % MasterGraphIndex.prime
+
+    @staticmethod
+    def computeSignature(packageDict):
+        """
+        :param dict() packageDict: in the form of {pkgName:pkgInfo} with pkgInfo = dict{version:?, architecture:?,...}
+        :return: numpy array of StaticInfo.masterIndexNumHashes minimum hash values, None for an empty packageDict
+        """
+        if packageDict is None or len(packageDict) == 0:
+            return None
+        hashes = np.array([MasterGraphIndex.hashPackage(pkgName, pkgInfo)
+                           for (pkgName, pkgInfo) in packageDict.iteritems()], dtype=np.int64)
+        permutedHashes = (np.outer(MasterGraphIndex.coefficientsA, hashes) +
+                          MasterGraphIndex.coefficientsB[:, np.newaxis]) % MasterGraphIndex.prime
+        return permutedHashes.min(axis=1)
+
+    @staticmethod
+    def getBands(signature):
+        """
+        :param signature:
+        :return: list of tuples (band, bucket), bucket identifies the values of the signature in this band
+        """
+        rowsPerBand = StaticInfo.masterIndexRowsPerBand
+        return [(band, ",".join(str(value) for value in signature[band * rowsPerBand:(band + 1) * rowsPerBand]))
+                for band in range(len(signature) // rowsPerBand)]
+
+    @staticmethod
+    def estimateSimilarity(signature1, signature2):
+        """
+        :return: estimated Jaccard similarity of the two package sets
+        """
+        return float(np.count_nonzero(signature1 == signature2)) / len(signature1)
+
+    @staticmethod
+    def signatureToBlob(signature):
+        return buffer(signature.astype(np.int64).tostring())
+
+    @staticmethod
+    def signatureFromBlob(blob):
+        return np.frombuffer(str(blob), dtype=np.int64)
@@ -0,0 +1,179 @@
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from StringIO import StringIO
+
+from PackageStore import PackageStore
+from StaticInfo import StaticInfo
+
+
+class PackageBundle:
+    """
+        Tarballs of the package files imported into a VMI together with the repository metadata of these packages
+        (Packages.gz for APT, repodata/ for DNF), generated on the host instead of inside the guest.
+        Bundles are cached in StaticInfo.relPathLocalRepositoryBundles and named by a hash over the checksums of their
+        packages, so a bundle is reused for the same package set and never for changed package contents.
+        If the metadata cannot be generated on the host (createrepo missing), the bundle only holds the packages.
+    """
+    formatDeb = "deb"
+    formatRpm = "rpm"
+
+    @staticmethod
+    def getBundle(packageFileNames, checksums, bundleFormat):
+        """
+        :param list() packageFileNames: paths of the package files
+        :param list() checksums: SHA-256 of each package file, None if unknown
+        :param bundleFormat: PackageBundle.formatDeb or PackageBundle.formatRpm
+        :return: tuple (path to bundle, True if the bundle contains repository metadata)
+        """
+        checksums = [checksum if checksum is not None else PackageStore.computeChecksum(fileName)
+                     for (fileName, checksum) in zip(packageFileNames, checksums)]
+        key = PackageBundle.getKey(packageFileNames, checksums, bundleFormat)
+        for (suffix, hasMetadata) in [("-meta.tar", True), ("-plain.tar", False)]:
+            bundlePath = StaticInfo.relPathLocalRepositoryBundles + "/" + key + suffix
+            if os.path.isfile(bundlePath):
+                # used bundles are kept longest, see evictBundles
+                os.utime(bundlePath, None)
+                return (bundlePath, hasMetadata)
+
+        if not os.path.isdir(StaticInfo.relPathLocalRepositoryBundles):
+            os.mkdir(StaticInfo.relPathLocalRepositoryBundles)
+        buildFolder = tempfile.mkdtemp(prefix="expelliarmus_bundle_", dir=StaticInfo.relPathLocalRepositoryBundles)
+        try:
+            for fileName in packageFileNames:
+                os.link(fileName, buildFolder + "/" + os.path.basename(fileName))
+            if bundleFormat == PackageBundle.formatDeb:
+                PackageBundle.writeAptMetadata(buildFolder, packageFileNames, checksums)
+                hasMetadata = True
+            else:
+                hasMetadata = PackageBundle.writeDnfMetadata(buildFolder)
+            bundlePath = StaticInfo.relPathLocalRepositoryBundles + "/" + key + \
+                         ("-meta.tar" if hasMetadata else "-plain.tar")
+            with tarfile.open(buildFolder + ".tar", mode="w") as tar:
+                for fileName in sorted(os.listdir(buildFolder)):
+                    tar.add(buildFolder + "/" + fileName, arcname=fileName)
+            # concurrent reassemblies may build the same bundle, the last one replaces it
+            os.rename(buildFolder + ".tar", bundlePath)
+        finally:
+            shutil.rmtree(buildFolder)
+            if os.path.isfile(buildFolder + ".tar"):
+                os.remove(buildFolder + ".tar")
+        PackageBundle.evictBundles(keep=bundlePath)
+        return (bundlePath, hasMetadata)
+
+    @staticmethod
+    def getKey(packageFileNames, checksums, bundleFormat):
+        sha256 = hashlib.sha256(bundleFormat)
+        for (baseName, checksum) in sorted(zip([os.path.basename(fileName) for fileName in packageFileNames],
+                                               checksums)):
+            sha256.update("\n%s %s" % (baseName, checksum))
+        return sha256.hexdigest()
+
+    @staticmethod
+    def evictBundles(keep=None):
+        """
+            Removes the least recently used bundles until all bundles fit into StaticInfo.packageBundleCacheSize.
+            Bundles used within StaticInfo.packageBundleEvictionGracePeriod are kept, parallel reassemblies may have
+            got them from getBundle without having imported them yet.
+        :param keep: path of a bundle that is never removed
+        """
+        bundles = []
+        cacheSize = 0
+        minMTime = time.time() - StaticInfo.packageBundleEvictionGracePeriod
+        for fileName in os.listdir(StaticInfo.relPathLocalRepositoryBundles):
+            path = StaticInfo.relPathLocalRepositoryBundles + "/" + fileName
+            if not fileName.endswith(".tar"):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed by a parallel eviction
+                continue
+            cacheSize = cacheSize + stat.st_size
+            if path != keep and stat.st_mtime < minMTime:
+                bundles.append((stat.st_mtime, stat.st_size, path))
+        for (_mtime, size, path) in sorted(bundles):
+            if cacheSize <= StaticInfo.packageBundleCacheSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            cacheSize = cacheSize - size
+
+    @staticmethod
+    def writeAptMetadata(folder, packageFileNames, checksums):
+        """
+            Writes the index of a flat APT repository (Packages.gz) with the same content as
+            "dpkg-scanpackages . /dev/null | gzip -9c > Packages.gz".
+        """
+        stanzas = []
+        for (fileName, checksum) in sorted(zip(packageFileNames, checksums),
+                                           key=lambda item: os.path.basename(item[0])):
+            md5 = hashlib.md5()
+            sha1 = hashlib.sha1()
+            with open(fileName, "rb") as packageFile:
+                while True:
+                    chunk = packageFile.read(StaticInfo.exportStreamChunkSize)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    sha1.update(chunk)
+            stanzas.append(PackageBundle.readDebControl(fileName).rstrip("\n") + "\n" +
+                           "Filename: ./%s\n" % os.path.basename(fileName) +
+                           "Size: %i\n" % os.path.getsize(fileName) +
+                           "MD5sum: %s\n" % md5.hexdigest() +
+                           "SHA1: %s\n" % sha1.hexdigest() +
+                           "SHA256: %s\n" % checksum)
+        with open(folder + "/Packages.gz", "wb") as packagesFile:
+            with gzip.GzipFile(fileobj=packagesFile, mode="wb", compresslevel=9, mtime=0) as gzipFile:
+                gzipFile.write("\n".join(stanzas))
+
+    @staticmethod
+    def readDebControl(fileName):
+        """
+        :return: content of the control file of the .deb package fileName
+        """
+        with open(fileName, "rb") as debFile:
+            if debFile.read(8) != "!<arch>\n":
+                raise ValueError("\"%s\" is not a Debian package" % fileName)
+            while True:
+                header = debFile.read(60)
+                if len(header) < 60:
+                    break
+                memberName = header[:16].strip().rstrip("/")
+                memberSize = int(header[48:58])
+                if not memberName.startswith("control.tar"):
+                    debFile.seek(memberSize + memberSize % 2, os.SEEK_CUR)
+                    continue
+                data = debFile.read(memberSize)
+                if memberName.endswith(".xz") or memberName.endswith(".zst"):
+                    process = subprocess.Popen(["xz" if memberName.endswith(".xz") else "zstd", "-dc"],
+                                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                    data = process.communicate(data)[0]
+                with tarfile.open(fileobj=StringIO(data), mode="r:gz" if memberName.endswith(".gz") else "r:") as tar:
+                    for member in tar:
+                        if member.isfile() and os.path.basename(member.name) == "control":
+                            return tar.extractfile(member).read()
+                break
+        raise ValueError("no control file found in \"%s\"" % fileName)
+
+    @staticmethod
+    def writeDnfMetadata(folder):
+        """
+            Writes repodata/ with createrepo_c or createrepo on the host.
+        :return: False if neither is available
+        """
+        with open(os.devnull, "w") as devNull:
+            for tool in ["createrepo_c", "createrepo"]:
+                try:
+                    if subprocess.call([tool, folder], stdout=devNull, stderr=devNull) == 0:
+                        return True
+                except OSError:
+                    pass
+        return False
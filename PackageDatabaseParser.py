@@ -0,0 +1,168 @@
+import sqlite3
+import struct
+
+
+class DpkgStatusParser:
+    """
+        Streaming parser for the dpkg status database (/var/lib/dpkg/status).
+    """
+    # fields of a package stanza that are required for the VMI graph
+    fieldsOfInterest = {"Package", "Status", "Version", "Architecture", "Essential",
+                        "Installed-Size", "Depends", "Pre-Depends", "Provides"}
+
+    @staticmethod
+    def iterateRecords(statusFile):
+        """
+            Reads the status file line by line and yields one record per package known to dpkg.
+            Packages in state "not-installed" are skipped (same as "dpkg-query --show").
+        :param file statusFile: opened status file
+        :return: generator of dict(field:value), e.g. dict(Package:"curl", Version:"1.1", Depends:"dep1, dep2",...)
+        """
+        record = dict()
+        field = None
+        for line in statusFile:
+            line = line.rstrip("\n")
+            if line == "":
+                # end of stanza
+                if DpkgStatusParser.isKnownPackage(record):
+                    yield record
+                record = dict()
+                field = None
+            elif line[0] in " \t":
+                # continuation line of a multiline field
+                if field in DpkgStatusParser.fieldsOfInterest:
+                    record[field] = record[field] + " " + line.strip()
+            else:
+                (field, _, value) = line.partition(":")
+                if field in DpkgStatusParser.fieldsOfInterest:
+                    record[field] = value.strip()
+        if DpkgStatusParser.isKnownPackage(record):
+            yield record
+
+    @staticmethod
+    def isKnownPackage(record):
+        """
+        :param dict() record:
+        :return: True if record describes a package that is not in state "not-installed"
+        """
+        if "Package" not in record:
+            return False
+        return record.get("Status", "").split(" ")[-1] != "not-installed"
+
+
+class RpmHeaderParser:
+    """
+        Parser for rpm package headers as they are stored in the rpm database (header blob without lead and magic).
+    """
+    # header tags, see https://github.com/rpm-software-management/rpm/blob/master/include/rpm/rpmtag.h
+    TagName         = 1000
+    TagVersion      = 1001
+    TagSize         = 1009
+    TagArch         = 1022
+    TagProvideName  = 1047
+    TagRequireName  = 1049
+    TagDirIndexes   = 1116
+    TagBaseNames    = 1117
+    TagDirNames     = 1118
+    TagLongSize     = 5009
+
+    # header data types
+    TypeInt8        = 2
+    TypeInt16       = 3
+    TypeInt32       = 4
+    TypeInt64       = 5
+    TypeString      = 6
+    TypeStringArray = 8
+    TypeI18NString  = 9
+
+    # struct format and size of integer data types (unsigned)
+    intFormats = {
+        TypeInt8: ("B", 1),
+        TypeInt16: ("H", 2),
+        TypeInt32: ("I", 4),
+        TypeInt64: ("Q", 8)
+    }
+
+    tagsOfInterest = {TagName, TagVersion, TagSize, TagArch, TagProvideName, TagRequireName,
+                      TagDirIndexes, TagBaseNames, TagDirNames, TagLongSize}
+
+    @staticmethod
+    def parse(blob):
+        """
+            Decodes the tags required for the VMI graph, all other tags are skipped without being decoded.
+        :param str blob: header blob
+        :return: dict(tag:value), value is str, int or list
+        """
+        blob = str(blob)
+        (numEntries, dataLength) = struct.unpack(">ii", blob[0:8])
+        dataStart = 8 + numEntries * 16
+        header = dict()
+        for i in range(numEntries):
+            (tag, dataType, offset, count) = struct.unpack(">iiii", blob[8 + i * 16:8 + (i + 1) * 16])
+            if tag not in RpmHeaderParser.tagsOfInterest:
+                continue
+            offset = dataStart + offset
+            if dataType == RpmHeaderParser.TypeString or dataType == RpmHeaderParser.TypeI18NString:
+                header[tag] = blob[offset:blob.index("\0", offset)]
+            elif dataType == RpmHeaderParser.TypeStringArray:
+                strings = list()
+                for _ in range(count):
+                    end = blob.index("\0", offset)
+                    strings.append(blob[offset:end])
+                    offset = end + 1
+                header[tag] = strings
+            elif dataType in RpmHeaderParser.intFormats:
+                formatChar, size = RpmHeaderParser.intFormats[dataType]
+                values = struct.unpack(">" + formatChar * count, blob[offset:offset + size * count])
+                header[tag] = list(values)
+        return header
+
+    @staticmethod
+    def getFileNames(header):
+        """
+        :param dict() header: parsed header
+        :return: list of absolute paths of files contained in the package
+        """
+        if RpmHeaderParser.TagBaseNames not in header:
+            return []
+        dirNames = header[RpmHeaderParser.TagDirNames]
+        return [dirNames[dirIndex] + baseName
+                for (dirIndex, baseName) in zip(header[RpmHeaderParser.TagDirIndexes],
+                                                header[RpmHeaderParser.TagBaseNames])]
+
+    @staticmethod
+    def iterateHeadersSQLite(pathToRpmDB):
+        """
+            Reads the headers from an rpm database in sqlite format (rpmdb.sqlite, used since Fedora 33).
+        :param pathToRpmDB:
+        :return: generator of parsed headers
+        """
+        db = sqlite3.connect(pathToRpmDB)
+        try:
+            for (blob,) in db.execute("SELECT blob FROM Packages"):
+                yield RpmHeaderParser.parse(blob)
+        finally:
+            db.close()
+
+    @staticmethod
+    def iterateHeadersRpmLib(pathToRpmDBFolder):
+        """
+            Reads the headers from an rpm database in any format supported by the host's rpm library
+            (e.g. Berkeley DB "Packages" used up to Fedora 32). Requires the rpm python bindings on the host.
+        :param pathToRpmDBFolder: folder containing the rpm database files
+        :return: generator of parsed headers
+        """
+        import rpm
+        rpm.addMacro("_dbpath", pathToRpmDBFolder)
+        try:
+            transactionSet = rpm.TransactionSet()
+            for rpmHeader in transactionSet.dbMatch():
+                header = dict()
+                for tag in RpmHeaderParser.tagsOfInterest:
+                    value = rpmHeader[tag]
+                    if value is None or value == [] or value == "":
+                        continue
+                    header[tag] = [value] if isinstance(value, (int, long)) else value
+                yield header
+        finally:
+            rpm.delMacro("_dbpath")
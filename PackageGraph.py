@@ -0,0 +1,484 @@
+import cPickle as pickle
+from array import array
+from collections import deque
+
+import networkx as nx
+
+from StaticInfo import StaticInfo
+
+
+class PackageGraph:
+    """
+        Compact, array-backed package dependency graph (directed, parallel edges allowed).
+        Packages are interned to integer ids, node attributes are stored column-wise and edges as CSR adjacency arrays.
+        Offers the part of the networkx MultiDiGraph interface that is used for VMI graphs
+        (add_nodes_from, add_edges_from, nodes(data=True), edges(data=True), subgraph, in, len).
+    """
+    # array attributes that are serialized as raw bytes
+    arrayColumns = ["versionIDs", "archIDs", "essentials", "installSizes", "pathIDs",
+                    "indptr", "targets", "constraints", "operatorIDs", "edgeVersionIDs"]
+
+    def __init__(self):
+        # package names and their ids
+        self.names = list()
+        self.nodeIDs = dict()
+
+        # node attributes, one column per attribute, indexed by package id
+        self.versionIDs = array("i")
+        self.archIDs = array("i")
+        self.essentials = array("b")
+        self.installSizes = array("l")
+        self.pathIDs = array("i")
+
+        # interned attribute values (versions, architectures, paths, operators), -1 encodes None
+        self.strings = list()
+        self.stringIDs = dict()
+
+        # edges in CSR format: edges of package i are at positions indptr[i] to indptr[i+1] of the edge columns
+        self.indptr = array("i", [0])
+        self.targets = array("i")
+        self.constraints = array("b")
+        self.operatorIDs = array("i")
+        self.edgeVersionIDs = array("i")
+
+        # edges added since CSR arrays were built, in the form of [(pkgID, depPkgID, constraint, operatorID, versionID)]
+        self.pendingEdges = list()
+
+    #
+    # interning of attribute values
+    #
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        value = str(value)
+        stringID = self.stringIDs.get(value)
+        if stringID is None:
+            stringID = len(self.strings)
+            self.strings.append(value)
+            self.stringIDs[value] = stringID
+        return stringID
+
+    def string(self, stringID):
+        return None if stringID < 0 else self.strings[stringID]
+
+    #
+    # construction
+    #
+
+    def add_node(self, name, attributes=None):
+        """
+            Adds package "name" or updates the given attributes if it already exists (same as networkx).
+        :param name:
+        :param dict() attributes: in the form of {name:"pkg", version:"1.1", architecture:"amd64", essential:False, size:10}
+        :return: package id
+        """
+        attributes = attributes if attributes is not None else dict()
+        pkgID = self.nodeIDs.get(name)
+        if pkgID is None:
+            pkgID = len(self.names)
+            self.names.append(name)
+            self.nodeIDs[name] = pkgID
+            self.versionIDs.append(self.intern(attributes.get(StaticInfo.dictKeyVersion, "")))
+            self.archIDs.append(self.intern(attributes.get(StaticInfo.dictKeyArchitecture, "")))
+            self.essentials.append(1 if attributes.get(StaticInfo.dictKeyEssential, False) else 0)
+            self.installSizes.append(int(attributes.get(StaticInfo.dictKeyInstallSize, 0) or 0))
+            self.pathIDs.append(self.intern(attributes.get(StaticInfo.dictKeyFilePath)))
+        else:
+            if StaticInfo.dictKeyVersion in attributes:
+                self.versionIDs[pkgID] = self.intern(attributes[StaticInfo.dictKeyVersion])
+            if StaticInfo.dictKeyArchitecture in attributes:
+                self.archIDs[pkgID] = self.intern(attributes[StaticInfo.dictKeyArchitecture])
+            if StaticInfo.dictKeyEssential in attributes:
+                self.essentials[pkgID] = 1 if attributes[StaticInfo.dictKeyEssential] else 0
+            if StaticInfo.dictKeyInstallSize in attributes:
+                self.installSizes[pkgID] = int(attributes[StaticInfo.dictKeyInstallSize] or 0)
+            if StaticInfo.dictKeyFilePath in attributes:
+                self.pathIDs[pkgID] = self.intern(attributes[StaticInfo.dictKeyFilePath])
+        return pkgID
+
+    def add_nodes_from(self, nodes):
+        """
+        :param nodes: iterable of names or of tuples (name, attributes)
+        """
+        for node in nodes:
+            if isinstance(node, tuple):
+                self.add_node(node[0], node[1])
+            else:
+                self.add_node(node)
+
+    def add_edge(self, pkgName, depPkgName, attributes=None):
+        attributes = attributes if attributes is not None else dict()
+        self.pendingEdges.append((
+            self.add_node(pkgName) if pkgName not in self.nodeIDs else self.nodeIDs[pkgName],
+            self.add_node(depPkgName) if depPkgName not in self.nodeIDs else self.nodeIDs[depPkgName],
+            1 if attributes.get(StaticInfo.dictKeyConstraint, False) else 0,
+            self.intern(attributes.get(StaticInfo.dictKeyOperator, "")),
+            self.intern(attributes.get(StaticInfo.dictKeyVersion, ""))
+        ))
+
+    def add_edges_from(self, edges):
+        """
+        :param edges: iterable of tuples (pkg, depPkg) or (pkg, depPkg, attributes)
+        """
+        for edge in edges:
+            self.add_edge(edge[0], edge[1], edge[2] if len(edge) > 2 else None)
+
+    def compact(self):
+        """
+            Merges pending edges into the CSR arrays. Called before any query that traverses edges.
+        """
+        numNodes = len(self.names)
+        if len(self.pendingEdges) == 0 and len(self.indptr) == numNodes + 1:
+            return
+        # count edges per package
+        counts = array("i", [0]) * (numNodes + 1)
+        for pkgID in range(len(self.indptr) - 1):
+            counts[pkgID + 1] = self.indptr[pkgID + 1] - self.indptr[pkgID]
+        for edge in self.pendingEdges:
+            counts[edge[0] + 1] = counts[edge[0] + 1] + 1
+        for pkgID in range(numNodes):
+            counts[pkgID + 1] = counts[pkgID + 1] + counts[pkgID]
+        numEdges = counts[numNodes]
+
+        # fill edge columns, existing edges of a package keep their position in front of the new ones
+        position = array("i", counts[:numNodes])
+        targets = array("i", [0]) * numEdges
+        constraints = array("b", [0]) * numEdges
+        operatorIDs = array("i", [0]) * numEdges
+        edgeVersionIDs = array("i", [0]) * numEdges
+        for pkgID in range(len(self.indptr) - 1):
+            for edgeIndex in range(self.indptr[pkgID], self.indptr[pkgID + 1]):
+                newIndex = position[pkgID]
+                targets[newIndex] = self.targets[edgeIndex]
+                constraints[newIndex] = self.constraints[edgeIndex]
+                operatorIDs[newIndex] = self.operatorIDs[edgeIndex]
+                edgeVersionIDs[newIndex] = self.edgeVersionIDs[edgeIndex]
+                position[pkgID] = newIndex + 1
+        for (pkgID, depPkgID, constraint, operatorID, versionID) in self.pendingEdges:
+            newIndex = position[pkgID]
+            targets[newIndex] = depPkgID
+            constraints[newIndex] = constraint
+            operatorIDs[newIndex] = operatorID
+            edgeVersionIDs[newIndex] = versionID
+            position[pkgID] = newIndex + 1
+
+        self.indptr = counts
+        self.targets = targets
+        self.constraints = constraints
+        self.operatorIDs = operatorIDs
+        self.edgeVersionIDs = edgeVersionIDs
+        self.pendingEdges = list()
+
+    #
+    # queries
+    #
+
+    def __contains__(self, name):
+        return name in self.nodeIDs
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def number_of_nodes(self):
+        return len(self.names)
+
+    def number_of_edges(self):
+        self.compact()
+        return len(self.targets)
+
+    def nodeData(self, name):
+        """
+        :param name:
+        :return: attributes of package "name" in the form of {name:"pkg", version:"1.1", architecture:"amd64", essential:False, size:10, path:None}
+        """
+        return self.nodeDataFromID(self.nodeIDs[name])
+
+    def nodeDataFromID(self, pkgID):
+        return {
+            StaticInfo.dictKeyName: self.names[pkgID],
+            StaticInfo.dictKeyVersion: self.string(self.versionIDs[pkgID]),
+            StaticInfo.dictKeyArchitecture: self.string(self.archIDs[pkgID]),
+            StaticInfo.dictKeyEssential: self.essentials[pkgID] == 1,
+            StaticInfo.dictKeyInstallSize: self.installSizes[pkgID],
+            StaticInfo.dictKeyFilePath: self.string(self.pathIDs[pkgID])
+        }
+
+    def iterPackageVersions(self):
+        """
+        :return: generator of tuples (name, version, architecture) without building attribute dicts
+        """
+        for pkgID in range(len(self.names)):
+            yield (self.names[pkgID], self.string(self.versionIDs[pkgID]), self.string(self.archIDs[pkgID]))
+
+    def nodes(self, data=False):
+        """
+        :param data:
+        :return: list of package names or, if data is specified, list of tuples (name, attributes)
+        """
+        if data:
+            return [(self.names[pkgID], self.nodeDataFromID(pkgID)) for pkgID in range(len(self.names))]
+        return list(self.names)
+
+    def edges(self, data=False):
+        """
+        :param data:
+        :return: list of tuples (pkg, depPkg) or, if data is specified, (pkg, depPkg, attributes)
+        """
+        self.compact()
+        edges = list()
+        for pkgID in range(len(self.names)):
+            for edgeIndex in range(self.indptr[pkgID], self.indptr[pkgID + 1]):
+                if data:
+                    edges.append((self.names[pkgID], self.names[self.targets[edgeIndex]], self.edgeDataFromIndex(edgeIndex)))
+                else:
+                    edges.append((self.names[pkgID], self.names[self.targets[edgeIndex]]))
+        return edges
+
+    def edgeDataFromIndex(self, edgeIndex):
+        return {
+            StaticInfo.dictKeyConstraint: self.constraints[edgeIndex] == 1,
+            StaticInfo.dictKeyOperator: self.string(self.operatorIDs[edgeIndex]),
+            StaticInfo.dictKeyVersion: self.string(self.edgeVersionIDs[edgeIndex])
+        }
+
+    def successors(self, name):
+        self.compact()
+        pkgID = self.nodeIDs[name]
+        return list(self.names[depPkgID] for depPkgID in self.targets[self.indptr[pkgID]:self.indptr[pkgID + 1]])
+
+    def bfsIDs(self, rootIDs):
+        """
+        :param rootIDs: iterable of package ids
+        :return: list of ids of all packages reachable from rootIDs (including roots) in breadth-first order
+        """
+        self.compact()
+        indptr = self.indptr
+        targets = self.targets
+        visited = bytearray(len(self.names))
+        order = list()
+        queue = deque()
+        for rootID in rootIDs:
+            if not visited[rootID]:
+                visited[rootID] = 1
+                queue.append(rootID)
+        while queue:
+            pkgID = queue.popleft()
+            order.append(pkgID)
+            for depPkgID in targets[indptr[pkgID]:indptr[pkgID + 1]]:
+                if not visited[depPkgID]:
+                    visited[depPkgID] = 1
+                    queue.append(depPkgID)
+        return order
+
+    def bfsNodes(self, rootNames):
+        """
+            Replaces nx.bfs_tree(graph, root).nodes(), raises KeyError if a root does not exist.
+        :param rootNames: name of root package or iterable of names
+        :return: list of names of all packages reachable from the root(s) (including roots) in breadth-first order
+        """
+        if isinstance(rootNames, basestring):
+            rootNames = [rootNames]
+        return [self.names[pkgID] for pkgID in self.bfsIDs(self.nodeIDs[name] for name in rootNames)]
+
+    def componentIDs(self, pkgIDs):
+        """
+            Strongly connected components (i.e. dependency cycles) of the subgraph induced by pkgIDs,
+            Tarjan's algorithm without recursion.
+        :param pkgIDs: iterable of package ids
+        :return: list of components (lists of package ids), every component follows the components it depends on
+        """
+        self.compact()
+        selectedIDs = set(pkgIDs)
+        indices = dict()
+        lowLinks = dict()
+        stack = list()
+        onStack = set()
+        components = list()
+        for rootID in sorted(selectedIDs):
+            if rootID in indices:
+                continue
+            indices[rootID] = lowLinks[rootID] = len(indices)
+            stack.append(rootID)
+            onStack.add(rootID)
+            # in the form of [(pkgID, index of the next edge to visit)]
+            path = [(rootID, self.indptr[rootID])]
+            while len(path) > 0:
+                (pkgID, edgeIndex) = path[-1]
+                if edgeIndex < self.indptr[pkgID + 1]:
+                    path[-1] = (pkgID, edgeIndex + 1)
+                    depPkgID = self.targets[edgeIndex]
+                    if depPkgID not in selectedIDs:
+                        continue
+                    if depPkgID not in indices:
+                        indices[depPkgID] = lowLinks[depPkgID] = len(indices)
+                        stack.append(depPkgID)
+                        onStack.add(depPkgID)
+                        path.append((depPkgID, self.indptr[depPkgID]))
+                    elif depPkgID in onStack:
+                        lowLinks[pkgID] = min(lowLinks[pkgID], indices[depPkgID])
+                    continue
+                path.pop()
+                if len(path) > 0:
+                    lowLinks[path[-1][0]] = min(lowLinks[path[-1][0]], lowLinks[pkgID])
+                if lowLinks[pkgID] == indices[pkgID]:
+                    component = list()
+                    while True:
+                        memberID = stack.pop()
+                        onStack.discard(memberID)
+                        component.append(memberID)
+                        if memberID == pkgID:
+                            break
+                    components.append(component)
+        return components
+
+    def stronglyConnectedComponents(self, names):
+        """
+            Replaces nx.strongly_connected_components(graph.subgraph(names)) in topological order of nx.condensation.
+        :param names: iterable of names
+        :return: list of components (lists of names), every component follows the components it depends on
+        """
+        return [[self.names[pkgID] for pkgID in component]
+                for component in self.componentIDs(self.nodeIDs[name] for name in names)]
+
+    #
+    # graph operations
+    #
+
+    def subgraphFromIDs(self, pkgIDs):
+        """
+        :param pkgIDs: iterable of package ids
+        :return: new PackageGraph induced by the given packages (packages keep their relative order)
+        """
+        self.compact()
+        selectedIDs = sorted(set(pkgIDs))
+        graph = PackageGraph()
+        newIDs = dict()
+        for pkgID in selectedIDs:
+            newIDs[pkgID] = graph.add_node(self.names[pkgID], self.nodeDataFromID(pkgID))
+        for pkgID in selectedIDs:
+            for edgeIndex in range(self.indptr[pkgID], self.indptr[pkgID + 1]):
+                depPkgID = self.targets[edgeIndex]
+                if depPkgID in newIDs:
+                    graph.pendingEdges.append((newIDs[pkgID], newIDs[depPkgID],
+                                               self.constraints[edgeIndex],
+                                               graph.intern(self.string(self.operatorIDs[edgeIndex])),
+                                               graph.intern(self.string(self.edgeVersionIDs[edgeIndex]))))
+        graph.compact()
+        return graph
+
+    def subgraph(self, names):
+        """
+        :param names: iterable of package names, names that do not exist are ignored (same as networkx)
+        :return: new PackageGraph induced by the given packages
+        """
+        return self.subgraphFromIDs(self.nodeIDs[name] for name in names if name in self.nodeIDs)
+
+    def copy(self):
+        return self.subgraphFromIDs(range(len(self.names)))
+
+    def addGraph(self, other, keepAttributes=False):
+        """
+            Merges other into this graph in place, attributes of other take precedence unless keepAttributes is set.
+            Parallel edges are merged as in nx.compose: for each pair of packages the edges of other are kept and
+            the surplus edges of this graph are appended.
+        :param PackageGraph other:
+        :param keepAttributes: keep the attributes of packages and edges that exist in both graphs
+                               (nx.compose(other, self))
+        """
+        self.compact()
+        other.compact()
+        existingEdges = dict()  # in the form of {(pkgID, depPkgID): [edgeIndex]}
+        for pkgID in range(len(self.names)):
+            for edgeIndex in range(self.indptr[pkgID], self.indptr[pkgID + 1]):
+                existingEdges.setdefault((pkgID, self.targets[edgeIndex]), []).append(edgeIndex)
+
+        newIDs = [self.nodeIDs[other.names[pkgID]] if keepAttributes and other.names[pkgID] in self.nodeIDs
+                  else self.add_node(other.names[pkgID], other.nodeDataFromID(pkgID))
+                  for pkgID in range(len(other.names))]
+        seenEdges = dict()
+        for pkgID in range(len(other.names)):
+            for edgeIndex in range(other.indptr[pkgID], other.indptr[pkgID + 1]):
+                edge = (newIDs[pkgID], newIDs[other.targets[edgeIndex]])
+                seenEdges[edge] = seenEdges.get(edge, 0) + 1
+                # edge with same key already exists, its attributes are replaced by those of other
+                if seenEdges[edge] <= len(existingEdges.get(edge, [])):
+                    if not keepAttributes:
+                        existingIndex = existingEdges[edge][seenEdges[edge] - 1]
+                        self.constraints[existingIndex] = other.constraints[edgeIndex]
+                        self.operatorIDs[existingIndex] = self.intern(other.string(other.operatorIDs[edgeIndex]))
+                        self.edgeVersionIDs[existingIndex] = self.intern(other.string(other.edgeVersionIDs[edgeIndex]))
+                    continue
+                self.pendingEdges.append((edge[0], edge[1],
+                                          other.constraints[edgeIndex],
+                                          self.intern(other.string(other.operatorIDs[edgeIndex])),
+                                          self.intern(other.string(other.edgeVersionIDs[edgeIndex]))))
+        self.compact()
+
+    @staticmethod
+    def compose(graph1, graph2):
+        """
+            Replaces nx.compose(graph1, graph2), attributes of graph2 take precedence.
+        :return: new PackageGraph
+        """
+        graph = graph1.copy()
+        graph.addGraph(graph2)
+        return graph
+
+    #
+    # conversion and serialization
+    #
+
+    @staticmethod
+    def fromNetworkX(nxGraph):
+        graph = PackageGraph()
+        graph.add_nodes_from(nxGraph.nodes(data=True))
+        graph.add_edges_from(nxGraph.edges(data=True))
+        graph.compact()
+        return graph
+
+    def toNetworkX(self):
+        nxGraph = nx.MultiDiGraph()
+        nxGraph.add_nodes_from(self.nodes(data=True))
+        nxGraph.add_edges_from(self.edges(data=True))
+        return nxGraph
+
+    @staticmethod
+    def readPickle(graphFileName):
+        """
+            Loads a graph saved with writePickle. Graphs that were saved as networkx graphs are converted.
+        :param graphFileName:
+        :return: PackageGraph
+        """
+        with open(graphFileName, "rb") as graphFile:
+            graph = pickle.load(graphFile)
+        if not isinstance(graph, PackageGraph):
+            graph = PackageGraph.fromNetworkX(graph)
+        return graph
+
+    def writePickle(self, graphFileName):
+        with open(graphFileName, "wb") as graphFile:
+            pickle.dump(self, graphFile, pickle.HIGHEST_PROTOCOL)
+
+    def __getstate__(self):
+        self.compact()
+        state = dict()
+        state["names"] = self.names
+        state["strings"] = self.strings
+        for column in PackageGraph.arrayColumns:
+            state[column] = getattr(self, column).tostring()
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.names = state["names"]
+        self.nodeIDs = dict((name, pkgID) for (pkgID, name) in enumerate(self.names))
+        self.strings = state["strings"]
+        self.stringIDs = dict((value, stringID) for (stringID, value) in enumerate(self.strings))
+        for column in PackageGraph.arrayColumns:
+            values = array(getattr(self, column).typecode)
+            values.fromstring(state[column])
+            setattr(self, column, values)
@@ -0,0 +1,111 @@
+import errno
+import hashlib
+import os
+
+from StaticInfo import StaticInfo
+
+
+class PackageStore:
+    """
+        Content-addressed store for package files. Every distinct content is kept once as blob named by its SHA-256
+        (StaticInfo.relPathLocalRepositoryPackageBlobs/<first two hex digits>/<sha256>). The package files in the
+        distribution folders are hard links to these blobs, byte-identical packages (e.g. architecture independent
+        packages of several distributions or repackaged files with identical payload) therefore occupy disk space once.
+        The link count of a blob is its reference count, a blob with a single link is no longer referenced.
+    """
+
+    @staticmethod
+    def computeChecksum(path):
+        """
+        :return: SHA-256 hex digest of the file at path
+        """
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as packageFile:
+            while True:
+                chunk = packageFile.read(StaticInfo.exportStreamChunkSize)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def getBlobPath(checksum):
+        return StaticInfo.relPathLocalRepositoryPackageBlobs + "/" + checksum[:2] + "/" + checksum
+
+    @staticmethod
+    def store(path, checksum=None):
+        """
+            Adds the package file at path to the store. If a blob with the same content exists, the file is replaced
+            by a hard link to it, otherwise the file becomes the blob of its content.
+        :param path: package file inside the local repository
+        :param checksum: SHA-256 of the file if already known (e.g. computed while exporting it)
+        :return: checksum of the file
+        """
+        if checksum is None:
+            checksum = PackageStore.computeChecksum(path)
+        blobPath = PackageStore.getBlobPath(checksum)
+        if not os.path.isdir(os.path.dirname(blobPath)):
+            try:
+                os.makedirs(os.path.dirname(blobPath))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            os.link(path, blobPath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not os.path.samefile(path, blobPath):
+                # replaced through a temporary link, the package file exists at any time
+                tempPath = path + ".link"
+                os.link(blobPath, tempPath)
+                os.rename(tempPath, path)
+        return checksum
+
+    @staticmethod
+    def resolve(path, checksum):
+        """
+            Returns a path to the content of a stored package. A package file that was removed from its distribution
+            folder is restored from its blob.
+        :param path: file name of the package as recorded in the repository database
+        :param checksum: recorded SHA-256 of the package, None for packages stored before checksums were recorded
+        :return: path, None if neither the file nor its blob exists
+        """
+        if os.path.isfile(path):
+            return path
+        if checksum is not None and os.path.isfile(PackageStore.getBlobPath(checksum)):
+            os.link(PackageStore.getBlobPath(checksum), path)
+            return path
+        return None
+
+    @staticmethod
+    def getStorageSizes():
+        """
+        :return: tuple (logicalSize, physicalSize) of all package files, logicalSize counts every package file,
+                 physicalSize every blob (i.e. every distinct content) once
+        """
+        logicalSize = 0
+        physicalSize = 0
+        blobFolder = os.path.abspath(StaticInfo.relPathLocalRepositoryPackageBlobs)
+        seenInodes = set()
+        for dirpath, dirnames, filenames in os.walk(StaticInfo.relPathLocalRepositoryPackages):
+            if os.path.abspath(dirpath) == blobFolder:
+                dirnames[:] = []
+                continue
+            for filename in filenames:
+                stat = os.stat(os.path.join(dirpath, filename))
+                logicalSize = logicalSize + stat.st_size
+                if (stat.st_dev, stat.st_ino) not in seenInodes:
+                    seenInodes.add((stat.st_dev, stat.st_ino))
+                    physicalSize = physicalSize + stat.st_size
+        return (logicalSize, physicalSize)
+
+    @staticmethod
+    def getDedupRatio():
+        """
+        :return: logical size of all package files divided by the disk space they occupy, None without packages
+        """
+        (logicalSize, physicalSize) = PackageStore.getStorageSizes()
+        if physicalSize == 0:
+            return None
+        return float(logicalSize) / physicalSize
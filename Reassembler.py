@@ -1,19 +1,80 @@
 import sys
 import os
+import Queue
+import multiprocessing
 import shutil
+import threading
 import time
+from collections import deque
 
+from Evaluation import ReassemblingEvaluation
 from GuestFSHelper import GuestFSHelper
+from PackageStore import PackageStore
 from RepositoryDatabase import RepositoryDatabase
 from StaticInfo import StaticInfo
 from VMIManipulation import VMIManipulator
 from VMIDescription import BaseImageDescriptor
 
 
+class ReassemblyResult:
+    """
+        Outcome of the reassembly of one VMI of a batch.
+    """
+    def __init__(self, vmiName):
+        self.vmiName = vmiName
+        self.pathToVMI = None
+        self.reassemblingTime = None
+        self.evalReassembly = None
+        # error message if the reassembly failed
+        self.error = None
+
+
+def reassembleTask(task):
+    """
+        Reassembles one VMI of a batch, module level function so that worker processes can run it.
+    :param task: tuple (vmiName, evaluate, flatten)
+    :return: ReassemblyResult
+    """
+    (vmiName, evaluate, flatten) = task
+    result = ReassemblyResult(vmiName)
+    result.evalReassembly = ReassemblingEvaluation(None) if evaluate else None
+    startTime = time.time()
+    try:
+        result.pathToVMI = Reassembler.reassemble(vmiName, evalReassembly=result.evalReassembly, flatten=False)
+        # a standalone image was asked for, the worker process must not exit before it is complete
+        if flatten and GuestFSHelper.getBackingFile(result.pathToVMI) is not None:
+            flattenStartTime = time.time()
+            flattened = Reassembler.flattenOverlay(result.pathToVMI)
+            if result.evalReassembly is not None:
+                result.evalReassembly.flattenTime = time.time() - flattenStartTime
+                if flattened:
+                    result.evalReassembly.reassemblyMode = "flattened overlay"
+    except (SystemExit, Exception) as e:
+        result.error = str(e)
+    result.reassemblingTime = time.time() - startTime
+    return result
+
+
 class Reassembler:
+    # background threads flattening overlays, in the form of {pathToVMI:thread}
+    flattenThreads = dict()
+    flattenThreadsLock = threading.Lock()
 
     @staticmethod
-    def reassemble(vmiName, evalReassembly=None):
+    def reassemble(vmiName, evalReassembly=None, useOverlay=None, flatten=None):
+        """
+        :param vmiName:
+        :param evalReassembly:
+        :param useOverlay: create the VMI as qcow2 overlay backed by its base image instead of a full copy,
+                           default is StaticInfo.reassemblyUseOverlays
+        :param flatten: flatten the overlay into a standalone image in the background,
+                        default is StaticInfo.reassemblyFlattenOverlays
+        :return: path to the reassembled VMI
+        """
+        if useOverlay is None:
+            useOverlay = StaticInfo.reassemblyUseOverlays
+        if flatten is None:
+            flatten = StaticInfo.reassemblyFlattenOverlays
         # TODO: reset image
         print "\n=== Reassemble VMI \"" + vmiName + "\""
 
@@ -35,7 +96,8 @@ class Reassembler:
             sys.exit("Error while reassembling: Compressed User Directory \"%s\" does not exist" % userDirPath)
 
 
-        format = baseImage.pathToVMI.split(".")[-1]
+        # overlays are always qcow2
+        format = "qcow2" if useOverlay else baseImage.pathToVMI.split(".")[-1]
         if vmiName.endswith(".qcow2") or vmiName.endswith(".img"):
             pathToVMI = StaticInfo.relPathLocalVMIFolder + "/" + vmiName.rsplit(".",1)[0] + "." + format
         else:
@@ -45,39 +107,57 @@ class Reassembler:
             sys.exit("Error while reassembling VMI \"%s\". \"%s\" already exists. Was it reassembled before?" % (vmiName, pathToVMI))
 
 
-        print "Copy of Base Image is being created..."
-        startTime = time.time()
-        shutil.copy(baseImage.pathToVMI, pathToVMI)
-        copyTime = time.time() - startTime
-
-        # Reset Image
-        startTime = time.time()
-        VMIManipulator.resetImage(pathToVMI)
-        resetTime = time.time() - startTime
-
-        # Create handler
-        startTime = time.time()
-        print ('Creating GuestFS Handle...')
-        (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
-        handlerCreationTime = time.time() - startTime
-
-        manipulator = VMIManipulator.getVMIManipulator(pathToVMI, vmiName, guest, root)
-        selinux = manipulator.checkSELinux()
-
-
-        # Import Home
-        manipulator.importHomeDir(userDirPath)
-
-        # Import Packages
-        startTime = time.time()
-        errorString = Reassembler.importPackages(manipulator, baseImage, mainServices, packageInfoDict, evalReassembly=evalReassembly)
-        importTime = time.time() - startTime
-
-        GuestFSHelper.shutdownHandle(guest)
-
-        # Relabel SELinux filesystem
-        if selinux:
-            VMIManipulator.relabelSELinux(pathToVMI)
+        # a partially reassembled VMI is removed, it would block the next reassembly of vmiName
+        succeeded = False
+        try:
+            startTime = time.time()
+            if useOverlay:
+                print "Overlay of Base Image is being created..."
+                GuestFSHelper.createOverlay(baseImage.pathToVMI, pathToVMI)
+            else:
+                print "Copy of Base Image is being created..."
+                shutil.copy(baseImage.pathToVMI, pathToVMI)
+            copyTime = time.time() - startTime
+
+            # Create handler, reset, import and relabel are done within this single guestfs session
+            startTime = time.time()
+            print ('Creating GuestFS Handle...')
+            (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
+            handlerCreationTime = time.time() - startTime
+            try:
+                manipulator = VMIManipulator.getVMIManipulator(pathToVMI, vmiName, guest, root)
+                selinux = manipulator.checkSELinux()
+
+                # Reset Image
+                startTime = time.time()
+                manipulator.resetGuest()
+                resetTime = time.time() - startTime
+
+
+                # Import Home
+                manipulator.importHomeDir(userDirPath)
+
+                # Import Packages
+                startTime = time.time()
+                errorString = Reassembler.importPackages(manipulator, baseImage, mainServices, packageInfoDict, evalReassembly=evalReassembly)
+                importTime = time.time() - startTime
+
+                # Relabel SELinux filesystem
+                startTime = time.time()
+                if selinux:
+                    manipulator.relabelSELinux()
+                relabelTime = time.time() - startTime
+            finally:
+                GuestFSHelper.shutdownHandle(guest)
+            succeeded = True
+        finally:
+            if not succeeded and os.path.isfile(pathToVMI):
+                os.remove(pathToVMI)
+
+        if useOverlay:
+            # keeps the base image on disk while the overlay exists, even if the base image is replaced
+            with RepositoryDatabase() as repoManager:
+                repoManager.addBaseImageOverlay(pathToVMI, baseImage.pathToVMI)
 
         if errorString is None:
             print "\nReassembling finished."
@@ -93,20 +173,227 @@ class Reassembler:
             print "\t           Log saved in: \"%s\"" % logFileName
             print "\t           VMI saved in: \"%s\"" % pathToVMI
 
+        if useOverlay and flatten:
+            print "\tVMI is flattened into a standalone image in the background."
+            Reassembler.startFlatten(pathToVMI)
+
         if evalReassembly is not None:
             evalReassembly.vmiFilename = pathToVMI.rsplit("/",1)[-1]
             evalReassembly.vmiMainServices = mainServices
             evalReassembly.pathToBase = baseImage.pathToVMI.rsplit("/",1)[-1]
             evalReassembly.baseImageSize = os.path.getsize(baseImage.pathToVMI)
+            # time to create the copy or the overlay, flattening is measured separately (flattenTime)
             evalReassembly.copyTime = copyTime
+            evalReassembly.reassemblyMode = "overlay" if useOverlay else "copy"
             evalReassembly.resetTime = resetTime
             evalReassembly.importTime = importTime
+            evalReassembly.relabelTime = relabelTime
             evalReassembly.handlerCreationTime = handlerCreationTime
             if errorString is not None:
                 evalReassembly.info = "\"/dev/pts\" error while reassembling, check manually."
 
         return pathToVMI
 
+    @staticmethod
+    def reassembleBatch(vmiNames, numWorkers=None, evaluate=False, flatten=None):
+        """
+            Reassembles several VMIs in up to numWorkers worker processes in parallel.
+            VMIs are grouped by base image, so that VMIs sharing a base image (and mostly their packages) run close
+            to each other while the base image and its package files are still in the page cache.
+            A reassembly only starts if the free disk space in StaticInfo.relPathLocalVMIFolder and the available
+            memory suffice for it next to the reassemblies already running (admission control),
+            see getRequiredDiskSpace and StaticInfo.guestfsApplianceMemory.
+            VMIs whose reassembly fails are reported and skipped.
+        :param list() vmiNames:
+        :param numWorkers: number of worker processes, default is StaticInfo.reassemblyWorkers
+        :param evaluate: if True, each ReassemblyResult holds a ReassemblingEvaluation of its VMI
+        :param flatten: flatten overlays into standalone images before their results are reported,
+                        default is StaticInfo.reassemblyFlattenOverlays
+        :return: generator of ReassemblyResults in the order the reassemblies finish
+        """
+        if numWorkers is None:
+            numWorkers = StaticInfo.reassemblyWorkers
+        if flatten is None:
+            flatten = StaticInfo.reassemblyFlattenOverlays
+        with RepositoryDatabase() as repoManager:
+            baseImageFileNames = repoManager.getBaseImageFileNamesOfVMIs()
+        order = dict((vmiName, index) for (index, vmiName) in enumerate(vmiNames))
+        vmiNames = sorted(vmiNames, key=lambda vmiName: (baseImageFileNames.get(vmiName), order[vmiName]))
+
+        if numWorkers <= 1 or len(vmiNames) <= 1:
+            GuestFSHelper.warmUpPool()
+            for vmiName in vmiNames:
+                yield Reassembler.reportResult(reassembleTask((vmiName, evaluate, flatten)))
+            return
+
+        pendingVMIs = deque(vmiNames)
+        runningVMIs = dict()  # in the form of {vmiName:required disk space}
+        finishedResults = Queue.Queue()
+        workerPool = multiprocessing.Pool(min(numWorkers, len(vmiNames)), initializer=GuestFSHelper.resetAfterFork)
+        try:
+            while len(pendingVMIs) > 0 or len(runningVMIs) > 0:
+                while len(pendingVMIs) > 0 and len(runningVMIs) < numWorkers:
+                    vmiName = pendingVMIs[0]
+                    requiredDiskSpace = Reassembler.getRequiredDiskSpace(baseImageFileNames.get(vmiName), flatten)
+                    # a reassembly is always started if none is running, it would never start otherwise
+                    if len(runningVMIs) > 0 and not Reassembler.admit(requiredDiskSpace, runningVMIs.values()):
+                        break
+                    pendingVMIs.popleft()
+                    runningVMIs[vmiName] = requiredDiskSpace
+                    workerPool.apply_async(reassembleTask, ((vmiName, evaluate, flatten),), callback=finishedResults.put)
+                # waiting with timeout, a blocking get cannot be interrupted
+                while True:
+                    try:
+                        result = finishedResults.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        pass
+                del runningVMIs[result.vmiName]
+                yield Reassembler.reportResult(result)
+            workerPool.close()
+        except BaseException:
+            workerPool.terminate()
+            raise
+        finally:
+            workerPool.join()
+
+    @staticmethod
+    def reportResult(result):
+        if result.error is not None:
+            print "\nReassembly of VMI \"%s\" failed and is skipped:\n\t%s" % (result.vmiName, result.error)
+        else:
+            print "\nVMI \"%s\" reassembled in %.1fs: \"%s\"" % (result.vmiName, result.reassemblingTime,
+                                                                 result.pathToVMI)
+        return result
+
+    @staticmethod
+    def getRequiredDiskSpace(baseImageFileName, flatten):
+        """
+        :param flatten: True if the reassembled VMI is flattened into a standalone image
+        :return: disk space the reassembly of a VMI based on baseImageFileName is expected to need [bytes]
+        """
+        requiredDiskSpace = StaticInfo.reassemblyDiskReserve
+        if baseImageFileName is not None and os.path.isfile(baseImageFileName) and \
+                (not StaticInfo.reassemblyUseOverlays or flatten):
+            requiredDiskSpace = requiredDiskSpace + os.path.getsize(baseImageFileName)
+        return requiredDiskSpace
+
+    @staticmethod
+    def admit(requiredDiskSpace, runningRequiredDiskSpaces):
+        """
+            Admission control for parallel reassemblies: the disk space and memory still needed by running
+            reassemblies are estimated by their full requirement, appliances of admitted reassemblies may not have
+            been launched yet.
+        :param requiredDiskSpace: disk space required by the reassembly to start [bytes]
+        :param runningRequiredDiskSpaces: disk spaces required by the running reassemblies [bytes]
+        :return: True if the reassembly can start now
+        """
+        stat = os.statvfs(StaticInfo.relPathLocalVMIFolder)
+        freeDiskSpace = stat.f_bavail * stat.f_frsize
+        if freeDiskSpace < requiredDiskSpace + sum(runningRequiredDiskSpaces):
+            return False
+        availableMemory = Reassembler.getAvailableMemory()
+        requiredMemory = (len(runningRequiredDiskSpaces) + 1) * StaticInfo.guestfsApplianceMemory * 1024 * 1024
+        if availableMemory is not None and availableMemory < requiredMemory:
+            return False
+        return True
+
+    @staticmethod
+    def getAvailableMemory():
+        """
+        :return: memory available for new processes [bytes], None if unknown
+        """
+        try:
+            with open("/proc/meminfo") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except IOError:
+            pass
+        return None
+
+    @staticmethod
+    def getInstallLayers(graph, packageNames):
+        """
+            Orders packages for an installation without dependency resolution: every package is installed in a later
+            layer than the packages it depends on, packages depending on each other (cycles) share a layer.
+            Dependencies on packages outside of packageNames are assumed to be installed already.
+            Layers with more than StaticInfo.directInstallBatchSize packages are split without splitting cycles.
+        :param graph: graph containing the dependencies between the packages (e.g. master graph)
+        :param packageNames:
+        :return: list of layers, i.e. lists of package names
+        """
+        packageNames = set(packageNames)
+        # strongly connected components (cycles) are installed by the same call, components follow their dependencies
+        components = graph.stronglyConnectedComponents(pkgName for pkgName in packageNames if pkgName in graph)
+        components.extend([pkgName] for pkgName in packageNames if pkgName not in graph)
+        componentIndices = dict()
+        depths = list()
+        for (index, component) in enumerate(components):
+            for pkgName in component:
+                componentIndices[pkgName] = index
+            depth = 0
+            for pkgName in component:
+                if pkgName in graph:
+                    for depPkgName in graph.successors(pkgName):
+                        depIndex = componentIndices.get(depPkgName)
+                        if depIndex is not None and depIndex != index:
+                            depth = max(depth, depths[depIndex] + 1)
+            depths.append(depth)
+
+        layers = []
+        for depth in range(max(depths) + 1 if len(depths) > 0 else 0):
+            layer = []
+            for componentMembers in sorted(sorted(component) for (index, component) in enumerate(components)
+                                           if depths[index] == depth):
+                if len(layer) > 0 and len(layer) + len(componentMembers) > StaticInfo.directInstallBatchSize:
+                    layers.append(layer)
+                    layer = []
+                layer.extend(componentMembers)
+            if len(layer) > 0:
+                layers.append(layer)
+        return layers
+
+    @staticmethod
+    def flattenOverlay(pathToVMI):
+        """
+            Replaces the qcow2 overlay at pathToVMI by a standalone qcow2 image with the same content, the overlay
+            stays in place until the standalone image is complete.
+        :param pathToVMI:
+        :return: True if the overlay was flattened
+        """
+        pathToFlatVMI = pathToVMI + ".flat"
+        if not GuestFSHelper.flattenImage(pathToVMI, pathToFlatVMI):
+            print "\tOverlay \"%s\" is kept, its base image is kept on disk as long as the overlay exists." % pathToVMI
+            return False
+        os.rename(pathToFlatVMI, pathToVMI)
+        # the base image of the overlay may have been replaced in the meantime
+        with RepositoryDatabase() as repoManager:
+            repoManager.removeUnusedBaseImageFiles()
+        return True
+
+    @staticmethod
+    def startFlatten(pathToVMI):
+        with Reassembler.flattenThreadsLock:
+            thread = threading.Thread(target=Reassembler.flattenOverlay, args=(pathToVMI,),
+                                      name="flatten " + pathToVMI)
+            Reassembler.flattenThreads[pathToVMI] = thread
+            thread.start()
+
+    @staticmethod
+    def waitForFlatten(pathToVMI=None):
+        """
+            Blocks until the background flattening of pathToVMI (or of all overlays) has finished.
+        """
+        with Reassembler.flattenThreadsLock:
+            if pathToVMI is None:
+                threads = Reassembler.flattenThreads.values()
+            else:
+                threads = [Reassembler.flattenThreads.get(pathToVMI)]
+        for thread in threads:
+            if thread is not None:
+                thread.join()
+
 
     @staticmethod
     def importPackages(manipulator, baseImage, mainServices, packageInfoDict, evalReassembly=None):
@@ -117,7 +404,7 @@ class Reassembler:
 
         # Filter which packages already exist in VMI
         vmiPackageDict = baseImage.getNodeData()
-        reqPackagesFileNames = list()
+        reqPackages = list()    # in the form of [(name, version, architecture)]
 
         for pkgName,pkgInfo in packageInfoDict.iteritems():
             if not (
@@ -125,10 +412,21 @@ class Reassembler:
                     vmiPackageDict[pkgName][StaticInfo.dictKeyVersion] == pkgInfo[StaticInfo.dictKeyVersion] and
                     vmiPackageDict[pkgName][StaticInfo.dictKeyArchitecture] == pkgInfo[StaticInfo.dictKeyArchitecture]
                 ):
-                reqPackagesFileNames.append(pkgInfo[StaticInfo.dictKeyFilePath])
+                reqPackages.append((pkgName, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture]))
                 reqPkgsSize = reqPkgsSize + int(pkgInfo[StaticInfo.dictKeyInstallSize])
             allPkgsSize = allPkgsSize + int(pkgInfo[StaticInfo.dictKeyInstallSize])
 
+        # Look up package files of required packages in local repository
+        with RepositoryDatabase() as repoManager:
+            storedPackages = repoManager.getExistingPackages(reqPackages, baseImage.distribution, withChecksums=True)
+        reqPackagesFileNames = [PackageStore.resolve(*storedPackages[pkg]) if pkg in storedPackages else None
+                                for pkg in reqPackages]
+        reqPackagesChecksums = [storedPackages[pkg][1] if pkg in storedPackages else None for pkg in reqPackages]
+        missingPackages = [pkg for (pkg, fileName) in zip(reqPackages, reqPackagesFileNames) if fileName is None]
+        if len(missingPackages) > 0:
+            sys.exit("Error: Cannot import packages, not found in repository:\n\t" +
+                     "\n\t".join(" ".join(pkg) for pkg in missingPackages))
+
         reqPkgNum = len(reqPackagesFileNames)
         print "Package Import:\n\t" \
               "Main Service(s):\t\t\t%s\n\t" \
@@ -137,7 +435,17 @@ class Reassembler:
               "Package(s) to be imported:\t%i" \
               % (",".join(mainServices), allPkgsNum, allPkgsNum - reqPkgNum, reqPkgNum)
 
-        errorString = manipulator.importPackages(mainServices, reqPackagesFileNames)
+        installLayers = None
+        if StaticInfo.reassemblyDirectInstall and reqPkgNum > 0:
+            with RepositoryDatabase() as repoManager:
+                master = repoManager.getVMIMasterDescriptorForVMI(manipulator.vmiName)
+            if master is not None:
+                fileNames = dict((pkg[0], fileName) for (pkg, fileName) in zip(reqPackages, reqPackagesFileNames))
+                installLayers = [[fileNames[pkgName] for pkgName in layer]
+                                 for layer in Reassembler.getInstallLayers(master.graph, fileNames.keys())]
+
+        errorString = manipulator.importPackages(mainServices, reqPackagesFileNames, reqPackagesChecksums,
+                                                 installLayers=installLayers)
 
         if evalReassembly is not None:
 
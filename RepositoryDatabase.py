@@ -1,37 +1,143 @@
+import atexit
 import os
 import sys
 import shutil
 import sqlite3
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 
+from GraphFile import GraphFile
+from GuestFSHelper import GuestFSHelper
+from MasterGraphIndex import MasterGraphIndex
+from PackageStore import PackageStore
 from StaticInfo import StaticInfo
 from VMIDescription import BaseImageDescriptor, VMIMasterDescriptor
 
+
+class RepositorySession:
+    """
+        Connection to the repository database that is shared by all RepositoryDatabase instances of a thread.
+        Stays open until the database file is removed or closeSessions is called.
+    """
+    pragmas = ["PRAGMA journal_mode=WAL",
+               "PRAGMA synchronous=NORMAL",
+               "PRAGMA temp_store=MEMORY",
+               "PRAGMA cache_size=-16384"]
+
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        # connections are only used by the thread that opened them, but may be closed by any thread
+        self.db = sqlite3.connect(dbFile, timeout=30, check_same_thread=False)
+        for pragma in RepositorySession.pragmas:
+            self.db.execute(pragma)
+        self.transactionDepth = 0
+
+    def close(self):
+        self.db.close()
+
+
 class RepositoryDatabase:
+    # open sessions in the form of {(absolute path of database, process id, thread id):RepositorySession}
+    sessions = dict()
+    sessionsLock = threading.Lock()
+    # serializes creating and migrating the schema, which may take long and must not block sessionsLock
+    schemaLock = threading.Lock()
+
     def __init__(self,forceNew=False):
         self.dbFile = StaticInfo.relPathLocalRepositoryDatabase
         self.forceNew = forceNew
+        self.session = None
         self.db = None
         self.cursor = None
 
     def __enter__(self):
-        if self.forceNew:
-            if os.path.exists(self.dbFile):
-                os.remove(self.dbFile)
-            self.db = sqlite3.connect(self.dbFile)
+        key = (os.path.abspath(self.dbFile), os.getpid(), threading.current_thread().ident)
+        isNewSession = False
+        with RepositoryDatabase.sessionsLock:
+            self.session = RepositoryDatabase.sessions.get(key)
+            if self.session is not None and (self.forceNew or not os.path.exists(self.dbFile)):
+                # database is replaced or has been removed (e.g. repository reset)
+                RepositoryDatabase.sessions.pop(key).close()
+                self.session = None
+            if self.session is None:
+                if self.forceNew:
+                    for fileName in [self.dbFile, self.dbFile + "-wal", self.dbFile + "-shm"]:
+                        if os.path.exists(fileName):
+                            os.remove(fileName)
+                self.session = RepositorySession(self.dbFile)
+                RepositoryDatabase.sessions[key] = self.session
+                isNewSession = True
+            self.db = self.session.db
             self.cursor = self.db.cursor()
-            self.initDB()
-        elif os.path.exists(self.dbFile):
-            self.db = sqlite3.connect(self.dbFile)
-            self.cursor = self.db.cursor()
-        else:
-            self.db = sqlite3.connect(self.dbFile)
-            self.cursor = self.db.cursor()
-            self.initDB()
+        if isNewSession:
+            # the session belongs to this thread only, other threads can open theirs in the meantime
+            try:
+                with RepositoryDatabase.schemaLock:
+                    self.cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='PackageRepository'")
+                    if self.cursor.fetchone()[0] == 0:
+                        self.initDB()
+                    else:
+                        self.migrateDB()
+                self.initSession()
+            except BaseException:
+                with RepositoryDatabase.sessionsLock:
+                    if RepositoryDatabase.sessions.get(key) is self.session:
+                        RepositoryDatabase.sessions.pop(key)
+                self.cursor.close()
+                self.session.close()
+                raise
         return self
 
-    def __exit__(self, *args):
-        self.db.close()
+    def __exit__(self, excType, excValue, traceback):
+        # same as closing a connection: changes that were not committed are discarded
+        if excType is not None and self.session.transactionDepth == 0:
+            self.db.rollback()
+        self.cursor.close()
+
+    @staticmethod
+    def closeSessions():
+        """
+            Closes all connections of this process, has to be called before the database file is removed.
+        """
+        with RepositoryDatabase.sessionsLock:
+            for key in list(RepositoryDatabase.sessions.keys()):
+                if key[1] == os.getpid():
+                    RepositoryDatabase.sessions.pop(key).close()
+
+    @staticmethod
+    def getDatabaseSize():
+        """
+        :return: size of the database file including its write-ahead log [bytes]
+        """
+        dbFile = StaticInfo.relPathLocalRepositoryDatabase
+        return sum(os.path.getsize(fileName) for fileName in [dbFile, dbFile + "-wal"] if os.path.exists(fileName))
+
+    @contextmanager
+    def transaction(self):
+        """
+            Unit of work: all changes made inside are committed at once when the outermost transaction ends
+            and are rolled back if an exception (including SystemExit) leaves it. Transactions can be nested.
+            Must not contain schema changes, those commit implicitly.
+        """
+        self.session.transactionDepth = self.session.transactionDepth + 1
+        try:
+            yield self
+        except BaseException:
+            self.session.transactionDepth = self.session.transactionDepth - 1
+            if self.session.transactionDepth == 0:
+                self.db.rollback()
+            raise
+        self.session.transactionDepth = self.session.transactionDepth - 1
+        if self.session.transactionDepth == 0:
+            self.db.commit()
+
+    def commit(self):
+        """
+            Commits the changes unless a transaction is open, these are committed when the transaction ends.
+        """
+        if self.session.transactionDepth == 0:
+            self.db.commit()
 
     def initDB(self):
         self.cursor.execute('''
@@ -73,10 +179,184 @@ class RepositoryDatabase:
                 graphPath     TEXT    NOT NULL,
                 masterGraphPath TEXT  NOT NULL);
                 ''')
-        self.db.commit()
+        self.commit()
+        self.migrateDB()
         self.addPackageDict(StaticInfo.basicPackagesDictFedora, "fedora")
 
+    def initSession(self):
+        # connection specific table for bulk lookups, see getExistingPackages
+        self.cursor.execute('''
+            CREATE TEMPORARY TABLE IF NOT EXISTS PackageLookup(
+                name          TEXT    NOT NULL,
+                version       TEXT    NOT NULL,
+                architecture  TEXT    NOT NULL)
+        ''')
+        self.commit()
+
+    def migrateDB(self):
+        """
+            Upgrades the schema of the database in place to the latest version.
+            The schema version is stored in "PRAGMA user_version", databases created by initDB start at version 0.
+            Every migration is idempotent, an interrupted upgrade can therefore be repeated.
+        """
+        migrations = [self.migrateToVersion1, self.migrateToVersion2, self.migrateToVersion3,
+                      self.migrateToVersion4, self.migrateToVersion5, self.migrateToVersion6]
+        self.cursor.execute("PRAGMA user_version")
+        schemaVersion = self.cursor.fetchone()[0]
+        for newSchemaVersion in range(schemaVersion + 1, len(migrations) + 1):
+            migrations[newSchemaVersion - 1]()
+            self.cursor.execute("PRAGMA user_version = %i" % newSchemaVersion)
+            self.commit()
+
+    def migrateToVersion1(self):
+        # MinHash signatures of master graphs and their LSH bands, see MasterGraphIndex
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS masterGraphSignatures(
+                baseID          INTEGER PRIMARY KEY,
+                signature       BLOB    NOT NULL,
+                FOREIGN KEY(baseID) REFERENCES baseImageRepository(baseID));
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS masterGraphBands(
+                band            INTEGER NOT NULL,
+                bucket          TEXT    NOT NULL,
+                baseID          INTEGER NOT NULL,
+                FOREIGN KEY(baseID) REFERENCES baseImageRepository(baseID));
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS masterGraphBandsBucket ON masterGraphBands(band, bucket)
+        ''')
+        self.commit()
+
+    def migrateToVersion2(self):
+        # remove duplicate packages (keep the first row, dependencies are redirected to it)
+        self.cursor.execute('''
+            CREATE TEMPORARY TABLE DuplicatePackages AS
+                SELECT p.pkgID AS pkgID, keep.pkgID AS keepID
+                FROM PackageRepository p
+                JOIN (
+                    SELECT min(pkgID) AS pkgID, name, version, architecture, distribution
+                    FROM PackageRepository
+                    GROUP BY name, version, architecture, distribution
+                ) keep
+                ON p.name = keep.name
+                AND p.version = keep.version
+                AND p.architecture = keep.architecture
+                AND p.distribution = keep.distribution
+                WHERE p.pkgID != keep.pkgID
+        ''')
+        self.cursor.execute('''
+            UPDATE PackageDependencies
+            SET pkgID = (SELECT keepID FROM DuplicatePackages WHERE DuplicatePackages.pkgID = PackageDependencies.pkgID)
+            WHERE pkgID IN (SELECT pkgID FROM DuplicatePackages)
+        ''')
+        self.cursor.execute('''
+            UPDATE PackageDependencies
+            SET deppkgID = (SELECT keepID FROM DuplicatePackages WHERE DuplicatePackages.pkgID = PackageDependencies.deppkgID)
+            WHERE deppkgID IN (SELECT pkgID FROM DuplicatePackages)
+        ''')
+        self.cursor.execute('''
+            DELETE FROM PackageRepository
+            WHERE pkgID IN (SELECT pkgID FROM DuplicatePackages)
+        ''')
+        self.cursor.execute("DROP TABLE DuplicatePackages")
+        self.commit()
+
+        self.cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS PackageRepositoryPackage
+            ON PackageRepository(name, version, architecture, distribution)
+        ''')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS PackageDependenciesVmiID ON PackageDependencies(vmiID)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS PackageDependenciesPkgID ON PackageDependencies(pkgID)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS PackageDependenciesDeppkgID ON PackageDependencies(deppkgID)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS vmiRepositoryName ON vmiRepository(name)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS vmiRepositoryBaseImageID ON vmiRepository(baseImageID)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS baseImageRepositoryFilename ON baseImageRepository(filename)")
+        self.commit()
+
+    def migrateToVersion3(self):
+        # summaries of base image and master graphs, descriptors use them instead of loading the graphs
+        self.cursor.execute("PRAGMA table_info(baseImageRepository)")
+        existingColumns = set(str(row[1]) for row in self.cursor.fetchall())
+        for column in ["numPackages", "pkgsInstallSize", "masterNumPackages"]:
+            if column not in existingColumns:
+                self.cursor.execute("ALTER TABLE baseImageRepository ADD COLUMN %s INTEGER" % column)
+        self.commit()
+
+        # summaries of existing base images are computed from their graphs once
+        self.cursor.execute('''
+            SELECT baseID, graphPath, masterGraphPath
+            FROM baseImageRepository
+            WHERE numPackages IS NULL OR pkgsInstallSize IS NULL OR masterNumPackages IS NULL
+            '''
+        )
+        for (baseID, graphPath, masterGraphPath) in self.cursor.fetchall():
+            graph = GraphFile.load(str(graphPath))
+            masterGraph = GraphFile.load(str(masterGraphPath))
+            self.cursor.execute('''
+                UPDATE baseImageRepository
+                SET numPackages = ?, pkgsInstallSize = ?, masterNumPackages = ?
+                WHERE baseID = ?''',
+                (len(graph), sum(graph.installSizes), len(masterGraph), baseID)
+            )
+        self.commit()
+
+    def migrateToVersion4(self):
+        # graphs saved as pickle are converted to graph files, see GraphFile
+        self.cursor.execute('''
+            SELECT baseID, graphPath, masterGraphPath
+            FROM baseImageRepository
+            '''
+        )
+        for (baseID, graphPath, masterGraphPath) in self.cursor.fetchall():
+            newPaths = list()
+            for graphFileName in [str(graphPath), str(masterGraphPath)]:
+                # a pickle is only removed after its graph file exists, a converted graph is never read as pickle
+                if graphFileName.endswith(".pkl"):
+                    newGraphFileName = GraphFile.getGraphFileName(graphFileName)
+                    if os.path.isfile(graphFileName):
+                        GraphFile.convertPickle(graphFileName)
+                    graphFileName = newGraphFileName
+                newPaths.append(graphFileName)
+            self.cursor.execute('''
+                UPDATE baseImageRepository
+                SET graphPath = ?, masterGraphPath = ?
+                WHERE baseID = ?''',
+                tuple(newPaths) + (baseID,)
+            )
+            self.commit()
+
+    def migrateToVersion5(self):
+        # SHA-256 of package files, package files are moved into the content-addressed PackageStore
+        self.cursor.execute("PRAGMA table_info(PackageRepository)")
+        if "checksum" not in set(str(row[1]) for row in self.cursor.fetchall()):
+            self.cursor.execute("ALTER TABLE PackageRepository ADD COLUMN checksum TEXT")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS PackageRepositoryChecksum ON PackageRepository(checksum)")
+        self.commit()
+
+        self.cursor.execute("SELECT pkgID, filename FROM PackageRepository WHERE checksum IS NULL")
+        for (pkgID, filename) in self.cursor.fetchall():
+            if os.path.isfile(str(filename)):
+                checksum = PackageStore.store(str(filename))
+                self.cursor.execute("UPDATE PackageRepository SET checksum = ? WHERE pkgID = ?", (checksum, pkgID))
+        self.commit()
+
+    def migrateToVersion6(self):
+        # VMIs reassembled as overlays of base images and replaced base images that are kept for them
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS baseImageOverlays(
+                overlayPath     TEXT    PRIMARY KEY,
+                baseImagePath   TEXT    NOT NULL);
+        ''')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS baseImageOverlaysBaseImagePath ON baseImageOverlays(baseImagePath)")
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pendingBaseImageRemovals(
+                filename        TEXT    PRIMARY KEY);
+        ''')
+        self.commit()
+
     def initRepo(self):
+        RepositoryDatabase.closeSessions()
         if os.path.exists(StaticInfo.relPathLocalRepository):
             shutil.rmtree(StaticInfo.relPathLocalRepository)
         os.mkdir(StaticInfo.relPathLocalRepositoryPackages)
@@ -174,6 +454,39 @@ class RepositoryDatabase:
                 "\tsolve manually!")
             return result[0][0]
 
+    def getExistingPackages(self, packageKeys, distribution, withChecksums=False):
+        """
+        Checks which of the given packages exist in database with a single query
+        :param packageKeys: iterable of tuples (name, version, architecture)
+        :param distribution:
+        :param withChecksums: if True, the checksum of each package file is returned as well
+        :return: dict in the form of {(name, version, architecture):filename} containing only existing packages,
+                 with checksums in the form of {(name, version, architecture):(filename, checksum)}
+        """
+        self.cursor.execute("DELETE FROM PackageLookup")
+        self.cursor.executemany('''
+            INSERT INTO PackageLookup (name, version, architecture)
+            VALUES (?,?,?)''',
+            packageKeys
+        )
+        self.cursor.execute('''
+            SELECT p.name, p.version, p.architecture, p.filename, p.checksum
+            FROM PackageLookup l
+            JOIN PackageRepository p
+            ON p.name = l.name
+            AND p.version = l.version
+            AND p.architecture = l.architecture
+            AND p.distribution = ?''',
+            (distribution,)
+        )
+        result = self.cursor.fetchall()
+        self.cursor.execute("DELETE FROM PackageLookup")
+        self.commit()
+        if withChecksums:
+            return dict(((str(row[0]), str(row[1]), str(row[2])), (str(row[3]), row[4] and str(row[4])))
+                        for row in result)
+        return dict(((str(row[0]), str(row[1]), str(row[2])), str(row[3])) for row in result)
+
     def getPackageFileNameFromID(self,pkgID):
         self.cursor.execute('''
             SELECT filename FROM PackageRepository
@@ -223,13 +536,15 @@ class RepositoryDatabase:
             pkgInfo[StaticInfo.dictKeyArchitecture],
             distribution,
             pkgInfo[StaticInfo.dictKeyInstallSize],
-            pkgInfo[StaticInfo.dictKeyFilePath]
+            pkgInfo[StaticInfo.dictKeyFilePath],
+            pkgInfo.get(StaticInfo.dictKeyChecksum)
         ) for pkg,pkgInfo in packageInfoDict.iteritems()]
+        # packages that already exist are kept (unique index on name, version, architecture and distribution)
         self.cursor.executemany('''
-                      INSERT INTO PackageRepository(name, version, architecture, distribution, installsize, filename)
-                      VALUES(?,?,?,?,?,?)
+                      INSERT OR IGNORE INTO PackageRepository(name, version, architecture, distribution, installsize, filename, checksum)
+                      VALUES(?,?,?,?,?,?,?)
                   ''', packageInfoList)
-        self.db.commit()
+        self.commit()
 
     def getBaseImageId(self, filename):
         self.cursor.execute('''
@@ -250,16 +565,21 @@ class RepositoryDatabase:
     def addBaseImage(self, baseImage, masterGraphPath):
         # Insert new Base Image
         self.cursor.execute('''
-                        INSERT INTO baseImageRepository (distribution, version,architecture, pkgManager,filename, graphPath, masterGraphPath)
-                        VALUES (?,?,?,?,?,?,?)''',
+                        INSERT INTO baseImageRepository (distribution, version,architecture, pkgManager,filename, graphPath, masterGraphPath,
+                                                         numPackages, pkgsInstallSize, masterNumPackages)
+                        VALUES (?,?,?,?,?,?,?,?,?,?)''',
                             (baseImage.distribution,
                              baseImage.distributionVersion,
                              baseImage.architecture,
                              baseImage.pkgManager,
                              baseImage.pathToVMI,
                              baseImage.graphFileName,
-                             masterGraphPath))
-        self.db.commit()
+                             masterGraphPath,
+                             baseImage.getNumberOfPackages(),
+                             int(baseImage.getPkgsInstallSize()),
+                             # a new master graph is a copy of the base image graph
+                             baseImage.getNumberOfPackages()))
+        self.commit()
         # Return id
         return self.getBaseImageId(baseImage.pathToVMI)
 
@@ -270,7 +590,116 @@ class RepositoryDatabase:
             WHERE baseID = ? 
             ''', (baseID,)
         )
-        self.db.commit()
+        self.removeMasterGraphSignature(baseID)
+        self.commit()
+
+    def updateMasterGraphSummary(self, baseID, master):
+        """
+            Stores the number of packages of the master graph of base image baseID, has to be called whenever
+            the master graph is saved.
+        :param baseID:
+        :param VMIMasterDescriptor master:
+        """
+        self.cursor.execute('''
+            UPDATE baseImageRepository
+            SET masterNumPackages = ?
+            WHERE baseID = ?''',
+            (master.getNumberOfPackages(), baseID)
+        )
+        self.commit()
+
+    def updateMasterGraphSignature(self, baseID, master):
+        """
+            Replaces the MinHash signature and LSH bands of the master graph of base image baseID.
+        :param baseID:
+        :param VMIMasterDescriptor master:
+        """
+        self.removeMasterGraphSignature(baseID)
+        signature = MasterGraphIndex.computeSignature(master.getClosureNodeData(master.mainServices))
+        if signature is None:
+            return
+        self.cursor.execute('''
+            INSERT INTO masterGraphSignatures (baseID, signature)
+            VALUES (?,?)''',
+            (baseID, MasterGraphIndex.signatureToBlob(signature))
+        )
+        self.cursor.executemany('''
+            INSERT INTO masterGraphBands (band, bucket, baseID)
+            VALUES (?,?,?)''',
+            ((band, bucket, baseID) for (band, bucket) in MasterGraphIndex.getBands(signature))
+        )
+        self.commit()
+
+    def removeMasterGraphSignature(self, baseID):
+        self.cursor.execute('''
+            DELETE FROM masterGraphSignatures
+            WHERE baseID = ?''', (baseID,)
+        )
+        self.cursor.execute('''
+            DELETE FROM masterGraphBands
+            WHERE baseID = ?''', (baseID,)
+        )
+        self.commit()
+
+    def indexMissingMasterGraphSignatures(self):
+        """
+            Computes signatures for master graphs without signature (e.g. repositories created before the index existed).
+            Master graphs without main services have no signature and are loaded again on every call.
+        """
+        self.cursor.execute('''
+            SELECT baseID
+            FROM baseImageRepository
+            WHERE baseID NOT IN (SELECT baseID FROM masterGraphSignatures)
+            '''
+        )
+        for (baseID,) in self.cursor.fetchall():
+            master = self.getVMIMasterDescriptorFromBaseID(baseID)
+            if master is not None:
+                self.updateMasterGraphSignature(baseID, master)
+
+    def getCandidateMasterDescriptors(self, vmi, k=None):
+        """
+            Uses the MinHash index to find the master graphs most similar to the main services of vmi.
+            Only master graphs sharing at least one LSH band with vmi are considered, of those the k with the highest
+            estimated similarity are loaded.
+        :param VMIDescriptor vmi:
+        :param k: number of candidates, default is StaticInfo.masterIndexTopK
+        :return: list of VMIMasterDescriptors
+        """
+        if k is None:
+            k = StaticInfo.masterIndexTopK
+        self.indexMissingMasterGraphSignatures()
+        signature = MasterGraphIndex.computeSignature(vmi.getClosureNodeData(vmi.mainServices))
+        if signature is None:
+            return []
+        candidateIDs = set()
+        for (band, bucket) in MasterGraphIndex.getBands(signature):
+            self.cursor.execute('''
+                SELECT baseID
+                FROM masterGraphBands
+                WHERE band = ? AND bucket = ?''',
+                (band, bucket)
+            )
+            candidateIDs.update(row[0] for row in self.cursor.fetchall())
+
+        estimates = list()
+        for baseID in candidateIDs:
+            self.cursor.execute('''
+                SELECT signature
+                FROM masterGraphSignatures
+                WHERE baseID = ?''',
+                (baseID,)
+            )
+            candidateSignature = MasterGraphIndex.signatureFromBlob(self.cursor.fetchone()[0])
+            estimates.append((MasterGraphIndex.estimateSimilarity(signature, candidateSignature), baseID))
+        estimates.sort(reverse=True)
+
+        masterDescriptors = list()
+        for (estimate, baseID) in estimates[:k]:
+            master = self.getVMIMasterDescriptorFromBaseID(baseID)
+            if master is not None:
+                masterDescriptors.append(master)
+        return masterDescriptors
 
     def getVmiID(self,vmiName):
         self.cursor.execute('''
@@ -312,7 +741,7 @@ class RepositoryDatabase:
 
     def getBaseImageInfoForVmiID(self, vmiID):
         self.cursor.execute('''
-                SELECT distribution,version,architecture,pkgManager,filename,graphPath
+                SELECT distribution,version,architecture,pkgManager,filename,graphPath,numPackages,pkgsInstallSize
                 FROM baseImageRepository
                 WHERE baseID=(
                     SELECT baseImageID
@@ -323,7 +752,7 @@ class RepositoryDatabase:
         )
         result = self.cursor.fetchall()
         if len(result) == 1:
-            return [str(x) for x in result[0]]
+            return [str(x) for x in result[0][:6]] + list(result[0][6:])
         else:
             return list()
 
@@ -347,7 +776,7 @@ class RepositoryDatabase:
 
     def getBaseImagesWith(self, distribution, version, architecture, pkgManager):
         self.cursor.execute('''
-                    SELECT baseID, filename,graphPath
+                    SELECT baseID, filename,graphPath, numPackages, pkgsInstallSize
                     FROM baseImageRepository
                     WHERE distribution = ?
                         AND version = ?
@@ -360,9 +789,9 @@ class RepositoryDatabase:
         if len(result) > 0:
             baseImageList = list()
             for row in result:
-                info = [str(col) for col in row] # -> returns [baseID, imageFilename, graphFileName]
+                info = [str(col) for col in row[:3]] # -> returns [baseID, imageFilename, graphFileName]
                 baseImage = BaseImageDescriptor(info[1])
-                baseImage.initializeFromRepo(distribution, version, architecture, pkgManager, info[2])
+                baseImage.initializeFromRepo(distribution, version, architecture, pkgManager, info[2], row[3], row[4])
                 baseImageList.append(baseImage)
             return baseImageList
         else:
@@ -370,7 +799,7 @@ class RepositoryDatabase:
 
     def getBaseImageFromID(self, baseID):
         self.cursor.execute('''
-                    SELECT distribution,version,architecture,pkgManager,filename,graphPath
+                    SELECT distribution,version,architecture,pkgManager,filename,graphPath,numPackages,pkgsInstallSize
                     FROM baseImageRepository
                     WHERE baseID = ?
                     ''',
@@ -378,16 +807,16 @@ class RepositoryDatabase:
                     )
         result = self.cursor.fetchall()
         if len(result) == 1:
-            info = [str(col) for col in result[0]] # -> returns [distribution,version,architecture,pkgManager,filename,graphPath]
+            info = [str(col) for col in result[0][:6]] # -> returns [distribution,version,architecture,pkgManager,filename,graphPath]
             baseImage = BaseImageDescriptor(info[4])
-            baseImage.initializeFromRepo(info[0], info[1], info[2], info[3], info[5])
+            baseImage.initializeFromRepo(info[0], info[1], info[2], info[3], info[5], result[0][6], result[0][7])
             return baseImage
         else:
             return None
 
     def getVMIMasterDescriptorFromBaseID(self, baseID):
         self.cursor.execute('''
-                            SELECT distribution,version,architecture,pkgManager,filename,masterGraphPath
+                            SELECT distribution,version,architecture,pkgManager,filename,masterGraphPath,masterNumPackages
                             FROM baseImageRepository
                             WHERE baseID = ?
                             ''',
@@ -396,26 +825,54 @@ class RepositoryDatabase:
         result = self.cursor.fetchall()
         if len(result) == 1:
             info = [str(col) for col in
-                    result[0]]  # -> returns [distribution,version,architecture,pkgManager,filename,masterGraphPath]
+                    result[0][:6]]  # -> returns [distribution,version,architecture,pkgManager,filename,masterGraphPath]
             master = VMIMasterDescriptor(info[4])
-            master.initializeMasterFromRepo(info[0], info[1], info[2], info[3], info[5], self.getMainServicesForBaseImage(baseID))
+            master.initializeMasterFromRepo(info[0], info[1], info[2], info[3], info[5], self.getMainServicesForBaseImage(baseID),
+                                            result[0][6])
             return master
         else:
             return None
 
+    def getVMIMasterDescriptorForVMI(self, vmiName):
+        """
+        :return: master of the base image vmiName is based on, None if vmiName does not exist
+        """
+        self.cursor.execute('''
+            SELECT baseImageID
+            FROM vmiRepository
+            WHERE name = ?
+            ''',
+            (vmiName,)
+        )
+        result = self.cursor.fetchall()
+        if len(result) != 1:
+            return None
+        return self.getVMIMasterDescriptorFromBaseID(result[0][0])
+
     def getVMIMasterDescriptors(self):
         self.cursor.execute('''
-                SELECT baseID
-                FROM baseImageRepository
+                SELECT b.distribution, b.version, b.architecture, b.pkgManager, b.filename, b.masterGraphPath,
+                    b.masterNumPackages,
+                    (
+                        SELECT GROUP_CONCAT(DISTINCT p.name)
+                        FROM PackageRepository p
+                        JOIN PackageDependencies d
+                        ON d.pkgID = p.pkgID
+                        JOIN vmiRepository v
+                        ON v.vmiID = d.vmiID
+                        WHERE v.baseImageID = b.baseID
+                    )
+                FROM baseImageRepository b
                 '''
         )
         result = self.cursor.fetchall()
-        baseIDs = [ int(row[0]) for row in result]
         masterDescriptors = list()
-        for baseID in baseIDs:
-            tmp = self.getVMIMasterDescriptorFromBaseID(baseID)
-            if tmp is not None:
-                masterDescriptors.append(tmp)
+        for row in result:
+            info = [str(col) for col in row[:6]]  # -> [distribution,version,architecture,pkgManager,filename,masterGraphPath]
+            mainServices = str(row[7]).split(",") if row[7] is not None else []
+            master = VMIMasterDescriptor(info[4])
+            master.initializeMasterFromRepo(info[0], info[1], info[2], info[3], info[5], mainServices, row[6])
+            masterDescriptors.append(master)
         return masterDescriptors
 
     def getNumberOfBaseImagesWith(self,distribution,version,architecture,pkgManager):
@@ -469,34 +926,93 @@ class RepositoryDatabase:
                             (baseID,)
                             )
         result = self.cursor.fetchall()
-        if len(result) == 1:
-            return [str(row[0]) for row in result]
-        else:
-            return []
+        return [str(row[0]) for row in result]
 
     def replaceAndRemoveBaseImages(self, newBaseImage, baseImagesToReplace):
+        """
+            Lets the VMIs of the replaced base images use newBaseImage and removes the replaced base images from the
+            database. Files are not touched, a rollback would leave the database pointing to removed files:
+            the base image files are recorded in pendingBaseImageRemovals (see removeUnusedBaseImageFiles) and the
+            graph files have to be removed by the caller once the changes are committed.
+        :return: list of graph files of the replaced base images and their master graphs
+        """
         newBaseID = self.getBaseImageId(newBaseImage.pathToVMI)
         if newBaseID == None:
             sys.exit("ERROR in Database: Trying to replace base images with new base image that is not found in database")
 
         # update VMIs to use new Base image and remove old ones
+        graphFileNames = list()
         for oldBase in baseImagesToReplace:
             oldBaseID = self.getBaseImageId(oldBase.pathToVMI)
 
-            # remove base image and graph files
-            if os.path.isfile(oldBase.pathToVMI):
-                os.remove(oldBase.pathToVMI)
-            if oldBase.graphFileName is not None and os.path.isfile(oldBase.graphFileName):
-                os.remove(oldBase.graphFileName)
+            # base images are only removed once no overlay is backed by them
+            self.cursor.execute('''
+                INSERT OR IGNORE INTO pendingBaseImageRemovals(filename)
+                VALUES (?)''',
+                (oldBase.pathToVMI,)
+            )
+            if oldBase.graphFileName is not None:
+                graphFileNames.append(oldBase.graphFileName)
 
             if oldBaseID is not None:
-                masterGraphFileName = self.getVMIMasterDescriptorFromBaseID(oldBaseID).graphFileName
-                if os.path.isfile(masterGraphFileName):
-                    os.remove(masterGraphFileName)
+                graphFileNames.append(self.getVMIMasterDescriptorFromBaseID(oldBaseID).graphFileName)
 
                 # update VMIs to use new base image and remove old base image
                 self.updateVMIs(oldBaseID,newBaseID)
                 self.removeBaseImage(oldBaseID)
+        return graphFileNames
+
+    def addBaseImageOverlay(self, pathToOverlay, pathToBaseImage):
+        """
+            Records a VMI that was reassembled as overlay backed by a base image of the repository.
+            Overlays are tracked at the path they were created at, an overlay has to be flattened before it is moved.
+        """
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO baseImageOverlays(overlayPath, baseImagePath)
+            VALUES (?,?)''',
+            (os.path.abspath(pathToOverlay), os.path.abspath(pathToBaseImage))
+        )
+        self.commit()
+
+    def getOverlaysOfBaseImage(self, pathToBaseImage):
+        """
+            Recorded overlays that were removed, flattened or replaced by other images are forgotten.
+        :return: sorted list of paths of the overlays (recorded ones and the ones in the VMI folder) that are
+                 backed by the base image at pathToBaseImage
+        """
+        overlays = set(os.path.abspath(overlay)
+                       for overlay in GuestFSHelper.getOverlays(pathToBaseImage, StaticInfo.relPathLocalVMIFolder))
+        self.cursor.execute('''
+            SELECT overlayPath FROM baseImageOverlays
+            WHERE baseImagePath=?''',
+            (os.path.abspath(pathToBaseImage),)
+        )
+        for (overlayPath,) in self.cursor.fetchall():
+            overlayPath = str(overlayPath)
+            backingFile = GuestFSHelper.getBackingFile(overlayPath) if os.path.isfile(overlayPath) else None
+            if backingFile is not None and os.path.realpath(backingFile) == os.path.realpath(pathToBaseImage):
+                overlays.add(overlayPath)
+            else:
+                self.cursor.execute("DELETE FROM baseImageOverlays WHERE overlayPath=?", (overlayPath,))
+        self.commit()
+        return sorted(overlays)
+
+    def removeUnusedBaseImageFiles(self):
+        """
+            Removes the files of replaced base images that are no longer the backing file of any overlay.
+        """
+        self.cursor.execute("SELECT filename FROM pendingBaseImageRemovals")
+        for (fileName,) in self.cursor.fetchall():
+            fileName = str(fileName)
+            overlays = self.getOverlaysOfBaseImage(fileName) if os.path.isfile(fileName) else []
+            if len(overlays) > 0:
+                print "\tReplaced base image \"%s\" is kept on disk, it is the backing file of %s" % \
+                      (fileName, ", ".join("\"%s\"" % overlay for overlay in overlays))
+                continue
+            if os.path.isfile(fileName):
+                os.remove(fileName)
+            self.cursor.execute("DELETE FROM pendingBaseImageRemovals WHERE filename=?", (fileName,))
+        self.commit()
 
     def addVMI(self, vmiName, localPathToUserDir, baseImageID):
         """
@@ -523,7 +1039,7 @@ class RepositoryDatabase:
                 INSERT INTO vmiRepository (name,userDirPath,baseImageID)
                 VALUES (?,?,?)
             ''', (vmiName, localPathToUserDir, baseImageID))
-            self.db.commit()
+            self.commit()
             # Return id
             return self.getVmiID(vmiName)
 
@@ -534,7 +1050,7 @@ class RepositoryDatabase:
             WHERE baseImageID = ?
             ''',
             (newBaseID, oldBaseID))
-        self.db.commit()
+        self.commit()
 
     def addMainServicesDepListForVMI(self, vmiID, distribution, mainServicesDepList):
         """
@@ -572,7 +1088,7 @@ class RepositoryDatabase:
                                 AND architecture=?
                                 AND distribution=?))
             ''', (depList))
-        self.db.commit()
+        self.commit()
 
     def getMainServicesForVmiID(self, vmiID):
         self.cursor.execute('''
@@ -766,7 +1282,8 @@ class RepositoryDatabase:
         userDirPath = self.getVmiUserDirPath(vmiName)
         baseImageInfo = self.getBaseImageInfoForVmiID(vmiID)
         baseImage = BaseImageDescriptor(baseImageInfo[4])
-        baseImage.initializeFromRepo(baseImageInfo[0], baseImageInfo[1], baseImageInfo[2], baseImageInfo[3], baseImageInfo[5])
+        baseImage.initializeFromRepo(baseImageInfo[0], baseImageInfo[1], baseImageInfo[2], baseImageInfo[3], baseImageInfo[5],
+                                     baseImageInfo[6], baseImageInfo[7])
 
         return (
             userDirPath,
@@ -775,46 +1292,101 @@ class RepositoryDatabase:
             self.getDepPkgInfoDictForVMI(vmiID)
         )
 
-    def getDataForAllVMIs(self):
-        vmiDataList = list()
-        self.cursor.execute('''
-            SELECT vmiID, name
-            FROM vmiRepository
-            '''
+    def iterateRows(self, query, parameters=()):
+        """
+            Streams the rows of query with a cursor of its own, other queries can be run while iterating.
+        """
+        cursor = self.db.cursor()
+        try:
+            cursor.execute(query, parameters)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def iterateVMIListing(self, limit=None, offset=0):
+        """
+        :param limit: maximum number of VMIs (None for all)
+        :param offset: number of VMIs to skip
+        :return: generator of lists [name, distribution, version, architecture, pkgManager, baseImageFileName,
+                 graphFileName, "MS1, MS2"] ordered by name
+        """
+        rows = self.iterateRows('''
+            SELECT v.name, b.distribution, b.version, b.architecture, b.pkgManager, b.filename, b.graphPath,
+                (
+                    SELECT GROUP_CONCAT(p.name, ', ')
+                    FROM PackageRepository p
+                    WHERE p.pkgID IN (
+                        SELECT DISTINCT pkgID
+                        FROM PackageDependencies d
+                        WHERE d.vmiID = v.vmiID
+                    )
+                )
+            FROM vmiRepository v
+            LEFT JOIN baseImageRepository b
+            ON b.baseID = v.baseImageID
+            ORDER BY v.name COLLATE NOCASE
+            LIMIT ? OFFSET ?
+            ''',
+            (-1 if limit is None else limit, offset)
         )
-        result = self.cursor.fetchall()
-        vmiIdsAndNames = list((int(row[0]), str(row[1])) for row in result)
-        for (vmiID, vmiName) in vmiIdsAndNames:
-            # list(MS1, MS2)
-            vmiMSList = self.getMainServicesForVmiID(vmiID)
-            # list(distribution,version,architecture,pkgManager,filename,graphPath)
-            vmiBaseInfo = self.getBaseImageInfoForVmiID(vmiID)
+        for row in rows:
             # remove full path for filename and graph so that only filenames remain
-            vmiBaseInfo[4] = vmiBaseInfo[4].split("/")[-1]
-            vmiBaseInfo[5] = vmiBaseInfo[5].split("/")[-1]
-            vmiData = list(vmiBaseInfo)
-            vmiData.insert(0,vmiName)
-            vmiData.append(", ".join(vmiMSList))
-            vmiDataList.append(vmiData)
-        return vmiDataList
+            yield [str(row[0]), str(row[1]), str(row[2]), str(row[3]), str(row[4]),
+                   str(row[5]).split("/")[-1], str(row[6]).split("/")[-1],
+                   str(row[7]) if row[7] is not None else ""]
 
-    def getAllPackages(self):
-        self.cursor.execute('''
+    def getDataForAllVMIs(self):
+        return list(self.iterateVMIListing())
+
+    def iteratePackageListing(self, limit=None, offset=0):
+        """
+        :return: generator of tuples (name, version, architecture, distribution) ordered by distribution and name
+        """
+        rows = self.iterateRows('''
             SELECT name,version,architecture, distribution
             FROM PackageRepository
-            '''
+            ORDER BY distribution, name COLLATE NOCASE
+            LIMIT ? OFFSET ?
+            ''',
+            (-1 if limit is None else limit, offset)
         )
-        result = self.cursor.fetchall()
-        return list((str(row[0]), str(row[1]), str(row[2]), str(row[3])) for row in result)
+        for row in rows:
+            yield (str(row[0]), str(row[1]), str(row[2]), str(row[3]))
 
-    def getAllBaseImages(self):
-        self.cursor.execute('''
+    def getAllPackages(self):
+        return list(self.iteratePackageListing())
+
+    def iterateBaseImageListing(self, limit=None, offset=0):
+        """
+        :return: generator of tuples (distribution, version, architecture, pkgManager) ordered by distribution
+        """
+        rows = self.iterateRows('''
             SELECT distribution,version,architecture,pkgManager
             FROM baseImageRepository
+            ORDER BY distribution COLLATE NOCASE
+            LIMIT ? OFFSET ?
+            ''',
+            (-1 if limit is None else limit, offset)
+        )
+        for row in rows:
+            yield (str(row[0]), str(row[1]), str(row[2]), str(row[3]))
+
+    def getAllBaseImages(self):
+        return list(self.iterateBaseImageListing())
+
+    def getRepositorySummary(self):
+        """
+        :return: tuple (number of VMIs, number of base images, number of packages)
+        """
+        self.cursor.execute('''
+            SELECT
+                (SELECT count(*) FROM vmiRepository),
+                (SELECT count(*) FROM baseImageRepository),
+                (SELECT count(*) FROM PackageRepository)
             '''
         )
-        result = self.cursor.fetchall()
-        return list((str(row[0]), str(row[1]), str(row[2]), str(row[3])) for row in result)
+        return tuple(int(col) for col in self.cursor.fetchone())
 
     def getAllVmiNames(self):
         """
@@ -832,6 +1404,19 @@ class RepositoryDatabase:
 
         return vmiNames
 
+    def getBaseImageFileNamesOfVMIs(self):
+        """
+        :return: dict in the form of {vmiName:filename of its base image}
+        """
+        self.cursor.execute('''
+            SELECT v.name, b.filename
+            FROM vmiRepository v
+            JOIN baseImageRepository b
+            ON b.baseID = v.baseImageID
+            '''
+        )
+        return dict((str(row[0]), str(row[1])) for row in self.cursor.fetchall())
+
     def getVmiMetaInfo(self, vmiID):
         self.cursor.execute('''
                     SELECT distribution, version, architecture, pkgManager
@@ -853,3 +1438,5 @@ class RepositoryDatabase:
                     str(result[0][2]),
                     str(result[0][3])
                     )
+
+atexit.register(RepositoryDatabase.closeSessions)
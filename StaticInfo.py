@@ -9,10 +9,77 @@ class StaticInfo:
     # List of supported VMI formats/extensions
     validVMIFormats = ["qcow2"]
 
+    # GuestFS appliance pool
+    # number of launched appliances kept for reuse (0 disables the pool)
+    guestfsPoolSize = 1
+    # number of VMIs an appliance serves before it is replaced by a new one
+    guestfsPoolMaxReuse = 20
+    # size of the scratch drive a pooled appliance is launched with [bytes]
+    guestfsScratchDriveSize = 1024 * 1024
+    # number of VMIs attached to one appliance for batch inspection
+    guestfsMaxDrivesPerAppliance = 32
+    # number of virtual CPUs of a GuestFS appliance
+    guestfsApplianceCPUs = 4
+    # memory of a GuestFS appliance [MiB]
+    guestfsApplianceMemory = 1024
+    # number of packages repackaged in parallel inside the appliance, matches the number of its virtual CPUs
+    guestRepackParallelism = guestfsApplianceCPUs
+    # number of slowest packages listed after repackaging
+    guestRepackReportSlowest = 5
+    # size of the chunks exported packages are streamed and hashed in [bytes]
+    exportStreamChunkSize = 1024 * 1024
+
+    # number of worker processes running the guest phase of batch decompositions in parallel (1 for sequential)
+    decompositionWorkers = 1
+    # interval in which a decomposition checks whether packages exported by parallel decompositions are stored [s]
+    packageExportPollInterval = 1.0
+
+    # reassembled VMIs are created as qcow2 overlays backed by their base image in the local repository instead of
+    # full copies, replaced base images stay on disk as long as overlays reference them (overlays are tracked at the
+    # path they were created at, see RepositoryDatabase.addBaseImageOverlay)
+    reassemblyUseOverlays = True
+    # optional stage for VMIs that leave the host: overlays are flattened into standalone qcow2 images once their
+    # reassembly finished, flattening writes the whole image like a full copy
+    reassemblyFlattenOverlays = False
+    # number of worker processes reassembling VMIs in parallel (1 for sequential)
+    reassemblyWorkers = 1
+    # disk space a reassembly is expected to need in addition to its base image copy (if any) [bytes]
+    reassemblyDiskReserve = 2 * 1024 * 1024 * 1024
+    # packages are installed directly (dpkg -i / rpm -U) in the dependency order of the master graph during
+    # reassembly, the package manager only resolves dependencies if the direct installation fails
+    reassemblyDirectInstall = True
+    # maximum number of packages installed by one dpkg/rpm call of a direct installation
+    directInstallBatchSize = 100
+    # package bundles (packages and repository metadata imported into VMIs) are cached up to this size [bytes]
+    packageBundleCacheSize = 10 * 1024 * 1024 * 1024
+    # bundles used within this period are never evicted, they may be about to be imported by parallel reassemblies [s]
+    packageBundleEvictionGracePeriod = 30 * 60
+
+    # parse the package databases of VMIs on the host instead of querying the package manager inside the guest
+    hostSidePkgDBParsing = True
+
+    # MinHash index over master graphs
+    # number of hash functions per signature, has to be a multiple of masterIndexRowsPerBand
+    masterIndexNumHashes = 64
+    # signature values per LSH band, more rows per band require more similar master graphs to become candidates
+    masterIndexRowsPerBand = 4
+    # number of candidate master graphs the exact similarity is computed for
+    masterIndexTopK = 3
+
+    # extension of package graph files, see GraphFile
+    graphFileExtension = ".graph"
+    # a master graph log is compacted into a new snapshot once it is larger than this fraction of the snapshot
+    masterGraphLogCompactionRatio = 0.5
+
     # local repository folders
     relPathLocalRepository = "localRepository"
     relPathLocalRepositoryPackages = relPathLocalRepository + "/packages"
     relPathLocalRepositoryPackagesBasic = relPathLocalRepository + "/packages/basic"
+    relPathLocalRepositoryPackagesLock = relPathLocalRepositoryPackages + "/export.lock"
+    # markers of packages that are being exported by a decomposition, see Decomposer.claimPackages
+    relPathLocalRepositoryPackagesInExport = relPathLocalRepository + "/exporting"
+    relPathLocalRepositoryPackageBlobs = relPathLocalRepositoryPackages + "/blobs"
+    relPathLocalRepositoryBundles = relPathLocalRepository + "/bundles"
     relPathLocalRepositoryBaseImages = relPathLocalRepository + "/BaseImages"
     relPathLocalRepositoryUserFolders = relPathLocalRepository + "/UserFolders"
     relPathLocalRepositoryDatabase = relPathLocalRepository + "/db_repo_metadata.sqlite"
@@ -42,6 +109,7 @@ class StaticInfo:
     dictKeyEssential = "essential"
     dictKeyInstallSize = "size"
     dictKeyFilePath = "path"
+    dictKeyChecksum = "checksum"
     dictKeyConstraint = "constraint"
     dictKeyOperator = "operator"
 
@@ -63,6 +131,9 @@ class StaticInfo:
         }
     }
 
+    # number of entries per page of command "list"
+    cliListPageSize = 50
+
     # CLI Texts
     cliLogo = "\n" \
               "   ______                 _ _ _                                \n" \
@@ -1,6 +1,9 @@
 from abc import ABCMeta, abstractmethod
-import networkx as nx
 import os
+import threading
+
+from GraphFile import GraphFile, GraphFileLog
+from PackageGraph import PackageGraph
 from StaticInfo import StaticInfo
 from VMIGraph import VMIGraph
 
@@ -13,9 +16,68 @@ class BaseImageDescriptor():
         self.distributionVersion = None
         self.architecture = None
         self.pkgManager = None
-        self.graph = None  # type: nx.MultiDiGraph
+        self.graph = None  # type: PackageGraph
         self.graphFileName = None
 
+    @property
+    def graph(self):
+        # graphs of descriptors initialized from the repository are loaded on first access
+        if self._graph is None and self.unloadedGraphFileName is not None:
+            self._graph = self.loadGraph(self.unloadedGraphFileName)
+            self.unloadedGraphFileName = None
+        return self._graph
+
+    @graph.setter
+    def graph(self, graph):
+        self._graph = graph
+        self.unloadedGraphFileName = None
+        self.invalidateGraphCaches()
+
+    def loadGraph(self, graphFileName):
+        return GraphFile.load(graphFileName)
+
+    def invalidateGraphCaches(self):
+        """
+            Drops summaries and cached closures of the graph, has to be called whenever the graph is mutated in place.
+        """
+        self.numPackages = None
+        self.pkgsInstallSize = None
+        self.invalidateClosureCache()
+
+    def setUnloadedGraph(self, graphFileName, numPackages=None, pkgsInstallSize=None):
+        """
+            Defers loading the graph stored in graphFileName until it is accessed.
+            Summaries known from the repository are used as long as the graph is not replaced.
+        """
+        self.graph = None
+        self.graphFileName = graphFileName
+        self.unloadedGraphFileName = graphFileName
+        self.numPackages = numPackages
+        self.pkgsInstallSize = pkgsInstallSize
+
+    def invalidateClosureCache(self):
+        """
+            Drops all cached dependency closures, has to be called whenever the graph is mutated in place.
+            Assigning a new graph invalidates the cache automatically.
+        """
+        # closures by set of root packages, in the form of {frozenset(roots):{pkgName:pkgInfo}}
+        self.closureNodeDataCache = dict()
+        # subgraphs induced by closures, in the form of {frozenset(roots):PackageGraph}
+        self.closureSubGraphCache = dict()
+
+    def getClosureNodeData(self, rootNodeList):
+        """
+            Returns the node data of all packages reachable from the given roots, computed once per set of roots.
+        :param rootNodeList:
+        :return: cached dict in the form of {pkgName:pkgInfo}, must not be modified
+        """
+        roots = frozenset(rootNodeList)
+        nodeDataDict = self.closureNodeDataCache.get(roots)
+        if nodeDataDict is None:
+            nodeList = self.graph.bfsNodes(list(roots))
+            nodeDataDict = dict((pkgName, self.graph.nodeData(pkgName)) for pkgName in nodeList)
+            self.closureNodeDataCache[roots] = nodeDataDict
+        return nodeDataDict
 
     def initializeNew(self, guest, root, verbose=False):
         #print "Creating new Descriptor for \"%s\"" % self.pathToVMI
@@ -27,20 +89,19 @@ class BaseImageDescriptor():
         self.pkgManager = guest.inspect_get_package_management(root)
         self.graph = VMIGraph.createGraph(guest, self.pkgManager, verbose=verbose)
 
-    def initializeFromRepo(self, distribution, distributionVersion, architecture, pkgManager, graphFileName):
+    def initializeFromRepo(self, distribution, distributionVersion, architecture, pkgManager, graphFileName,
+                           numPackages=None, pkgsInstallSize=None):
         self.distribution = distribution
         self.distributionVersion = distributionVersion
         self.architecture = architecture
         self.pkgManager = pkgManager
-        self.graphFileName = graphFileName
-        self.graph = nx.read_gpickle(graphFileName)
+        self.setUnloadedGraph(graphFileName, numPackages, pkgsInstallSize)
 
     def saveGraph(self):
         if self.graphFileName is None:
-            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + ".pkl"
-        if os.path.isfile(self.graphFileName):
-            os.remove(self.graphFileName)
-        nx.write_gpickle(self.graph, self.graphFileName)
+            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + StaticInfo.graphFileExtension
+        # replaces an existing graph file atomically
+        GraphFile.write(self.graph, self.graphFileName)
 
     def getVMIMasterDescriptor(self):
         master = VMIMasterDescriptor(self.pathToVMI)
@@ -53,37 +114,35 @@ class BaseImageDescriptor():
         return dict((pkgName, pkgInfo) for (pkgName, pkgInfo) in self.graph.nodes(data=True))
 
     def getNumberOfPackages(self):
-        return len(self.graph)
+        # computed once per graph
+        if self.numPackages is None:
+            self.numPackages = len(self.graph)
+        return self.numPackages
 
     def getPkgsInstallSize(self):
-        size = 0
-        for pkg, pkgInfo in self.graph.nodes(data=True):
-            size = size + int(pkgInfo[StaticInfo.dictKeyInstallSize])
-        return size
+        # computed once per graph
+        if self.pkgsInstallSize is None:
+            self.pkgsInstallSize = sum(self.graph.installSizes)
+        return self.pkgsInstallSize
 
     def getSubGraphFromRoots(self, rootNodeList):
-        nodeList = list()
-        for name in rootNodeList:
-            nodeList = nodeList + list(nx.bfs_tree(self.graph, name))
-        return nx.MultiDiGraph(self.graph.subgraph(nodeList))
-
-    def getSubGraphFromRootsOLD(self, rootNodeList):
-        nodeList = list()
-        for name in rootNodeList:
-            nodeList.append(nx.bfs_tree(self.graph, name))
-        return nx.MultiDiGraph(self.graph.subgraph(nodeList))
+        """
+        :param rootNodeList:
+        :return: cached subgraph induced by the closure of the given roots, must not be modified
+        """
+        roots = frozenset(rootNodeList)
+        subGraph = self.closureSubGraphCache.get(roots)
+        if subGraph is None:
+            subGraph = self.graph.subgraph(self.getClosureNodeData(roots).keys())
+            self.closureSubGraphCache[roots] = subGraph
+        return subGraph
 
     def getNodeDataFromSubTree(self, rootNode):
-        nodeList = nx.bfs_tree(self.graph, rootNode)
-        NodeDataDict = dict((pkgName, pkgInfo) for (pkgName, pkgInfo) in self.graph.subgraph(nodeList).nodes(data=True))
-        return NodeDataDict
+        return self.getNodeDataFromSubTrees([rootNode])
 
     def getNodeDataFromSubTrees(self, rootNodeList):
-        result = dict()
-        for name in rootNodeList:
-            nodeList = nx.bfs_tree(self.graph, name)
-            result.update(dict((pkgName, pkgInfo) for (pkgName, pkgInfo) in self.graph.subgraph(nodeList).nodes(data=True)))
-        return result
+        # callers modify the returned dicts (e.g. when exporting packages), the cached closure is therefore copied
+        return dict((pkgName, dict(pkgInfo)) for (pkgName, pkgInfo) in self.getClosureNodeData(rootNodeList).iteritems())
 
     def checkIfNodeExists(self, nodeName):
         return nodeName in self.graph
@@ -101,13 +160,12 @@ class BaseImageDescriptor():
                 in the form of dict{pkgName, pkgInfo} with pkgInfo = dict{version:?, Arch:?,...}
         :return:
         """
-        graphNodeData = self.getNodeData()
         if packageDict is None:
             return True
         for pkg2Name,pkg2Data in packageDict.iteritems():
-            if pkg2Name in graphNodeData:
+            if pkg2Name in self.graph:
                 # pkg2 is in graph, version and architecture has to match, otherwise return False:
-                pkg1Data = graphNodeData[pkg2Name]
+                pkg1Data = self.graph.nodeData(pkg2Name)
                 if not (
                         # Version has to be the same
                         pkg1Data[StaticInfo.dictKeyVersion] == pkg2Data[StaticInfo.dictKeyVersion]
@@ -156,34 +214,96 @@ class VMIDescriptor(BaseImageDescriptor):
         return base
 
 class VMIMasterDescriptor(BaseImageDescriptor):
+    """
+        Master graphs are persisted as a snapshot graph file and a log of the subgraphs added since (see GraphFileLog).
+    """
+    # background compactions of master graph logs, in the form of {graphFileName:Thread}
+    compactionThreads = dict()
+    compactionThreadsLock = threading.Lock()
+
     def __init__(self, pathToVMI):
         super(VMIMasterDescriptor, self).__init__(pathToVMI)
         self.mainServices = None
+        # subgraphs added since the graph was loaded or saved, in the form of [(mainServices, subGraph)],
+        # None if the graph has no snapshot yet and has to be saved completely
+        self.unsavedSubGraphs = None
 
     def createNew(self, distribution, distributionVersion, architecture, pkgManager, graph, mainServices):
         self.distribution = distribution
         self.distributionVersion = distributionVersion
         self.architecture = architecture
         self.pkgManager = pkgManager
-        self.graph = nx.MultiDiGraph(graph)
+        self.graph = graph.copy()
         self.mainServices = set(mainServices)
         self.graphFileName = None
+        self.unsavedSubGraphs = None
 
-    def initializeMasterFromRepo(self, distribution, distributionVersion, architecture, pkgManager, graphFileName, mainServices):
+    def initializeMasterFromRepo(self, distribution, distributionVersion, architecture, pkgManager, graphFileName,
+                                 mainServices, numPackages=None):
         self.distribution = distribution
         self.distributionVersion = distributionVersion
         self.architecture = architecture
         self.pkgManager = pkgManager
-        self.graphFileName = graphFileName
-        self.graph = nx.read_gpickle(graphFileName)
+        self.setUnloadedGraph(graphFileName, numPackages)
         self.mainServices = set(mainServices)
+        self.unsavedSubGraphs = list()
 
-    def saveGraph(self):
+    def loadGraph(self, graphFileName):
+        (graph, loggedMainServices) = GraphFileLog.load(graphFileName)
+        if self.mainServices is not None:
+            self.mainServices = self.mainServices.union(loggedMainServices)
+        return graph
+
+    def saveGraph(self, compact=True):
+        """
+            Appends the subgraphs added since the last save to the log of the master graph, a master graph without
+            snapshot is written completely. Logs larger than StaticInfo.masterGraphLogCompactionRatio times the
+            snapshot are compacted in the background.
+        :param compact: if False, the log is not compacted (appended records can be discarded with
+                        GraphFileLog.truncate until startCompactionIfNeeded is called)
+        """
         if self.graphFileName is None:
-            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + "_MASTER.pkl"
-        if os.path.isfile(self.graphFileName):
-            os.remove(self.graphFileName)
-        nx.write_gpickle(self.graph, self.graphFileName)
+            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + "_MASTER" + StaticInfo.graphFileExtension
+        if self.unsavedSubGraphs is None or not os.path.isfile(self.graphFileName):
+            VMIMasterDescriptor.waitForCompaction(self.graphFileName)
+            # replaces an existing graph file atomically, an old log would be merged again
+            GraphFileLog.removeLog(self.graphFileName)
+            GraphFile.write(self.graph, self.graphFileName)
+        elif len(self.unsavedSubGraphs) > 0:
+            GraphFileLog.append(self.graphFileName, self.unsavedSubGraphs)
+            if compact:
+                self.startCompactionIfNeeded()
+        self.unsavedSubGraphs = list()
+
+    def startCompactionIfNeeded(self):
+        if GraphFileLog.getLogSize(self.graphFileName) > \
+                StaticInfo.masterGraphLogCompactionRatio * os.path.getsize(self.graphFileName):
+            VMIMasterDescriptor.startCompaction(self.graphFileName)
+
+    @staticmethod
+    def startCompaction(graphFileName):
+        with VMIMasterDescriptor.compactionThreadsLock:
+            thread = VMIMasterDescriptor.compactionThreads.get(graphFileName)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=GraphFileLog.compact, args=(graphFileName,),
+                                      name="compaction " + graphFileName)
+            VMIMasterDescriptor.compactionThreads[graphFileName] = thread
+            thread.start()
+
+    @staticmethod
+    def waitForCompaction(graphFileName=None):
+        """
+            Blocks until the background compaction of graphFileName (or of all master graphs) has finished.
+        """
+        with VMIMasterDescriptor.compactionThreadsLock:
+            if graphFileName is None:
+                threads = VMIMasterDescriptor.compactionThreads.values()
+            else:
+                threads = [VMIMasterDescriptor.compactionThreads.get(graphFileName)]
+        for thread in threads:
+            if thread is not None:
+                thread.join()
 
     def getSubGraphForMainServices(self):
         return self.getSubGraphFromRoots(self.mainServices)
@@ -198,5 +318,9 @@ class VMIMasterDescriptor(BaseImageDescriptor):
             print "ERROR in Mastergraph: trying to add packages that are not compatible to mastergraph!"
             return False
 
-        self.graph = nx.compose(newGraph, self.graph)
-        self.mainServices = self.mainServices.union(set(mainServices))
\ No newline at end of file
+        # merged in place, packages already in the master graph keep their attributes
+        self.graph.addGraph(newGraph, keepAttributes=True)
+        self.invalidateGraphCaches()
+        self.mainServices = self.mainServices.union(set(mainServices))
+        if self.unsavedSubGraphs is not None:
+            self.unsavedSubGraphs.append((set(mainServices), newGraph))
\ No newline at end of file
@@ -3,10 +3,13 @@ import re
 import sys
 from abc import ABCMeta, abstractmethod
 
-import networkx as nx
 import os
+import shutil
+import tempfile
 from enum import IntEnum
 
+from PackageDatabaseParser import DpkgStatusParser, RpmHeaderParser
+from PackageGraph import PackageGraph
 from StaticInfo import StaticInfo
 
 
@@ -27,22 +30,45 @@ class VMIGraph:
         if pkgManagement == "apt":
             return VMIGraph.createGraphAPT(guest, verbose=verbose)
         elif pkgManagement == "dnf":
+            if StaticInfo.hostSidePkgDBParsing:
+                graph = VMIGraph.createGraphDNFHostSide(guest, verbose=verbose)
+                if graph is not None:
+                    return graph
             return VMIGraph.createGraphDNF(guest, verbose=verbose)
         else:
             sys.exit("ERROR in VMIGraph: trying to create Graph for VMI with unsupported package manager \"%s\"" % pkgManagement)
 
     @staticmethod
-    def createGraphAPT(guest, verbose=False):
-        # Enum more understandable list access
-        class Q(IntEnum):
-            Name        = 0
-            Version     = 1
-            Arch        = 2
-            Essential   = 3
-            InstallSize = 4
-            Depends     = 5
-            PreDepends  = 6
+    def getPkgRecordsAPTHostSide(guest):
+        """
+            Downloads the dpkg status database and parses it on the host, no process is spawned in the guest.
+        :param guest:
+        :return: list of package records, see DpkgStatusParser.iterateRecords
+        """
+        localStatusFolder = tempfile.mkdtemp(prefix="expelliarmus_dpkg_")
+        localStatusPath = os.path.join(localStatusFolder, "status")
+        try:
+            guest.download("/var/lib/dpkg/status", localStatusPath)
+            with open(localStatusPath, "r") as statusFile:
+                return list(DpkgStatusParser.iterateRecords(statusFile))
+        finally:
+            shutil.rmtree(localStatusFolder, ignore_errors=True)
 
+    @staticmethod
+    def getPkgRecordsAPTGuestSide(guest):
+        """
+            Queries dpkg inside the guest.
+        :param guest:
+        :return: list of package records, see DpkgStatusParser.iterateRecords
+        """
+        fields = ["Package", "Version", "Architecture", "Essential", "Installed-Size", "Depends", "Pre-Depends", "Provides"]
+        pkgsInfoString = guest.sh(
+            "dpkg-query --show --showformat='" + ";".join("${" + field + "}" for field in fields) + "\\n'")[:-1]
+        # returns lines of form "curl;1.1;amd64;no;10;dep1, dep2,...;dep3, dep4,...;virt1,..."
+        return [dict(zip(fields, line.split(";"))) for line in pkgsInfoString.split("\n")]
+
+    @staticmethod
+    def createGraphAPT(guest, verbose=False):
         # Regular Expressions for pattern matching Package's info
         patternPkgName = r"([^(): ]*)"
         patternArch = r"(?:: *([^(): ]*))?"
@@ -50,58 +76,62 @@ class VMIGraph:
         depMatcher = re.compile(r"^ *" + patternPkgName + " *" + patternArch + " *" + patternVersionConstraint + " *$")
 
         # Init Graph
-        graph = nx.MultiDiGraph()
+        graph = PackageGraph()
 
         # Obtain Package Data from guest
         # install size is in kbytes
-        pkgsInfoString = guest.sh(
-            "dpkg-query --show --showformat='${Package};${Version};${Architecture};${Essential};${Installed-Size};${Depends};${Pre-Depends}\\n'")[:-1]
-        # returns lines of form "curl;1.1;amd64;no;dep1, dep2,...;dep3, dep4,..."
+        if StaticInfo.hostSidePkgDBParsing:
+            pkgRecords = VMIGraph.getPkgRecordsAPTHostSide(guest)
+        else:
+            pkgRecords = VMIGraph.getPkgRecordsAPTGuestSide(guest)
+        # list of dicts of form {Package:"curl", Version:"1.1", Architecture:"amd64", Essential:"no",
+        #                        Installed-Size:"10", Depends:"dep1, dep2,...", Pre-Depends:"dep3, dep4,...", Provides:"virt1,..."}
 
         # List of node names and attributes
         pkgsInfo = []   # in the form of [(pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False, installsize:10})]
         pkgHelperDict = dict()
-        for line in pkgsInfoString.split("\n"):
-            lineData = line.split(";")
-            essentialPkg = True if lineData[Q.Essential] == "yes" else False
-            pkgsInfo.append((lineData[Q.Name],
-                             {
-                                 StaticInfo.dictKeyName: lineData[Q.Name],
-                                 StaticInfo.dictKeyVersion: lineData[Q.Version],
-                                 StaticInfo.dictKeyArchitecture: lineData[Q.Arch],
-                                 StaticInfo.dictKeyEssential: essentialPkg,
-                                 StaticInfo.dictKeyInstallSize: int(lineData[Q.InstallSize])*1000,
-                                 StaticInfo.dictKeyFilePath: None
-                            }))
-            pkgHelperDict[lineData[Q.Name]] = {StaticInfo.dictKeyName: lineData[Q.Name],
-                                               StaticInfo.dictKeyVersion: lineData[Q.Version],
-                                               StaticInfo.dictKeyArchitecture: lineData[Q.Arch],
-                                               StaticInfo.dictKeyEssential: essentialPkg,
-                                               StaticInfo.dictKeyInstallSize: int(lineData[Q.InstallSize])*1000,
-                                               StaticInfo.dictKeyFilePath: None}
+        providesIndex = dict() # in the form of {virtualPkg:[pkg1,pkg2]}
+        for record in pkgRecords:
+            essentialPkg = True if record.get("Essential") == "yes" else False
+            installSize = record.get("Installed-Size")
+            pkgInfo = {StaticInfo.dictKeyName: record["Package"],
+                       StaticInfo.dictKeyVersion: record.get("Version", ""),
+                       StaticInfo.dictKeyArchitecture: record.get("Architecture", ""),
+                       StaticInfo.dictKeyEssential: essentialPkg,
+                       StaticInfo.dictKeyInstallSize: int(installSize)*1000 if installSize else 0,
+                       StaticInfo.dictKeyFilePath: None}
+            pkgsInfo.append((record["Package"], pkgInfo))
+            pkgHelperDict[record["Package"]] = dict(pkgInfo)
+            for provided in [p for p in record.get("Provides", "").split(",") if p.strip() != ""]:
+                matchResult = depMatcher.match(provided)
+                if matchResult:
+                    providesIndex.setdefault(matchResult.group(1), []).append(record["Package"])
+
+        def archMatches(depPkgArch, pkgName):
+            return depPkgArch == None or depPkgArch == "any" or pkgHelperDict[pkgName][StaticInfo.dictKeyArchitecture] == "all"
 
         # List of edge data (fromNode, toNode and attributes)
         depList = []  # in the form of [(pkg,deppkg,{constraint:True, operator:">=", version:"1.6"})]
-        for line in pkgsInfoString.split("\n"):
-            lineData = line.split(";")
-            deps = [dep for dep in (lineData[Q.Depends] + "," + lineData[Q.PreDepends]).split(",") if dep != ""]
+        for record in pkgRecords:
+            deps = [dep for dep in (record.get("Depends", "") + "," + record.get("Pre-Depends", "")).split(",") if dep.strip() != ""]
             for dep in deps:
-                #print lineData[Q.Name] + ": \"" + dep + "\""
+                #print record["Package"] + ": \"" + dep + "\""
                 for depPossibility in dep.split("|"):
                     #print "\"" + depPossibility + "\""
                     matchResult = depMatcher.match(depPossibility)
                     if not matchResult:
-                        sys.exit("ERROR: Could not match Dependency line: \"" + lineData[Q.Name] + "\" -> \"" + depPossibility + "\"")
+                        sys.exit("ERROR: Could not match Dependency line: \"" + record["Package"] + "\" -> \"" + depPossibility + "\"")
                     if matchResult:
                         depPkgName = matchResult.group(1)
                         depPkgArch = matchResult.group(2)
                         depPkgVersConstraint = matchResult.group(3)
-                        Zinstalled = depPkgName in pkgHelperDict
-                        #if Zinstalled:
-                        #    ZarchSpecified = depPkgArch == None
-                        #    ZarchAny       = depPkgArch == "any"
-                        #    ZArchAllAllowed= pkgHelperDict[depPkgName]["architecture"] == "all"
-                        if depPkgName in pkgHelperDict and (depPkgArch == None or depPkgArch == "any" or pkgHelperDict[depPkgName][StaticInfo.dictKeyArchitecture] == "all"):
+                        # installed package or installed package that provides the (virtual) package
+                        if depPkgName in pkgHelperDict and archMatches(depPkgArch, depPkgName):
+                            resolvedPkgName = depPkgName
+                        else:
+                            providers = [p for p in providesIndex.get(depPkgName, []) if archMatches(depPkgArch, p)]
+                            resolvedPkgName = providers[0] if len(providers) > 0 else None
+                        if resolvedPkgName is not None:
                             constraint = False
                             operator = ""
                             version = ""
@@ -112,7 +142,7 @@ class VMIGraph:
                                 constraint = True
                                 operator = versConstraintTuple[0]
                                 version = versConstraintTuple[1]
-                            depList.append((lineData[Q.Name],depPkgName,
+                            depList.append((record["Package"],resolvedPkgName,
                                             {
                                                 StaticInfo.dictKeyConstraint:constraint,
                                                 StaticInfo.dictKeyOperator:operator,
@@ -124,6 +154,92 @@ class VMIGraph:
         graph.add_edges_from(depList)
         return graph
 
+    @staticmethod
+    def createGraphDNFHostSide(guest, verbose=False):
+        """
+            Creates the graph from the guest's rpm database which is downloaded and parsed on the host.
+            Dependencies are resolved through an index of all capabilities and files provided by the installed packages.
+        :param guest:
+        :param verbose:
+        :return: graph or None if the rpm database cannot be read on the host
+        """
+        ignoreSet = {"filesystem"}
+        ignoredPackages = set()
+
+        localRpmDBFolder = tempfile.mkdtemp(prefix="expelliarmus_rpmdb_")
+        try:
+            # Obtain rpm database from guest
+            if guest.is_file("/var/lib/rpm/rpmdb.sqlite", followsymlinks=True):
+                for fileName in ["rpmdb.sqlite", "rpmdb.sqlite-wal", "rpmdb.sqlite-shm"]:
+                    if guest.is_file("/var/lib/rpm/" + fileName, followsymlinks=True):
+                        guest.download("/var/lib/rpm/" + fileName, os.path.join(localRpmDBFolder, fileName))
+                headers = RpmHeaderParser.iterateHeadersSQLite(os.path.join(localRpmDBFolder, "rpmdb.sqlite"))
+            elif guest.is_file("/var/lib/rpm/Packages", followsymlinks=True):
+                try:
+                    import rpm
+                except ImportError:
+                    if verbose:
+                        print "\tNo rpm python bindings on host, dependencies are fetched in guest."
+                    return None
+                guest.download("/var/lib/rpm/Packages", os.path.join(localRpmDBFolder, "Packages"))
+                headers = RpmHeaderParser.iterateHeadersRpmLib(os.path.abspath(localRpmDBFolder))
+            else:
+                return None
+
+            # Init Graph
+            graph = PackageGraph()
+
+            # List of node names and attributes
+            pkgsInfo = []  # in the form of [(pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False, installsize:10})]
+                           # essential not present in dnf
+            pkgHelperDict = dict()
+            requiresDict = dict()   # in the form of {pkg:[capability1, /usr/bin/file,...]}
+            providesIndex = dict()  # in the form of {capability:pkg}, files are capabilities as well
+            for header in headers:
+                pkgName = header[RpmHeaderParser.TagName]
+                if pkgName in ignoreSet:
+                    ignoredPackages.add(pkgName)
+                    continue
+                # tag size specifies installsize in bytes, longsize is used for packages larger than 4GB
+                installSize = header.get(RpmHeaderParser.TagLongSize, header.get(RpmHeaderParser.TagSize, [0]))[0]
+                pkgInfo = {StaticInfo.dictKeyName: pkgName,
+                           StaticInfo.dictKeyVersion: header.get(RpmHeaderParser.TagVersion, ""),
+                           StaticInfo.dictKeyArchitecture: header.get(RpmHeaderParser.TagArch, "(none)"),
+                           StaticInfo.dictKeyEssential: False,
+                           StaticInfo.dictKeyInstallSize: str(installSize),
+                           StaticInfo.dictKeyFilePath: None}
+                pkgsInfo.append((pkgName, pkgInfo))
+                pkgHelperDict[pkgName] = dict(pkgInfo)
+                requiresDict[pkgName] = header.get(RpmHeaderParser.TagRequireName, [])
+                for capability in header.get(RpmHeaderParser.TagProvideName, []) + RpmHeaderParser.getFileNames(header):
+                    providesIndex.setdefault(capability, pkgName)
+        finally:
+            shutil.rmtree(localRpmDBFolder, ignore_errors=True)
+
+        # List of edge data (fromNode, toNode and attributes)
+        depList = []  # in the form of [(pkg,deppkg,{constraint:False, operator:"", version:""})]
+        for pkgName, requirements in requiresDict.iteritems():
+            depNames = set()
+            for requirement in requirements:
+                if requirement.startswith("rpmlib("):
+                    continue
+                depName = providesIndex.get(requirement)
+                if depName is not None and depName != pkgName and depName in pkgHelperDict:
+                    depNames.add(depName)
+            for depName in depNames:
+                depList.append((pkgName, depName,
+                                {
+                                    StaticInfo.dictKeyConstraint: False,
+                                    StaticInfo.dictKeyOperator: "",
+                                    StaticInfo.dictKeyVersion: ""}))
+
+        graph.add_nodes_from(pkgsInfo)
+        graph.add_edges_from(depList)
+        if verbose==True and len(ignoredPackages) > 0:
+            print "\tThe following packages were ignored while creating the VMI graph:"
+            print "\t\t" + ",".join(ignoredPackages)
+        return graph
+
     @staticmethod
     def createGraphDNF(guest, verbose=False):
         # Enum more understandable list access
@@ -142,7 +258,7 @@ class VMIGraph:
         depMatcher = re.compile(r"^" + patternLevel + " " + patternPkgName + " -> " + patternPkgName + " *$")
 
         # Init Graph
-        graph = nx.MultiDiGraph()
+        graph = PackageGraph()
 
         # tag size specifies installsize in bytes
         # see http://ftp.rpm.org/max-rpm/ch-queryformat-tags.html
@@ -5,12 +5,15 @@ import itertools
 import threading
 import time
 import guestfs
+import fcntl
+import hashlib
 import tarfile
+import tempfile
 from abc import ABCMeta, abstractmethod
-import subprocess
 
 import shutil
 
+from PackageBundle import PackageBundle
 from StaticInfo import StaticInfo
 
 
@@ -26,6 +29,7 @@ class VMIManipulator:
         self.local_currentDir = os.path.dirname(os.path.realpath(__file__))
         self.local_absPathToVMI = self.local_currentDir + '/' + pathToVMI
         self.vmi_repackagingFolder = "/var/exportpackages"
+        self.vmi_repackagingWorkFolder = "/var/exportpackages_work"
         self.vmi_repoFolder = "/var/tempRepository"
         self.localUserBackupPath = StaticInfo.relPathLocalRepositoryUserFolders + "/userfolder_" + self.vmiName + ".tar"
         self.loading = False
@@ -57,11 +61,174 @@ class VMIManipulator:
             pass
         return False
 
+    def repackagePackages(self, packageNames, repackCommand):
+        """
+            Repackages packageNames inside the guest with up to StaticInfo.guestRepackParallelism processes at once
+            (xargs -P). All packages are repackaged within a single guest round trip, each worker stores return code,
+            start/end time and output of its package which are collected after all workers finished.
+            The resulting files are placed in self.vmi_repackagingFolder, which has to exist.
+        :param list() packageNames:
+        :param str repackCommand: command run in self.vmi_repackagingFolder, the package name is appended to it
+        :return: dict() in the form of {pkgName:(returnCode, seconds, outputLines)}, returnCode is None if
+                 the worker of a package did not report any result
+        """
+        workFolder = self.vmi_repackagingWorkFolder
+        workerScript = workFolder + "/worker.sh"
+        packageList = workFolder + "/packages"
+        self.guest.rm_rf(workFolder)
+        self.guest.mkdir(workFolder)
+        self.guest.write(packageList, "\n".join(packageNames) + "\n")
+        self.guest.write(workerScript,
+                         "pkg=\"$1\"\n"
+                         "start=$(date +%s%N)\n"
+                         "cd " + self.vmi_repackagingFolder + " && " + repackCommand + " \"$pkg\" "
+                         "> " + workFolder + "/\"$pkg\".log 2>&1\n"
+                         "rc=$?\n"
+                         "echo \"$rc $start $(date +%s%N)\" > " + workFolder + "/\"$pkg\".result\n")
+        output = self.guest.sh(
+            "cd " + workFolder + "\n"
+            "xargs -n 1 -P " + str(StaticInfo.guestRepackParallelism) + " sh " + workerScript + " < " + packageList + "\n"
+            "while read -r pkg; do\n"
+            "    printf 'RESULT\\t%s\\t%s\\n' \"$pkg\" \"$(cat \"$pkg\".result 2>/dev/null)\"\n"
+            "    [ -f \"$pkg\".log ] && while IFS= read -r line; do printf 'OUTPUT\\t%s\\t%s\\n' \"$pkg\" \"$line\"; done < \"$pkg\".log\n"
+            "done < " + packageList + "\n"
+            "exit 0\n")
+        self.guest.rm_rf(workFolder)
+
+        results = dict()  # in the form of {pkgName:(returnCode, seconds, outputLines)}
+        outputs = dict((pkgName, []) for pkgName in packageNames)
+        for line in output.split("\n"):
+            fields = line.split("\t", 2)
+            if len(fields) < 3:
+                continue
+            (kind, pkgName, value) = fields
+            if kind == "OUTPUT" and pkgName in outputs:
+                outputs[pkgName].append(value)
+            elif kind == "RESULT":
+                values = value.split()
+                if len(values) == 3:
+                    results[pkgName] = (int(values[0]), (int(values[2]) - int(values[1])) / 1e9)
+        return dict((pkgName, results.get(pkgName, (None, 0.0)) + (outputs[pkgName],))
+                    for pkgName in packageNames)
+
+    def streamOutPackages(self):
+        """
+            Streams the files in self.vmi_repackagingFolder out of the guest into self.local_packageFolder and removes
+            the folder in the guest. The tar output of the guest is read from a named pipe instead of an intermediate
+            tarball, so each file is written to disk exactly once and hashed while it is written.
+            The directory structure of the guest folder is flattened.
+        :return: dict() in the form of {fileName:sha256}
+        """
+        tempFolder = tempfile.mkdtemp(prefix="expelliarmus_export_")
+        pipePath = os.path.join(tempFolder, "packages.tar")
+        os.mkfifo(pipePath)
+        checksums = dict()
+        errors = []
+        # the pipe is held open for writing until tar_out returned, the reader only sees EOF after the guest is done
+        pipeIn = os.fdopen(os.open(pipePath, os.O_RDONLY | os.O_NONBLOCK), "rb")
+        fcntl.fcntl(pipeIn, fcntl.F_SETFL, fcntl.fcntl(pipeIn, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        pipeHold = os.open(pipePath, os.O_WRONLY)
+
+        def readPipe():
+            try:
+                with tarfile.open(fileobj=pipeIn, mode="r|") as tar:
+                    for member in tar:
+                        if not member.isfile():
+                            continue
+                        fileName = os.path.basename(member.name)
+                        checksums[fileName] = VMIManipulator.writeStream(tar.extractfile(member),
+                                                                         self.local_packageFolder + "/" + fileName)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pipeIn.close()
+
+        reader = threading.Thread(target=readPipe)
+        reader.start()
+        try:
+            self.guest.tar_out(self.vmi_repackagingFolder, pipePath)
+        except RuntimeError:
+            # a failed reader closes the pipe (after recording its error), tar_out then fails with a broken pipe
+            # that would hide the actual error
+            if len(errors) == 0:
+                raise
+        finally:
+            os.close(pipeHold)
+            reader.join()
+            shutil.rmtree(tempFolder)
+        if len(errors) > 0:
+            raise errors[0]
+        self.guest.rm_rf(self.vmi_repackagingFolder)
+        return checksums
+
+    @staticmethod
+    def writeStream(stream, path):
+        """
+            Writes stream to path (atomically, through a temporary file next to it).
+        :return: SHA-256 hex digest of the written content
+        """
+        sha256 = hashlib.sha256()
+        tempPath = path + ".part"
+        try:
+            with open(tempPath, "wb") as outFile:
+                while True:
+                    chunk = stream.read(StaticInfo.exportStreamChunkSize)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    outFile.write(chunk)
+            os.rename(tempPath, path)
+        except BaseException:
+            # half-written files would be counted as packages (see PackageStore.getStorageSizes)
+            if os.path.isfile(tempPath):
+                os.remove(tempPath)
+            raise
+        return sha256.hexdigest()
+
+    @staticmethod
+    def printRepackagingReport(repackResults, failedPackages, wallTime):
+        """
+            Prints failed packages together with their output and the packages that took longest to repackage.
+        :param dict() repackResults: as returned by repackagePackages
+        :param list() failedPackages: names of packages no file was produced for
+        :param float wallTime: time taken to repackage all packages [s]
+        """
+        for pkgName in sorted(failedPackages):
+            (returnCode, seconds, outputLines) = repackResults[pkgName]
+            print "\t\tcould not repackage \"%s\" (return code %s, %.2fs)" % (pkgName, returnCode, seconds)
+            for line in outputLines:
+                print "\t\t\t" + line
+        sumTimes = sum(seconds for (_returnCode, seconds, _outputLines) in repackResults.values())
+        print "\tRepackaged %i package(s) in %.2fs (%.2fs summed over packages, %i parallel)" % \
+              (len(repackResults) - len(failedPackages), wallTime, sumTimes, StaticInfo.guestRepackParallelism)
+        slowest = sorted(repackResults.iteritems(), key=lambda item: item[1][1], reverse=True)
+        for (pkgName, (_returnCode, seconds, _outputLines)) in slowest[:StaticInfo.guestRepackReportSlowest]:
+            print "\t\t{:30s} {:8.2f}s".format(pkgName, seconds)
+
     @abstractmethod
     def exportPackages(self, packageDict):pass
 
     @abstractmethod
-    def importPackages(self, mainServices, filenames):pass
+    def importPackages(self, mainServices, filenames, checksums=None, installLayers=None):pass
+
+    def installDirectly(self, installLayers, installCommand):
+        """
+            Installs the package files uploaded to self.vmi_repoFolder layer by layer without resolving dependencies.
+        :param installLayers: lists of package files in dependency order, see Reassembler.getInstallLayers
+        :param installCommand: command installing the package files appended to it (dpkg -i, rpm -U)
+        :return: True if all layers were installed
+        """
+        print "\tInstalling %i package(s) directly in %i layer(s)." % (sum(len(layer) for layer in installLayers),
+                                                                     len(installLayers))
+        for (index, layer) in enumerate(installLayers):
+            try:
+                self.guest.sh("cd " + self.vmi_repoFolder + " && " + installCommand + " " +
+                              " ".join(os.path.basename(fileName) for fileName in layer))
+            except RuntimeError as e:
+                print "\tDirect installation failed in layer %i/%i, dependencies are resolved by the package " \
+                      "manager instead:\n\t\t%s" % (index + 1, len(installLayers), str(e).strip().replace("\n", "\n\t\t"))
+                return False
+        return True
 
     @abstractmethod
     def removePackages(self, packageList):pass
@@ -79,27 +246,56 @@ class VMIManipulator:
     def compare(a, b):
         return len(a) - len(b)
 
-    @staticmethod
-    def relabelSELinux(pathToVMI):
-        print ('Relabeling VMI ' + pathToVMI + ' (required by SELinux): ')
-
-        absPathToVMI = os.path.dirname(os.path.realpath(__file__)) + '/' + pathToVMI
-        subprocess.call(
-            ['/home/csat2890/Downloads/libguestfs-1.36.7/run', 'virt-customize',
-             '--add', absPathToVMI,
-             '--selinux-relabel'],
-            stdout=subprocess.PIPE)
-
-    # TODO: check blkid-tab
-    @staticmethod
-    def resetImage(pathToVMI):
+    # files removed by the operations of virt-sysprep that resetGuest applies, in the form of [(operation, [globs])]
+    sysprepGlobs = [
+        ("abrt-data",               ["/var/spool/abrt/*"]),
+        ("bash-history",            ["/root/.bash_history", "/home/*/.bash_history"]),
+        ("blkid-tab",               ["/var/run/blkid.tab", "/var/run/blkid.tab.old", "/etc/blkid/blkid.tab",
+                                     "/etc/blkid/blkid.tab.old", "/etc/blkid.tab", "/etc/blkid.tab.old",
+                                     "/dev/.blkid.tab", "/dev/.blkid.tab.old"]),
+        ("crash-data",              ["/var/crash/*", "/var/log/dump/*"]),
+        ("dhcp-client-state",       ["/var/lib/dhclient/*", "/var/lib/dhcp/*"]),
+        ("dhcp-server-state",       ["/var/lib/dhcpd/*"]),
+        ("dovecot-data",            ["/var/lib/dovecot/*"]),
+        ("logfiles",                ["/var/log/*.log*", "/var/log/audit/*", "/var/log/btmp*", "/var/log/cron*",
+                                     "/var/log/dmesg*", "/var/log/lastlog*", "/var/log/maillog*",
+                                     "/var/log/messages*", "/var/log/secure*", "/var/log/spooler*",
+                                     "/var/log/syslog*", "/var/log/wtmp*", "/var/log/apt/*", "/var/log/journal/*",
+                                     "/var/log/installer/*", "/var/log/anaconda/*", "/var/log/dnf*",
+                                     "/var/log/hawkey.log*", "/var/log/yum.log*"]),
+        ("mail-spool",              ["/var/spool/mail/*", "/var/mail/*"]),
+        ("pacct-log",               ["/var/account/pacct*", "/var/log/account/pacct*"]),
+        ("pam-data",                ["/var/run/console/*", "/var/run/faillock/*", "/var/run/sepermit/*"]),
+        ("passwd-backups",          ["/etc/group-", "/etc/gshadow-", "/etc/passwd-", "/etc/shadow-",
+                                     "/etc/subuid-", "/etc/subgid-"]),
+        ("puppet-data-log",         ["/var/log/puppet/*", "/var/lib/puppet/*"]),
+        ("rh-subscription-manager", ["/etc/pki/consumer/*", "/etc/pki/entitlement/*"]),
+        ("rhn-systemid",            ["/etc/sysconfig/rhn/systemid", "/etc/sysconfig/rhn/osad-auth.conf"]),
+        ("rpm-db",                  ["/var/lib/rpm/__db.*"]),
+        ("samba-db-log",            ["/var/log/samba/*", "/var/lib/samba/*/*"]),
+        ("smolt-uuid",              ["/etc/sysconfig/hw-uuid", "/etc/smolt/uuid", "/etc/smolt/hw-uuid"]),
+        ("ssh-hostkeys",            ["/etc/ssh/*_host_*"]),
+        ("ssh-userdir",             ["/root/.ssh", "/home/*/.ssh"]),
+        ("sssd-db-log",             ["/var/log/sssd/*", "/var/lib/sss/db/*"]),
+        ("tmp-files",               ["/tmp/*", "/var/tmp/*"]),
+        ("udev-persistent-net",     ["/etc/udev/rules.d/70-persistent-net.rules"]),
+        ("utmp",                    ["/var/run/utmp"]),
+        ("yum-uuid",                ["/var/lib/yum/uuid"]),
+        ("machine-id",              ["/var/lib/dbus/machine-id"]),
+    ]
+    # folders searched for editor backup files (operation backup-files)
+    sysprepBackupFileFolders = ["/etc", "/root", "/srv"]
+    # random seeds replaced by new ones (operation customize)
+    sysprepRandomSeeds = ["/var/lib/random-seed", "/var/lib/systemd/random-seed", "/var/lib/urandom/random-seed"]
+
+    def resetGuest(self):
         """
-        Resets certain properties of the image. Intended to use after cloning
-        Reset properties:
+        Resets certain properties of the image through the existing guestfs handle. Intended to use after cloning.
+        Applies the following operations of virt-sysprep natively, i.e. without launching an appliance of its own:
             abrt-data:          crash data generated by ABRT
             backup-files:       editor backup files
             bash-history:       bash-history
-            blkid-tab:          cached information from blkid? #TODO
+            blkid-tab:          cached information from blkid
             crash-data:         automatically generated kdump kernel crash data
             dhcp-client-state:  DHCP client leases
             dhcp-server-state:  DHCP server leases
@@ -119,8 +315,7 @@ class VMIManipulator:
             rpm-db:             host-specific RPM database files and locks
             samba-db-log:       database and log files of Samba
             smolt-uuid:         Smolt hardware UUID
-            !ssh-hostkeys:      SSH host keys
-                                If, after cloning, the guest gets the same IP address, ssh will give you a stark warning about the host key changing:
+            ssh-hostkeys:       SSH host keys
             ssh-userdir:        ".ssh" directories in the guest
             sssd-db-log:        database and log files of sssd
             tmp-files:          temporary files under /tmp and /var/tmp
@@ -129,26 +324,69 @@ class VMIManipulator:
             yum-uuid:           yum UUID
             customize           to generate new random seed
 
-            REMOVED because of unidenfiable problems with virt-sysprep
+            NOT APPLIED (as with virt-sysprep before)
             package-manager-cache: package manager cache
             cron-spool:         user's at-jobs and cron-jobs (scheduled jobs)
-        :param pathToVMI:
-        :return:
         """
         print ('Resetting VMI (e.g. Log files, crashreports, editor backups ...): ')
+        guest = self.guest
+
+        for (_operation, globs) in VMIManipulator.sysprepGlobs:
+            for pattern in globs:
+                for path in guest.glob_expand(pattern):
+                    guest.rm_rf(path)
+
+        # backup-files
+        for folder in VMIManipulator.sysprepBackupFileFolders:
+            if guest.is_dir(folder):
+                for relPath in guest.find(folder):
+                    path = folder + "/" + relPath
+                    if (path.endswith("~") or path.endswith(".bak")) and guest.is_file(path):
+                        guest.rm(path)
+
+        # machine-id, an empty file makes systemd generate a new ID on next boot
+        if guest.is_file("/etc/machine-id"):
+            guest.truncate("/etc/machine-id")
+
+        # net-hwaddr, net-hostname
+        for path in guest.glob_expand("/etc/sysconfig/network-scripts/ifcfg-*"):
+            lines = guest.read_lines(path)
+            keptLines = [line for line in lines
+                         if not line.split("=", 1)[0].strip() in ["HWADDR", "HOSTNAME", "DHCP_HOSTNAME"]]
+            if len(keptLines) != len(lines):
+                guest.write(path, "".join(line + "\n" for line in keptLines))
+
+        # customize
+        for path in VMIManipulator.sysprepRandomSeeds:
+            if guest.is_file(path):
+                guest.write(path, os.urandom(512))
+
+        # lvm-uuids
+        if len(guest.pvs()) > 0:
+            try:
+                guest.pvchange_uuid_all()
+                guest.vgchange_uuid_all()
+            except RuntimeError as e:
+                print "\tLVM UUIDs could not be changed: %s" % e
 
-        absPathToVMI = os.path.dirname(os.path.realpath(__file__)) + '/' + pathToVMI
-        subprocess.call(
-            [StaticInfo.absPathLibguestfsRun, 'virt-sysprep',
-             '--add', absPathToVMI,
-             '--enable','customize'],
-            stdout=subprocess.PIPE)
-        subprocess.call(
-            [StaticInfo.absPathLibguestfsRun, 'virt-sysprep',
-                '--add', absPathToVMI,
-                '--operations',
-                'customize,abrt-data,backup-files,bash-history,blkid-tab,crash-data,dhcp-client-state,dhcp-server-state,dovecot-data,logfiles,lvm-uuids,machine-id,mail-spool,net-hostname,net-hwaddr,pacct-log,pam-data,passwd-backups,puppet-data-log,rh-subscription-manager,rhn-systemid,rpm-db,samba-db-log,smolt-uuid,ssh-hostkeys,ssh-userdir,sssd-db-log,tmp-files,udev-persistent-net,utmp,yum-uuid'],
-            stdout=subprocess.PIPE)
+    def relabelSELinux(self):
+        """
+            Relabels the filesystem of the guest with the file contexts of its SELinux policy through the existing
+            guestfs handle. If the guestfs version does not support relabeling, the guest relabels itself on next boot.
+        """
+        print ('Relabeling VMI (required by SELinux): ')
+        guest = self.guest
+        policyType = "targeted"
+        if guest.is_file("/etc/selinux/config"):
+            for line in guest.read_lines("/etc/selinux/config"):
+                if line.startswith("SELINUXTYPE="):
+                    policyType = line.split("=", 1)[1].strip()
+        specFile = "/etc/selinux/" + policyType + "/contexts/files/file_contexts"
+        try:
+            guest.selinux_relabel(specFile, "/", force=True)
+        except (AttributeError, RuntimeError) as e:
+            print "\tRelabeling in place failed (%s), relabeling is done on next boot." % e
+            guest.touch("/.autorelabel")
 
 
     def load(self):
@@ -208,53 +446,62 @@ class VMIManipulatorAPT(VMIManipulator):
                 self.guest.rm_rf(self.vmi_repackagingFolder)
                 self.guest.mkdir(self.vmi_repackagingFolder)
             print "\tStarting to repackage and export " + str(numPackages) + " package(s)."
-            packageFileNames = self.guest.sh(
-                "cd /var/exportpackages && fakeroot -u dpkg-repack " + " ".join(packageDict.keys()))
+            startTime = time.time()
+            repackResults = self.repackagePackages(packageDict.keys(), "fakeroot -u dpkg-repack")
+            repackTime = time.time() - startTime
 
-            # Download and extract packages, delete temp folder in guest
-            localpackagesFilePath = self.local_packageFolder + "/" + self.vmiName + "Packages.tar"
-            self.guest.tar_out(self.vmi_repackagingFolder, localpackagesFilePath)
-            self.guest.rm_rf(self.vmi_repackagingFolder)
-            with tarfile.open(localpackagesFilePath) as tar:
-                tar.extractall(path=self.local_packageFolder)
-            os.remove(localpackagesFilePath)
+            # Stream packages into local repository, delete temp folder in guest
+            checksums = self.streamOutPackages()
 
             # save filename information of packages
-            for line in packageFileNames.split("\n"):
-                matchResult = depMatcher.match(line)
-                if matchResult:
-                    pkgName = matchResult.group(1)
-                    pkgFileName = matchResult.group(2)
-                    pkgNewpath = self.local_packageFolder + "/" + pkgFileName
-                    packageInfoDict[pkgName][StaticInfo.dictKeyFilePath] = pkgNewpath
+            for (pkgName, (_returnCode, _seconds, outputLines)) in repackResults.iteritems():
+                for line in outputLines:
+                    matchResult = depMatcher.match(line)
+                    if matchResult and matchResult.group(1) in packageInfoDict:
+                        pkgFileName = os.path.basename(matchResult.group(2))
+                        if pkgFileName in checksums:
+                            pkgInfo = packageInfoDict[matchResult.group(1)]
+                            pkgInfo[StaticInfo.dictKeyFilePath] = self.local_packageFolder + "/" + pkgFileName
+                            pkgInfo[StaticInfo.dictKeyChecksum] = checksums[pkgFileName]
+            VMIManipulator.printRepackagingReport(
+                repackResults,
+                [pkgName for pkgName in repackResults if StaticInfo.dictKeyFilePath not in packageInfoDict[pkgName]],
+                repackTime)
 
         # make sure every package in packageInfoDict has a path
-        for pkg,pkgInfo in packageInfoDict.iteritems():
-            if "path" not in pkgInfo:
+        for pkg in packageInfoDict.keys():
+            if "path" not in packageInfoDict[pkg]:
                 del packageInfoDict[pkg]
-                print "ATTENTION: package \"%s\" was planned to be exported but failed."
+                print "ATTENTION: package \"%s\" was planned to be exported but failed." % pkg
 
         print "\t" + str(len(packageInfoDict)) + " package(s) exported"
         return packageInfoDict
 
-    def importPackages(self, mainServices, filenames):
+    def importPackages(self, mainServices, filenames, checksums=None, installLayers=None):
+        """
+        :param mainServices:
+        :param filenames: package files to import
+        :param checksums: SHA-256 of each package file (None if unknown), identify the cached package bundle
+        :param installLayers: if given, the package files are installed with dpkg in this order, apt only installs
+                              the main services if that fails
+        :return: error message of the installation if it is assumed to be harmless, None otherwise
+        """
 
         errorString = None
 
         # check if installation necessary
         if len(mainServices) > 0:
-            # prepare tarfile with compressed packages for import
-            localpackagesFilePath = self.local_packageFolder + "/" + self.vmiName + "Packages.tar"
-            with tarfile.open(localpackagesFilePath, mode='w') as tar:
-                for pkgFileName in filenames:
-                    tar.add(pkgFileName)
+            # bundle of packages and their Packages.gz, cached for the same package set
+            if checksums is None:
+                checksums = [None] * len(filenames)
+            (bundlePath, hasMetadata) = PackageBundle.getBundle(filenames, checksums, PackageBundle.formatDeb)
 
             # Upload packages to temporary repository
             try:
                 self.guest.mkdir(self.vmi_repoFolder)
             except:
                 print "\"" + self.vmi_repoFolder + "\" already exist in guest. Proceeding anyway."
-            self.guest.tar_in(localpackagesFilePath, self.vmi_repoFolder)
+            self.guest.tar_in(bundlePath, self.vmi_repoFolder)
 
             # Rename default .list
             self.guest.rename("/etc/apt/sources.list", "/etc/apt/sources.list2")
@@ -264,13 +511,21 @@ class VMIManipulatorAPT(VMIManipulator):
             self.guest.mkdir(self.vmi_sourcesConfigFolder)
             self.guest.upload(self.localSourcesFile, self.vmi_tmpSourceConfigPath)
 
-            self.guest.sh("cd /var/tempRepository && dpkg-scanpackages . /dev/null | gzip -9c > Packages.gz")
+            if not hasMetadata:
+                self.guest.sh("cd /var/tempRepository && dpkg-scanpackages . /dev/null | gzip -9c > Packages.gz")
 
             # Installing package
+            installed = False
+            if installLayers is not None:
+                installed = self.installDirectly(installLayers,
+                                                 "DEBIAN_FRONTEND=noninteractive dpkg --force-confnew -i")
             try:
-                self.guest.sh("apt-get update \
+                if not installed:
+                    # --fix-broken completes packages left unconfigured by a failed direct installation
+                    self.guest.sh("apt-get update \
                                 && DEBIAN_FRONTEND=noninteractive "
                                      "apt-get --option Dpkg::Options::=--force-confnew -y --allow-unauthenticated "
+                                     + ("--fix-broken " if installLayers is not None else "") +
                                      "install " + " ".join(mainServices) + "")
                 #exec >> '/var/builder.log' 2>&1 &&
             except RuntimeError as e:
@@ -290,9 +545,6 @@ class VMIManipulatorAPT(VMIManipulator):
             self.guest.rename("/etc/apt/sources.list2", "/etc/apt/sources.list")
             self.guest.rename("/etc/apt/sources.list.d2", "/etc/apt/sources.list.d")
 
-            # Remove temporary tarfile
-            os.remove(localpackagesFilePath)
-
         return errorString
 
     def removePackages(self, packageList):
@@ -360,59 +612,50 @@ class VMIManipulatorDNF(VMIManipulator):
 
 
             startTime = time.time()
+            repackResults = self.repackagePackages(
+                packageDict.keys(),
+                "rpmrebuild --batch --comment-missing=yes --directory " + self.vmi_repackagingFolder)
+            repackTime = time.time() - startTime
 
-            pkgFileNames = dict() # in form {pkgName:rebuildOutput}
-            i = 1
-            for pkgName in packageDict.keys():
-                #sys.stdout.write ("\r\t{:26s}| {:20s}".format(pkgName,"%i/%i (%.0f%%)" % (i,numPackages, (float(i)/numPackages*100))))
-                sys.stdout.write ("\r\t{:26s}| {:30s}".format("Progress: %i/%i (%.0f%%)" % (i,numPackages, (float(i)/numPackages*100)),pkgName))
-                #sys.stdout.write ("\r\tProgress: %i/%i (%.0f%%)" % (i,numPackages, (float(i)/numPackages*100)))
-                sys.stdout.flush()
-                i = i + 1
-                output = self.guest.sh("rpmrebuild --batch --comment-missing=yes --directory " + self.vmi_repackagingFolder + " " + pkgName)
-                for line in output.split("\n"):
+            # Stream packages into local repository (flattens directory structure), delete temp folder in guest
+            checksums = self.streamOutPackages()
+
+            for (pkgName, (_returnCode, _seconds, outputLines)) in repackResults.iteritems():
+                for line in outputLines:
                     if line.startswith("result: "):
-                        packageInfoDict[pkgName][StaticInfo.dictKeyFilePath] = self.local_packageFolder +\
-                                                                               "/" + line.rsplit("/",1)[1]
+                        pkgFileName = line.rsplit("/",1)[1]
+                        if pkgFileName in checksums:
+                            packageInfoDict[pkgName][StaticInfo.dictKeyFilePath] = self.local_packageFolder +\
+                                                                                   "/" + pkgFileName
+                            packageInfoDict[pkgName][StaticInfo.dictKeyChecksum] = checksums[pkgFileName]
                         break
-                # check if all packages were exported and received a filename
-                if StaticInfo.dictKeyFilePath not in packageInfoDict[pkgName]:
-                    print "\t\tcould not find repackaged \"%s\"" % pkgName
-                    print "\t\tOutput of repackaging:"
-                    print "\t\t" + str(output)
-            print ""
-            # Download and extract packages, delete temp folder in guest
-            localTempFileFolder = self.local_packageFolder + "/" + self.vmiName
-            os.mkdir(localTempFileFolder)
-            localTempPackagesTar = localTempFileFolder + "/Packages.tar"
-
-            self.guest.tar_out(self.vmi_repackagingFolder, localTempPackagesTar)
-            self.guest.rm_rf(self.vmi_repackagingFolder)
-            with tarfile.open(localTempPackagesTar) as tar:
-                tar.extractall(path=localTempFileFolder)
-            os.remove(localTempPackagesTar)
-
-            # move files in temp folder to actual repository folder (flattens directory structure)
-            for root, _dirs, files in os.walk(localTempFileFolder):
-                for filename in files:
-                    shutil.move(root + "/" + filename, self.local_packageFolder + "/" + filename)
-            shutil.rmtree(localTempFileFolder)
+            # check if all packages were exported and received a filename
+            VMIManipulator.printRepackagingReport(
+                repackResults,
+                [pkgName for pkgName in repackResults if StaticInfo.dictKeyFilePath not in packageInfoDict[pkgName]],
+                repackTime)
 
         # make sure every package in packageInfoDict has a path
-        for pkg, pkgInfo in packageInfoDict.iteritems():
-            if "path" not in pkgInfo:
+        for pkg in packageInfoDict.keys():
+            if "path" not in packageInfoDict[pkg]:
                 del packageInfoDict[pkg]
-                print "ATTENTION: package \"%s\" was planned to be exported but failed."
+                print "ATTENTION: package \"%s\" was planned to be exported but failed." % pkg
         return packageInfoDict
 
-    def importPackages(self, mainServices, filenames):
+    def importPackages(self, mainServices, filenames, checksums=None, installLayers=None):
+        """
+        :param mainServices:
+        :param filenames: package files to import
+        :param checksums: SHA-256 of each package file (None if unknown), identify the cached package bundle
+        :param installLayers: if given, the package files are installed with rpm in this order, dnf only installs
+                              the main services if that fails
+        """
         if len(mainServices) > 0:
 
-            # prepare tarfile with compressed packages for import
-            localPkgsTarPath = self.local_packageFolder + "/" + self.vmiName + "Packages.tar"
-            with tarfile.open(localPkgsTarPath, mode='w') as tar:
-                for pkgFileName in filenames:
-                    tar.add(pkgFileName)
+            # bundle of packages and their repodata/, cached for the same package set
+            if checksums is None:
+                checksums = [None] * len(filenames)
+            (bundlePath, hasMetadata) = PackageBundle.getBundle(filenames, checksums, PackageBundle.formatRpm)
 
             # Upload packages to temporary repository
             try:
@@ -420,7 +663,7 @@ class VMIManipulatorDNF(VMIManipulator):
             except:
                 print "\"" + self.vmi_repoFolder + "\" already exist in guest. Proceeding anyway."
 
-            self.guest.tar_in(localPkgsTarPath, self.vmi_repoFolder)
+            self.guest.tar_in(bundlePath, self.vmi_repoFolder)
 
             # Backup VMI repo configs locally and remove in vmi
             localVmiRepoConfigBackup = StaticInfo.relPathLocalRepository + "/" + self.vmiName + "_repoConfigs.tar"
@@ -434,10 +677,15 @@ class VMIManipulatorDNF(VMIManipulator):
 
             # Create temporary local repository config in vmi
             self.guest.upload(self.localSourcesFile, self.vmi_tmpSourceConfigPath)
-            self.guest.sh("createrepo " + self.vmi_repoFolder)
 
             # Installing package
-            self.guest.sh("dnf --nogpgcheck -y install " + " ".join(mainServices))
+            installed = False
+            if installLayers is not None:
+                installed = self.installDirectly(installLayers, "rpm -U --nosignature")
+            if not installed:
+                if not hasMetadata:
+                    self.guest.sh("createrepo " + self.vmi_repoFolder)
+                self.guest.sh("dnf --nogpgcheck -y install " + " ".join(mainServices))
 
             # Remove temporary repository
             self.guest.rm_rf(self.vmi_repoFolder)
@@ -451,9 +699,6 @@ class VMIManipulatorDNF(VMIManipulator):
             # Remove original repo config backup
             os.remove(localVmiRepoConfigBackup)
 
-            # Remove temporary tarfile
-            os.remove(localPkgsTarPath)
-
             # Cleanup repository
             self.guest.sh("dnf clean all")
 
@@ -1,6 +1,8 @@
 import sys
 from collections import defaultdict
 
+import numpy as np
+
 from StaticInfo import StaticInfo
 from GuestFSHelper import GuestFSHelper
 from VMIDescription import VMIDescriptor
@@ -54,9 +56,9 @@ class SimilarityCalculator:
 
         if onlyOnMainServices:
             # nodesToCheck: union(mainServices1,mainServices2)
-            nodesToCheck = set(vmi1.getNodeDataFromMainServicesSubtrees().keys()) \
+            nodesToCheck = set(vmi1.getClosureNodeData(vmi1.mainServices).keys()) \
                 .union(
-                set(vmi2.getNodeDataFromMainServicesSubtrees().keys()))
+                set(vmi2.getClosureNodeData(vmi2.mainServices).keys()))
             numAllNodes = len(nodesToCheck)
 
             # prefilter nodesToCheck by name occurring in both graphs
@@ -139,9 +141,9 @@ class SimilarityCalculator:
 
         if onlyOnMainServices:
             # nodesToCheck: union(g1-mainServices1,g2-mainServices2)
-            nodesToCheck = set(vmi1.getNodeDataFromMainServicesSubtrees().keys())\
+            nodesToCheck = set(vmi1.getClosureNodeData(vmi1.mainServices).keys())\
                            .union(
-                           set(vmi2.getNodeDataFromMainServicesSubtrees().keys()))
+                           set(vmi2.getClosureNodeData(vmi2.mainServices).keys()))
         else:
             # nodesToCheck: union(G1,G2)
             nodesToCheck = set(g1NodesDict.keys()).union(set(g2NodesDict.keys()))
@@ -221,12 +223,12 @@ class SimilarityCalculator:
 
         # Create Descriptors/Graphs for each VMI
         print "\n=== Creating Descriptor for VMI \"%s\"" % (pathToVMI1)
-        (guest, root) = GuestFSHelper.getHandle(pathToVMI1, rootRequired=True)
+        (guest, root) = GuestFSHelper.getHandle(pathToVMI1, rootRequired=True, readOnly=True)
         vmi1 = VMIDescriptor(pathToVMI1, "internal_vmi1", mainServices1, guest, root)
         GuestFSHelper.shutdownHandle(guest)
 
         print "\n=== Creating Descriptor for VMI \"%s\"" % (pathToVMI2)
-        (guest, root) = GuestFSHelper.getHandle(pathToVMI2, rootRequired=True)
+        (guest, root) = GuestFSHelper.getHandle(pathToVMI2, rootRequired=True, readOnly=True)
         vmi2 = VMIDescriptor(pathToVMI2, "internal_vmi2", mainServices2, guest, root)
         GuestFSHelper.shutdownHandle(guest)
 
@@ -238,6 +240,32 @@ class SimilarityCalculator:
         graphSimilarity = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi1, vmi2, onlyOnMainServices)
         return graphSimilarity
 
+    @staticmethod
+    def createVMIDescriptors(vmiData, skipFailed=False):
+        """
+            Creates the descriptors for many VMIs in batch, several VMIs share one appliance launch.
+        :param list() vmiData:  in the form of [(pathToVMI, vmiFileName, [MS1,MS2])]
+        :param bool skipFailed: if True, VMIs that cannot be inspected are reported and skipped instead of aborting the batch
+        :return: list of VMIDescriptors in the order of vmiData, None for skipped VMIs
+        """
+        vmiDescriptors = list()
+        pathsToVMI = list(pathToVMI for (pathToVMI, vmiFileName, mainServices) in vmiData)
+        count = 0
+        for (pathToVMI, guest, root) in GuestFSHelper.iterateRoots(pathsToVMI):
+            (_, vmiFileName, mainServices) = vmiData[count]
+            count = count + 1
+            print "Creating Descriptor for vmi \"%s\" (%i/%i)..." % (vmiFileName, count, len(vmiData))
+            try:
+                if guest is None:
+                    raise root
+                vmiDescriptors.append(VMIDescriptor(pathToVMI, vmiFileName, mainServices, guest, root))
+            except Exception as e:
+                if not skipFailed:
+                    raise
+                print "\tError while inspecting VMI \"%s\", VMI is skipped: %s" % (pathToVMI, e)
+                vmiDescriptors.append(None)
+        return vmiDescriptors
+
     @staticmethod
     def computeSimilarityManyToMany(vmiData, onlyOnMainServices):
         if onlyOnMainServices:
@@ -245,34 +273,90 @@ class SimilarityCalculator:
         else:
             print "=====Calculating similarities between each of %i VMIs" % len(vmiData)
 
-        sortedVMIDescriptorList = list()
-        count = 0
-        for (pathToVMI, vmiFileName, mainServices) in vmiData:
-            count = count + 1
-            print "Creating Descriptor for vmi \"%s\" (%i/%i)..." % (vmiFileName, count, len(vmiData))
-            (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
-            vmi = VMIDescriptor(pathToVMI, vmiFileName, mainServices, guest, root)
-            GuestFSHelper.shutdownHandle(guest)
-            sortedVMIDescriptorList.append(vmi)
+        sortedVMIDescriptorList = SimilarityCalculator.createVMIDescriptors(vmiData)
+
+        # Check if Main Services exist
+        for vmi in sortedVMIDescriptorList:
+            SimilarityCalculator.checkMainServicesExistence(vmi, vmi.mainServices)
+
+        similarityMatrix = SimilarityCalculator.computeWeightedSimilarityMatrix(sortedVMIDescriptorList,
+                                                                                onlyOnMainServices)
 
         similarities = defaultdict(dict)
-        for vmi1 in sortedVMIDescriptorList:
+        for (i, vmi1) in enumerate(sortedVMIDescriptorList):
             print "Similarities for VMI \"%s\":" % vmi1.vmiName
-            for vmi2 in sortedVMIDescriptorList:
+            for (j, vmi2) in enumerate(sortedVMIDescriptorList):
                 if vmi1.pathToVMI == vmi2.pathToVMI:
                     similarities[vmi1.vmiName][vmi2.vmiName] = None
                 else:
-                    # Check if Main Services exist
-                    SimilarityCalculator.checkMainServicesExistence(vmi1, vmi1.mainServices)
-                    SimilarityCalculator.checkMainServicesExistence(vmi2, vmi2.mainServices)
-
-                    sim = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi1, vmi2,
-                                                                                              onlyOnMainServices,
-                                                                                              verbose=False)
+                    sim = float(similarityMatrix[i, j])
                     similarities[vmi1.vmiName][vmi2.vmiName] = sim
                     print "\t%0.2f similarity to VMI \"%s\"" % (sim, vmi2.vmiName)
         return similarities
 
+    @staticmethod
+    def computeWeightedSimilarityMatrix(vmiDescriptors, onlyOnMainServices):
+        """
+            Computes computeWeightedSimilarityBetweenVMIDescriptors for all pairs of VMIs at once.
+            Each VMI is encoded as a row over the vocabulary of all package names, holding install size, version and
+            architecture of each package. Similarities are computed row by row against all following VMIs,
+            the matrix is symmetric.
+        :param list() vmiDescriptors: list of VMIDescriptors
+        :param Boolean onlyOnMainServices:
+        :return: numpy array in the form of matrix[i, j] = similarity between vmiDescriptors[i] and vmiDescriptors[j]
+        """
+        numVMIs = len(vmiDescriptors)
+        pkgNameIDs = dict()
+        versionIDs = dict()
+        archIDs = {"all": 0}
+        for vmi in vmiDescriptors:
+            for (pkgName, version, architecture) in vmi.graph.iterPackageVersions():
+                pkgNameIDs.setdefault(pkgName, len(pkgNameIDs))
+                versionIDs.setdefault(version, len(versionIDs))
+                archIDs.setdefault(architecture, len(archIDs))
+        numPkgNames = len(pkgNameIDs)
+
+        # in the form of matrix[vmi, pkgName], version and architecture -1 for packages missing in VMI
+        sizes = np.zeros((numVMIs, numPkgNames))
+        versions = np.full((numVMIs, numPkgNames), -1, dtype=np.int32)
+        architectures = np.full((numVMIs, numPkgNames), -1, dtype=np.int32)
+        # packages to compare (all packages or main services and their dependencies)
+        toCheck = np.zeros((numVMIs, numPkgNames), dtype=bool)
+        for (i, vmi) in enumerate(vmiDescriptors):
+            columns = list()
+            for (pkgName, version, architecture) in vmi.graph.iterPackageVersions():
+                column = pkgNameIDs[pkgName]
+                columns.append(column)
+                versions[i, column] = versionIDs[version]
+                architectures[i, column] = archIDs[architecture]
+            sizes[i, columns] = vmi.graph.installSizes
+            if onlyOnMainServices:
+                toCheck[i, [pkgNameIDs[pkgName] for pkgName in vmi.getClosureNodeData(vmi.mainServices)]] = True
+            else:
+                toCheck[i, columns] = True
+
+        # similarity = sum of max(size1, size2) over matching packages in union of packages to check
+        #            / sum of max(size1, size2) over union of packages to check
+        # (normalization by the maximum install size cancels out)
+        similarityMatrix = np.zeros((numVMIs, numVMIs))
+        for i in range(numVMIs - 1):
+            others = slice(i + 1, numVMIs)
+            union = toCheck[i] | toCheck[others]
+            weights = np.maximum(sizes[i], sizes[others])
+            matches = union \
+                & (versions[i] >= 0) \
+                & (versions[i] == versions[others]) \
+                & ((architectures[i] == architectures[others])
+                   | (architectures[i] == archIDs["all"])
+                   | (architectures[others] == archIDs["all"]))
+            sumAll = (weights * union).sum(axis=1)
+            sumMatches = (weights * matches).sum(axis=1)
+            rowSimilarities = np.where(sumAll > 0, sumMatches / np.where(sumAll > 0, sumAll, 1.0), 0.0)
+            similarityMatrix[i, others] = rowSimilarities
+            similarityMatrix[others, i] = rowSimilarities
+        np.fill_diagonal(similarityMatrix, 1.0)
+        return similarityMatrix
+
     @staticmethod
     def computeSimilarityManyToManyOLD(vmisAndMS, onlyOnMainServices):
         if onlyOnMainServices:
@@ -286,7 +370,7 @@ class SimilarityCalculator:
             i = i + 1
             print "Creating Descriptor for vmi \"%s\" (%i/%i)..." % (vmiFileName, i, len(vmisAndMS))
             pathToVMI = StaticInfo.relPathLocalVMIFolder + "/" + vmiFileName
-            (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
+            (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True, readOnly=True)
             vmi = VMIDescriptor(pathToVMI, vmiFileName, mainServices, guest, root)
             GuestFSHelper.shutdownHandle(guest)
             sortedVMIDescriptorList.append(vmi)
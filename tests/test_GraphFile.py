@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import networkx as nx
+
+from GraphFile import GraphFile, GraphFileLog
+from PackageGraph import PackageGraph
+from tests.test_PackageGraph import GraphTestCase, createRandomGraph
+
+
+class GraphFileTest(GraphTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.graphFileName = os.path.join(self.folder, "graph.expg")
+        self.nxGraph = createRandomGraph(200, 600, "1.", 7)
+        for (i, pkgName) in enumerate(sorted(self.nxGraph.nodes())):
+            if i % 3 == 0:
+                self.nxGraph.nodes[pkgName]["path"] = "packages/%s.deb" % pkgName
+        self.graph = PackageGraph.fromNetworkX(self.nxGraph)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testRoundTrip(self):
+        GraphFile.write(self.graph, self.graphFileName)
+        self.assertTrue(GraphFile.isGraphFile(self.graphFileName))
+        self.assertSameGraph(GraphFile.read(self.graphFileName), self.nxGraph)
+        self.assertSameGraph(GraphFile.load(self.graphFileName), self.nxGraph)
+
+    def testTruncatedFile(self):
+        GraphFile.write(self.graph, self.graphFileName)
+        with open(self.graphFileName, "rb") as graphFile:
+            buf = graphFile.read()
+        self.assertRaises(ValueError, GraphFile.fromString, buf[:20])
+        self.assertRaises(ValueError, GraphFile.fromString, "X" + buf[1:])
+
+    def testConvertPickle(self):
+        pickleFileName = os.path.join(self.folder, "graph.pkl")
+        self.graph.writePickle(pickleFileName)
+        self.assertFalse(GraphFile.isGraphFile(pickleFileName))
+        self.assertSameGraph(GraphFile.load(pickleFileName), self.nxGraph)
+        graphFileName = GraphFile.convertPickle(pickleFileName)
+        self.assertFalse(os.path.exists(pickleFileName))
+        self.assertSameGraph(GraphFile.load(graphFileName), self.nxGraph)
+
+    def testMappedGraph(self):
+        GraphFile.write(self.graph, self.graphFileName)
+        with GraphFile.open(self.graphFileName) as mappedGraph:
+            self.assertEqual(len(mappedGraph), self.graph.number_of_nodes())
+            self.assertEqual(mappedGraph.number_of_edges(), self.graph.number_of_edges())
+            for pkgName in self.graph:
+                self.assertEqual(mappedGraph.nodeData(pkgName), self.graph.nodeData(pkgName))
+                self.assertEqual(sorted(mappedGraph.successors(pkgName)), sorted(self.graph.successors(pkgName)))
+            self.assertEqual(set(mappedGraph.bfsNodes(["p1", "p42"])), set(self.graph.bfsNodes(["p1", "p42"])))
+            self.assertFalse("missing" in mappedGraph)
+            self.assertRaises(KeyError, mappedGraph.nodeData, "missing")
+
+
+class GraphFileLogTest(GraphTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.graphFileName = os.path.join(self.folder, "master.expg")
+        self.nxGraph = createRandomGraph(50, 100, "1.", 8)
+        GraphFile.write(PackageGraph.fromNetworkX(self.nxGraph), self.graphFileName)
+        # subgraphs sharing packages with the snapshot, those keep the attributes of the snapshot
+        self.records = list()
+        for seed in range(3):
+            nxSubGraph = createRandomGraph(60, 80, "2.", 20 + seed)
+            self.records.append((["p%i" % seed, "p%i" % (seed + 10)], PackageGraph.fromNetworkX(nxSubGraph)))
+            self.nxGraph = nx.compose(nxSubGraph, self.nxGraph)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testLoad(self):
+        logSize = GraphFileLog.append(self.graphFileName, self.records[:1])
+        self.assertEqual(GraphFileLog.append(self.graphFileName, self.records[1:]),
+                         GraphFileLog.getLogSize(self.graphFileName))
+        self.assertTrue(GraphFileLog.getLogSize(self.graphFileName) > logSize)
+        (graph, mainServices) = GraphFileLog.load(self.graphFileName)
+        self.assertSameGraph(graph, self.nxGraph)
+        self.assertEqual(mainServices, set(["p0", "p1", "p2", "p10", "p11", "p12"]))
+
+    def testLoadWithoutLog(self):
+        (graph, mainServices) = GraphFileLog.load(self.graphFileName)
+        self.assertEqual(graph.number_of_nodes(), 50)
+        self.assertEqual(mainServices, set())
+
+    def testCompact(self):
+        GraphFileLog.append(self.graphFileName, self.records)
+        GraphFileLog.compact(self.graphFileName)
+        self.assertEqual(GraphFileLog.getLogSize(self.graphFileName), 0)
+        self.assertSameGraph(GraphFile.load(self.graphFileName), self.nxGraph)
+        self.assertSameGraph(GraphFileLog.load(self.graphFileName)[0], self.nxGraph)
+        # records that are already contained in the snapshot do no harm
+        GraphFileLog.append(self.graphFileName, self.records)
+        self.assertSameGraph(GraphFileLog.load(self.graphFileName)[0], self.nxGraph)
+
+    def testIncompleteRecord(self):
+        logSize = GraphFileLog.append(self.graphFileName, self.records)
+        with open(GraphFileLog.getLogFileName(self.graphFileName), "ab") as logFile:
+            logFile.write(GraphFileLog.recordMarker + "\x01")
+        self.assertTrue(GraphFileLog.getLogSize(self.graphFileName) > logSize)
+        self.assertSameGraph(GraphFileLog.load(self.graphFileName)[0], self.nxGraph)
+
+    def testTruncate(self):
+        logSize = GraphFileLog.append(self.graphFileName, self.records[:2])
+        GraphFileLog.append(self.graphFileName, self.records[2:])
+        GraphFileLog.truncate(self.graphFileName, logSize)
+        self.assertEqual(GraphFileLog.getLogSize(self.graphFileName), logSize)
+        self.assertEqual(GraphFileLog.load(self.graphFileName)[1], set(["p0", "p1", "p10", "p11"]))
+        GraphFileLog.truncate(self.graphFileName, 0)
+        self.assertFalse(os.path.exists(GraphFileLog.getLogFileName(self.graphFileName)))
+        GraphFileLog.remove(self.graphFileName)
+        self.assertFalse(os.path.exists(self.graphFileName))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from PackageBundle import PackageBundle
+
+
+def createTarGz(files):
+    """
+    :param files: dict in the form of {name:content}
+    :return: content of a .tar.gz with the files
+    """
+    buf = StringIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name in sorted(files):
+            info = tarfile.TarInfo(name)
+            info.size = len(files[name])
+            tar.addfile(info, StringIO(files[name]))
+    return buf.getvalue()
+
+
+def createDeb(fileName, control):
+    """
+        Writes a minimal Debian package (ar archive) with the given control file.
+    """
+    members = [("debian-binary", "2.0\n"),
+               ("control.tar.gz", createTarGz({"./control": control, "./md5sums": ""})),
+               ("data.tar.gz", createTarGz({"./usr/share/doc/x": "x"}))]
+    with open(fileName, "wb") as debFile:
+        debFile.write("!<arch>\n")
+        for (name, data) in members:
+            debFile.write("%-16s%-12s%-6s%-6s%-8s%-10i`\n" % (name, "0", "0", "0", "100644", len(data)))
+            debFile.write(data)
+            if len(data) % 2 == 1:
+                debFile.write("\n")
+
+
+class AptMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testReadDebControl(self):
+        control = "Package: a\nVersion: 1.0\nArchitecture: all\n"
+        fileName = os.path.join(self.folder, "a_1.0_all.deb")
+        createDeb(fileName, control)
+        self.assertEqual(PackageBundle.readDebControl(fileName), control)
+
+    def testNoDebianPackage(self):
+        fileName = os.path.join(self.folder, "a.deb")
+        with open(fileName, "wb") as debFile:
+            debFile.write("no package")
+        self.assertRaises(ValueError, PackageBundle.readDebControl, fileName)
+
+    def testWriteAptMetadata(self):
+        fileNames = []
+        checksums = []
+        for name in ["b", "a"]:
+            fileName = os.path.join(self.folder, "%s_1.0_all.deb" % name)
+            createDeb(fileName, "Package: %s\nVersion: 1.0\nArchitecture: all\n" % name)
+            fileNames.append(fileName)
+            with open(fileName, "rb") as debFile:
+                checksums.append(hashlib.sha256(debFile.read()).hexdigest())
+        PackageBundle.writeAptMetadata(self.folder, fileNames, checksums)
+        with gzip.open(os.path.join(self.folder, "Packages.gz")) as packagesFile:
+            stanzas = packagesFile.read().split("\n\n")
+        # sorted by file name, same as dpkg-scanpackages
+        self.assertEqual([stanza.split("\n")[0] for stanza in stanzas], ["Package: a", "Package: b"])
+        for (fileName, checksum) in zip(fileNames, checksums):
+            stanza = stanzas[0] if os.path.basename(fileName).startswith("a") else stanzas[1]
+            with open(fileName, "rb") as debFile:
+                content = debFile.read()
+            fields = dict(line.split(": ", 1) for line in stanza.rstrip("\n").split("\n"))
+            self.assertEqual(fields["Filename"], "./" + os.path.basename(fileName))
+            self.assertEqual(fields["Size"], str(len(content)))
+            self.assertEqual(fields["MD5sum"], hashlib.md5(content).hexdigest())
+            self.assertEqual(fields["SHA1"], hashlib.sha1(content).hexdigest())
+            self.assertEqual(fields["SHA256"], checksum)
+
+
+if __name__ == "__main__":
+    unittest.main()
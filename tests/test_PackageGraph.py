@@ -0,0 +1,131 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import networkx as nx
+
+from PackageGraph import PackageGraph
+
+
+def createRandomGraph(numPkgs, numDeps, versionPrefix, seed):
+    """
+        Random networkx graph with the node and edge attributes of package graphs.
+    :return: nx.MultiDiGraph
+    """
+    rand = random.Random(seed)
+    nxGraph = nx.MultiDiGraph()
+    nxGraph.add_nodes_from(("p%i" % i, {"name": "p%i" % i, "version": versionPrefix + str(i), "architecture": "amd64",
+                                        "essential": i % 5 == 0, "size": i * 10, "path": None})
+                           for i in range(numPkgs))
+    for _ in range(numDeps):
+        nxGraph.add_edge("p%i" % rand.randrange(numPkgs), "p%i" % rand.randrange(numPkgs),
+                         constraint=rand.random() < 0.5, operator=rand.choice([">=", "=", "<<", None]),
+                         version=versionPrefix + str(rand.randrange(5)))
+    return nxGraph
+
+
+class GraphTestCase(unittest.TestCase):
+    def assertSameGraph(self, graph, nxGraph):
+        self.assertEqual(dict(graph.nodes(data=True)), dict(nxGraph.nodes(data=True)))
+        self.assertEqual(sorted(graph.edges(data=True)), sorted(nxGraph.edges(data=True)))
+        self.assertEqual(graph.number_of_nodes(), nxGraph.number_of_nodes())
+        self.assertEqual(graph.number_of_edges(), nxGraph.number_of_edges())
+
+
+class PackageGraphTest(GraphTestCase):
+    """
+        PackageGraph replaces networkx.MultiDiGraph, results have to be the same as with networkx.
+    """
+    def testBuild(self):
+        nxGraph = createRandomGraph(300, 900, "1.", 1)
+        graph = PackageGraph()
+        graph.add_nodes_from(nxGraph.nodes(data=True))
+        edges = list(nxGraph.edges(data=True))
+        # edges added after compaction are kept apart until the next compaction
+        graph.add_edges_from(edges[:400])
+        graph.compact()
+        graph.add_edges_from(edges[400:])
+        self.assertSameGraph(graph, nxGraph)
+        graph.compact()
+        self.assertSameGraph(graph, nxGraph)
+        for pkgName in ["p0", "p17", "p299"]:
+            self.assertEqual(sorted(graph.successors(pkgName)), sorted(nxGraph.successors(pkgName)))
+
+    def testNetworkXConversion(self):
+        nxGraph = createRandomGraph(50, 120, "1.", 2)
+        graph = PackageGraph.fromNetworkX(nxGraph)
+        self.assertSameGraph(graph, nxGraph)
+        self.assertSameGraph(graph, graph.toNetworkX())
+
+    def testBfs(self):
+        nxGraph = createRandomGraph(300, 400, "1.", 3)
+        graph = PackageGraph.fromNetworkX(nxGraph)
+        for roots in [["p3"], ["p3", "p77"], ["p10", "p11", "p12"]]:
+            expected = set()
+            for root in roots:
+                expected.update(nx.bfs_tree(nxGraph, root))
+            self.assertEqual(set(graph.bfsNodes(roots)), expected)
+
+    def testSubgraph(self):
+        nxGraph = createRandomGraph(300, 900, "1.", 4)
+        graph = PackageGraph.fromNetworkX(nxGraph)
+        pkgNames = list(nx.bfs_tree(nxGraph, "p5")) + ["p1", "p2"]
+        self.assertSameGraph(graph.subgraph(pkgNames), nxGraph.subgraph(pkgNames))
+
+    def testCompose(self):
+        for seed in range(30):
+            nxGraph1 = createRandomGraph(12, 40, "a", seed)
+            nxGraph2 = createRandomGraph(15, 40, "b", seed + 100)
+            graph1 = PackageGraph.fromNetworkX(nxGraph1)
+            graph2 = PackageGraph.fromNetworkX(nxGraph2)
+            # attributes of graph2 take precedence
+            self.assertSameGraph(PackageGraph.compose(graph1, graph2), nx.compose(nxGraph1, nxGraph2))
+            # attributes of the graph that is added to are kept
+            graph1.addGraph(graph2, keepAttributes=True)
+            self.assertSameGraph(graph1, nx.compose(nxGraph2, nxGraph1))
+
+    def testStronglyConnectedComponents(self):
+        for seed in range(30):
+            nxGraph = createRandomGraph(40, 60, "1.", seed)
+            graph = PackageGraph.fromNetworkX(nxGraph)
+            pkgNames = ["p%i" % i for i in range(0, 40, 2)]
+            components = graph.stronglyConnectedComponents(pkgNames)
+            expected = nx.strongly_connected_components(nx.DiGraph(nxGraph.subgraph(pkgNames)))
+            self.assertEqual(sorted(sorted(component) for component in components),
+                             sorted(sorted(component) for component in expected))
+
+
+class PackageGraphPickleTest(GraphTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testRoundTrip(self):
+        nxGraph = createRandomGraph(300, 900, "1.", 5)
+        graph = PackageGraph.fromNetworkX(nxGraph)
+        graph.add_edge("p1", "p2", {"constraint": False, "operator": None, "version": None})
+        nxGraph.add_edge("p1", "p2", constraint=False, operator=None, version=None)
+        graphFileName = os.path.join(self.folder, "graph.pkl")
+        graph.writePickle(graphFileName)
+        loadedGraph = PackageGraph.readPickle(graphFileName)
+        self.assertSameGraph(loadedGraph, nxGraph)
+        self.assertEqual(loadedGraph.nodes(), graph.nodes())
+        # graphs are still mutable after loading
+        loadedGraph.add_node("new", {"name": "new", "version": "1", "architecture": "all", "essential": False,
+                                     "size": 1, "path": None})
+        loadedGraph.add_edge("new", "p1", {"constraint": False, "operator": None, "version": None})
+        self.assertEqual(list(loadedGraph.successors("new")), ["p1"])
+
+    def testReadNetworkXPickle(self):
+        nxGraph = createRandomGraph(100, 200, "1.", 6)
+        graphFileName = os.path.join(self.folder, "legacy.pkl")
+        nx.write_gpickle(nxGraph, graphFileName)
+        self.assertSameGraph(PackageGraph.readPickle(graphFileName), nxGraph)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from PackageGraph import PackageGraph
+from StaticInfo import StaticInfo
+
+try:
+    from Reassembler import Reassembler
+except ImportError:
+    # requires python-guestfs
+    Reassembler = None
+
+
+def createGraph(dependencies):
+    """
+    :param dependencies: list of tuples (pkgName, depPkgName)
+    :return: PackageGraph
+    """
+    graph = PackageGraph()
+    for pkgName in sorted(set(pkgName for dependency in dependencies for pkgName in dependency)):
+        graph.add_node(pkgName, {"name": pkgName, "version": "1", "architecture": "all", "essential": False,
+                                 "size": 1, "path": None})
+    for (pkgName, depPkgName) in dependencies:
+        graph.add_edge(pkgName, depPkgName, {"constraint": False, "operator": None, "version": None})
+    return graph
+
+
+@unittest.skipIf(Reassembler is None, "python-guestfs is not installed")
+class InstallLayersTest(unittest.TestCase):
+    def setUp(self):
+        self.batchSize = StaticInfo.directInstallBatchSize
+
+    def tearDown(self):
+        StaticInfo.directInstallBatchSize = self.batchSize
+
+    def testDependenciesFirst(self):
+        graph = createGraph([("a", "b"), ("b", "c"), ("d", "c"), ("e", "installed")])
+        self.assertEqual(Reassembler.getInstallLayers(graph, ["a", "b", "c", "d", "e"]),
+                         [["c", "e"], ["b", "d"], ["a"]])
+
+    def testCyclesShareLayer(self):
+        graph = createGraph([("a", "b"), ("b", "c"), ("c", "b"), ("c", "d"), ("e", "a")])
+        self.assertEqual(Reassembler.getInstallLayers(graph, ["a", "b", "c", "d", "e"]),
+                         [["d"], ["b", "c"], ["a"], ["e"]])
+
+    def testPackagesNotInGraph(self):
+        graph = createGraph([("a", "b")])
+        self.assertEqual(Reassembler.getInstallLayers(graph, ["a", "b", "x"]), [["b", "x"], ["a"]])
+        self.assertEqual(Reassembler.getInstallLayers(graph, []), [])
+
+    def testBatchSize(self):
+        StaticInfo.directInstallBatchSize = 2
+        graph = createGraph([("a", "b"), ("b", "a"), ("x", "y")])
+        self.assertEqual(Reassembler.getInstallLayers(graph, ["a", "b", "c", "d", "x", "y"]),
+                         [["a", "b"], ["c", "d"], ["y"], ["x"]])
+        # cycles are never split
+        StaticInfo.directInstallBatchSize = 1
+        self.assertEqual(Reassembler.getInstallLayers(graph, ["a", "b"]), [["a", "b"]])
+
+
+if __name__ == "__main__":
+    unittest.main()